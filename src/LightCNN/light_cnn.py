@@ -47,7 +47,26 @@ class resblock(nn.Module):
         out = out + res
         return out
 
-class network_9layers(nn.Module):
+class embedding_network(object):
+    """
+    Inference path shared by the networks: embed() returns the fc embedding only,
+    without dropout or the fc2 classifier, and without autograd bookkeeping.
+    Build the network with num_classes=None to leave the classifier out altogether.
+    """
+    channels_last = False
+
+    def to_channels_last(self):
+        """Keep weights and inputs in channels-last layout, which CPU convolutions run faster on"""
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
+    @torch.inference_mode()
+    def embed(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.embedding(x)
+
+class network_9layers(embedding_network, nn.Module):
     def __init__(self, num_classes=79077):
         super(network_9layers, self).__init__()
         self.features = nn.Sequential(
@@ -62,17 +81,20 @@ class network_9layers(nn.Module):
             nn.MaxPool2d(kernel_size=2, stride=2, ceil_mode=True),
             )
         self.fc1 = mfm(8*8*128, 256, type=0)
-        self.fc2 = nn.Linear(256, num_classes)
+        self.fc2 = nn.Linear(256, num_classes) if num_classes else None
 
-    def forward(self, x):
+    def embedding(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
-        x = self.fc1(x)
+        x = torch.flatten(x, 1)
+        return self.fc1(x)
+
+    def forward(self, x):
+        x = self.embedding(x)
         x = F.dropout(x, training=self.training)
-        out = self.fc2(x)
+        out = self.fc2(x) if self.fc2 is not None else None
         return out, x
 
-class network_29layers(nn.Module):
+class network_29layers(embedding_network, nn.Module):
     def __init__(self, block, layers, num_classes=79077):
         super(network_29layers, self).__init__()
         self.conv1  = mfm(1, 48, 5, 1, 2)
@@ -89,7 +111,7 @@ class network_29layers(nn.Module):
         self.group4 = group(128, 128, 3, 1, 1)
         self.pool4  = nn.MaxPool2d(kernel_size=2, stride=2, ceil_mode=True)
         self.fc     = mfm(8*8*128, 256, type=0)
-        self.fc2    = nn.Linear(256, num_classes)
+        self.fc2    = nn.Linear(256, num_classes) if num_classes else None
             
     def _make_layer(self, block, num_blocks, in_channels, out_channels):
         layers = []
@@ -97,7 +119,7 @@ class network_29layers(nn.Module):
             layers.append(block(in_channels, out_channels))
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def embedding(self, x):
         x = self.conv1(x)
         x = self.pool1(x)
 
@@ -115,14 +137,17 @@ class network_29layers(nn.Module):
         x = self.group4(x)
         x = self.pool4(x)
 
-        x = x.view(x.size(0), -1)
-        fc = self.fc(x)
+        x = torch.flatten(x, 1)
+        return self.fc(x)
+
+    def forward(self, x):
+        fc = self.embedding(x)
         fc = F.dropout(fc, training=self.training)
-        out = self.fc2(fc)
+        out = self.fc2(fc) if self.fc2 is not None else None
         return out, fc
 
 
-class network_29layers_v2(nn.Module):
+class network_29layers_v2(embedding_network, nn.Module):
     def __init__(self, block, layers, num_classes=79077):
         super(network_29layers_v2, self).__init__()
         self.conv1    = mfm(1, 48, 5, 1, 2)
@@ -135,7 +160,7 @@ class network_29layers_v2(nn.Module):
         self.block4   = self._make_layer(block, layers[3], 128, 128)
         self.group4   = group(128, 128, 3, 1, 1)
         self.fc       = nn.Linear(8*8*128, 256)
-        self.fc2 = nn.Linear(256, num_classes, bias=False)
+        self.fc2 = nn.Linear(256, num_classes, bias=False) if num_classes else None
             
     def _make_layer(self, block, num_blocks, in_channels, out_channels):
         layers = []
@@ -143,7 +168,7 @@ class network_29layers_v2(nn.Module):
             layers.append(block(in_channels, out_channels))
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def embedding(self, x):
         x = self.conv1(x)
         x = F.max_pool2d(x, 2) + F.avg_pool2d(x, 2)
 
@@ -161,10 +186,13 @@ class network_29layers_v2(nn.Module):
         x = self.group4(x)
         x = F.max_pool2d(x, 2) + F.avg_pool2d(x, 2)
 
-        x = x.view(x.size(0), -1)
-        fc = self.fc(x)
+        x = torch.flatten(x, 1)
+        return self.fc(x)
+
+    def forward(self, x):
+        fc = self.embedding(x)
         x = F.dropout(fc, training=self.training)
-        out = self.fc2(x)
+        out = self.fc2(x) if self.fc2 is not None else None
         return out, fc
 
 def LightCNN_9Layers(**kwargs):
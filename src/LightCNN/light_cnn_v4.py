@@ -11,6 +11,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
+try:
+    from .light_cnn import embedding_network
+except ImportError:
+    # Imported as a top-level module, next to light_cnn (train.py, extract_features.py)
+    from light_cnn import embedding_network
 
 
 class mfm(nn.Module):
@@ -41,7 +46,7 @@ class resblock_v1(nn.Module):
         return out
 
 
-class network(nn.Module):
+class network(embedding_network, nn.Module):
     def __init__(self, block, layers):
         super(network, self).__init__()
 
@@ -65,7 +70,7 @@ class network(nn.Module):
             layers.append(block(in_channels, out_channels))
         return nn.Sequential(*layers)
 
-    def forward(self, x, label=None):
+    def embedding(self, x):
         x = self.conv1(x)
         x = F.max_pool2d(x, 2) + F.avg_pool2d(x, 2)
 
@@ -88,6 +93,10 @@ class network(nn.Module):
 
         return fc
 
+    def forward(self, x, label=None):
+        # This network has no classifier head: the output is the fc embedding
+        return self.embedding(x)
+
 def LightCNN_V4(cfg):
     model = network(resblock_v1, [1, 2, 3, 4])
     return model
\ No newline at end of file
@@ -0,0 +1,211 @@
+import os
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Seconds between attempts to take a slot shared with other processes
+SHARED_SLOT_POLL_INTERVAL = 0.25
+
+class AdmissionRejected(Exception):
+    """
+    A request that can't be admitted; answer with status_code and a Retry-After header
+
+    429 means the class's queue is full, 503 that the request waited queue_timeout
+    seconds without getting a slot.
+    """
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class ProcessSlots:
+    """
+    Slots shared by all worker processes of a server, held as exclusive file locks
+
+    Slot i is the lock file {directory}/{name}.{i}.lock; a process holds the slot while
+    it has the file locked, and the kernel releases the lock if the process dies.
+    Without fcntl (Windows) every slot is always free, leaving the per-process limit.
+    """
+
+    def __init__(self, directory, name, slots):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"{name}.{i}.lock") for i in range(slots)]
+
+    def try_acquire(self):
+        """Lock a free slot without waiting; returns its handle, or None if all are taken"""
+        if fcntl is None:
+            return -1
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def release(self, handle):
+        if handle >= 0:
+            # Closing the descriptor drops its lock
+            os.close(handle)
+
+class WorkClass:
+    """
+    Limits of one class of work
+
+    Args:
+        name: Class name, e.g. "interactive" or "bulk"
+        limit: Requests of this class running at the same time
+        queue_size: Requests allowed to wait for a slot (0 rejects as soon as the class is busy)
+        queue_timeout: Seconds a request may wait before it is rejected
+        retry_after: Seconds suggested to rejected clients
+        priority: Lower runs first when classes compete for the shared capacity
+        shared: Optional ProcessSlots limiting the class across all worker processes
+    """
+
+    def __init__(self, name, limit, queue_size, queue_timeout, retry_after, priority, shared=None):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.priority = priority
+        self.shared = shared
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+class AdmissionController:
+    """
+    Admission control with one queue and concurrency limit per class of work
+
+    Each class runs at most its own limit of requests; all classes together run at
+    most total_limit. Freed slots go to the waiting requests of the highest priority
+    class first, and a lower priority class doesn't take a shared slot while a higher
+    priority one is waiting for it. Requests over capacity are rejected quickly
+    instead of piling up until the client times out.
+
+    Meant to be used from a single event loop (one per worker process). A class with
+    shared slots also needs one of those before it runs, so its limit holds across
+    all workers; requests hold their process-local slot while they wait for it.
+    """
+
+    def __init__(self, classes, total_limit=None):
+        self.classes = {work_class.name: work_class for work_class in classes}
+        self._by_priority = sorted(classes, key=lambda work_class: work_class.priority)
+        self.total_limit = total_limit
+        self.active = 0
+
+    def _can_start(self, work_class):
+        if work_class.active >= work_class.limit:
+            return False
+        if self.total_limit is None:
+            return True
+        if self.active >= self.total_limit:
+            return False
+        # Leave the last shared slots to higher priority classes that are waiting
+        waiting_ahead = sum(1 for other in self._by_priority
+                            if other.priority < work_class.priority and other.waiters and other.active < other.limit)
+        return self.active + waiting_ahead < self.total_limit
+
+    def _start(self, work_class):
+        work_class.active += 1
+        work_class.admitted += 1
+        self.active += 1
+
+    def _release(self, work_class):
+        work_class.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for work_class in self._by_priority:
+            while work_class.waiters and self._can_start(work_class):
+                waiter = work_class.waiters.popleft()
+                if waiter.done():
+                    continue
+                self._start(work_class)
+                waiter.set_result(True)
+
+    @asynccontextmanager
+    async def admit(self, name):
+        """
+        Hold a slot of a class for the duration of the block
+
+        Raises:
+            AdmissionRejected: If the class's queue is full or the wait times out
+        """
+        work_class = self.classes[name]
+        if not work_class.waiters and self._can_start(work_class):
+            self._start(work_class)
+        else:
+            if len(work_class.waiters) >= work_class.queue_size:
+                work_class.rejected += 1
+                raise AdmissionRejected(429, f"Too many {name} requests, try again later", work_class.retry_after)
+            waiter = asyncio.get_running_loop().create_future()
+            work_class.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), work_class.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # Granted just as the wait ended: hand the slot on
+                    self._release(work_class)
+                else:
+                    waiter.cancel()
+                    if waiter in work_class.waiters:
+                        work_class.waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                work_class.timed_out += 1
+                raise AdmissionRejected(503, f"Server busy with {name} work, try again later", work_class.retry_after)
+        handle = None
+        try:
+            if work_class.shared is not None:
+                handle = await self._acquire_shared(work_class)
+            yield
+        finally:
+            if handle is not None:
+                work_class.shared.release(handle)
+            self._release(work_class)
+
+    async def _acquire_shared(self, work_class):
+        """Wait up to the class's queue_timeout for a slot shared with the other worker processes"""
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + work_class.queue_timeout
+        while True:
+            handle = work_class.shared.try_acquire()
+            if handle is not None:
+                return handle
+            if loop.time() >= give_up:
+                work_class.timed_out += 1
+                raise AdmissionRejected(503, f"Server busy with {work_class.name} work in other workers, try again later",
+                                        work_class.retry_after)
+            await asyncio.sleep(SHARED_SLOT_POLL_INTERVAL)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "total_limit": self.total_limit,
+            "classes": {
+                work_class.name: {
+                    "active": work_class.active,
+                    "limit": work_class.limit,
+                    "queued": len(work_class.waiters),
+                    "queue_size": work_class.queue_size,
+                    "shared_slots": len(work_class.shared.paths) if work_class.shared is not None else None,
+                    "admitted": work_class.admitted,
+                    "rejected": work_class.rejected,
+                    "timed_out": work_class.timed_out
+                }
+                for work_class in self._by_priority
+            }
+        }
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+
+import cv2
+
+import database
+from face_tracker import VideoRecognizer
+from gallery_manager import DetectionROI, gallery_cache
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class FrameSource:
+    """
+    Frames from a camera index, stream URL, video file or directory of images
+
+    A directory of images (read in name order) or a video file can stand in for a
+    classroom camera; with realtime=True a video file is paced at its frame rate.
+    """
+
+    def __init__(self, source, realtime=False):
+        self.source = str(source)
+        self.realtime = realtime
+        self._images = None
+        self._capture = None
+        self.index = 0
+        self._start = None
+
+        if os.path.isdir(self.source):
+            self._images = sorted(os.path.join(self.source, f) for f in os.listdir(self.source)
+                                  if f.lower().endswith(IMAGE_EXTENSIONS))
+            self.fps = None
+        else:
+            self._capture = cv2.VideoCapture(int(self.source) if self.source.isdigit() else self.source)
+            if not self._capture.isOpened():
+                raise ValueError(f"Could not open camera source: {source}")
+            self.fps = self._capture.get(cv2.CAP_PROP_FPS) or None
+            self.realtime = realtime and os.path.isfile(self.source)
+
+    def read(self):
+        """Next frame, or None when the source is exhausted"""
+        if self._images is not None:
+            while self.index < len(self._images):
+                frame = cv2.imread(self._images[self.index])
+                self.index += 1
+                if frame is not None:
+                    return frame
+            return None
+
+        ok, frame = self._capture.read()
+        if not ok:
+            return None
+        self.index += 1
+        if self.realtime and self.fps:
+            self._start = self._start or time.time()
+            delay = self._start + self.index / self.fps - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return frame
+
+    def close(self):
+        if self._capture is not None:
+            self._capture.release()
+
+def motion_score(previous, current):
+    """Mean absolute difference (0-255) between two downscaled grayscale frames"""
+    if previous is None or previous.shape != current.shape:
+        return float("inf")
+    return float(cv2.absdiff(previous, current).mean())
+
+def _motion_frame(frame, width=160):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height = max(1, int(gray.shape[0] * width / gray.shape[1]))
+    return cv2.GaussianBlur(cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA), (5, 5), 0)
+
+class AttendanceSession(threading.Thread):
+    """
+    Long-running attendance for one camera against one department/year gallery
+
+    Every identity in the gallery starts absent. A frame is only run through detection
+    when it differs enough from the last analysed frame (motion_threshold, mean absolute
+    difference of a small grayscale copy), or at least every max_idle_frames frames.
+    Faces are tracked and an identity is confirmed present once confirm_votes
+    embeddings matched it; tracks of confirmed identities are then not re-embedded.
+    Detection is restricted to the region of interest stored for the source, if any.
+    The table is written to SQLite every snapshot_interval seconds and when stopped.
+
+    The embedding model is shared with the worker's other requests, so frames are run
+    through it holding `lock` (the worker's recognition lock) when one is given, or on
+    the inference processes when an inference client is given. Once the
+    session ends it is dropped from this process, with its detector and gallery, and its
+    final table is served from the database.
+    """
+
+    def __init__(self, session_id, year, department, gallery_path, source, model, device, yolo_model,
+                 threshold=0.45, motion_threshold=2.0, max_idle_frames=50, confirm_votes=3,
+                 snapshot_interval=30.0, realtime=True, nprobe=None, lock=None, inference=None):
+        super().__init__(name=f"attendance-{session_id}", daemon=True)
+        self.session_id = session_id
+        self.year = year
+        self.department = department
+        self.gallery_path = gallery_path
+        self.source = source
+        self.threshold = threshold
+        self.motion_threshold = motion_threshold
+        self.max_idle_frames = max_idle_frames
+        self.confirm_votes = confirm_votes
+        self.snapshot_interval = snapshot_interval
+        self.realtime = realtime
+        self.model_lock = lock or nullcontext()
+
+        gallery = gallery_cache.get(gallery_path)
+        if gallery is None:
+            raise ValueError(f"Gallery not found: {gallery_path}")
+        self._gallery_version = gallery_cache.version(gallery_path)
+        self._roi_polygons = database.get_camera_roi(str(source))
+        self.recognizer = VideoRecognizer(model, device, yolo_model, gallery, threshold=threshold, nprobe=nprobe,
+                                          roi=DetectionROI(self._roi_polygons) if self._roi_polygons else None,
+                                          inference=inference)
+
+        self.records = {identity: self._new_record(identity) for identity in gallery.identities}
+        self.status = "starting"
+        self.error = None
+        self.frames = 0
+        self.analysed_frames = 0
+        self.motion_skipped = 0
+        self.started_at = datetime.now()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_record(identity):
+        return {"identity": identity, "present": False, "confidence": 0.0, "sightings": 0,
+                "votes": 0, "first_seen": None, "last_seen": None}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        source = None
+        try:
+            source = FrameSource(self.source, self.realtime)
+            self.status = "running"
+            previous = None
+            idle = 0
+            last_snapshot = time.time()
+
+            while not self._stop_event.is_set():
+                frame = source.read()
+                if frame is None:
+                    self.status = "finished"
+                    break
+                self.frames += 1
+
+                # Motion gating: a static classroom needs no new detections
+                current = _motion_frame(frame)
+                if motion_score(previous, current) < self.motion_threshold and idle < self.max_idle_frames:
+                    self.motion_skipped += 1
+                    idle += 1
+                else:
+                    previous = current
+                    idle = 0
+                    self.analysed_frames += 1
+                    self._process(frame, source)
+
+                if time.time() - last_snapshot >= self.snapshot_interval:
+                    self._refresh_gallery()
+                    self._refresh_roi()
+                    self.snapshot()
+                    last_snapshot = time.time()
+            else:
+                self.status = "stopped"
+        except Exception as e:
+            print(f"Attendance session {self.session_id} failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            if source is not None:
+                source.close()
+            self.snapshot()
+            _forget(self.session_id)
+
+    def _process(self, frame, source):
+        with self.model_lock:
+            faces = self.recognizer.process_frame(frame, source.index)
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            for face in faces:
+                record = self.records.get(face["identity"])
+                if record is None or face["similarity"] < self.threshold:
+                    continue
+                record["sightings"] += 1
+                record["first_seen"] = record["first_seen"] or now
+                record["last_seen"] = now
+                record["confidence"] = max(record["confidence"], face["similarity"])
+                if face["embedded"]:
+                    record["votes"] += 1
+                    if record["votes"] >= self.confirm_votes and not record["present"]:
+                        record["present"] = True
+                        self.recognizer.settled_identities.add(face["identity"])
+                        print(f"Attendance {self.session_id}: {face['identity']} present")
+
+    def _refresh_gallery(self):
+        """Pick up identities added to or removed from the gallery"""
+        version = gallery_cache.version(self.gallery_path)
+        if version == self._gallery_version:
+            return
+        gallery = gallery_cache.get(self.gallery_path)
+        if gallery is None:
+            return
+        self._gallery_version = version
+        self.recognizer.gallery = gallery
+        with self._lock:
+            for identity in gallery.identities:
+                self.records.setdefault(identity, self._new_record(identity))
+
+    def _refresh_roi(self):
+        """Pick up a region of interest changed while the session runs"""
+        try:
+            polygons = database.get_camera_roi(str(self.source))
+        except Exception as e:
+            print(f"Error reading region of interest for {self.source}: {e}")
+            return
+        if polygons != self._roi_polygons:
+            self._roi_polygons = polygons
+            self.recognizer.roi = DetectionROI(polygons) if polygons else None
+
+    def stats(self):
+        tracker_stats = self.recognizer.tracker.stats()
+        elapsed = (datetime.now() - self.started_at).total_seconds()
+        return {
+            "frames": self.frames,
+            "analysed_frames": self.analysed_frames,
+            "motion_skipped": self.motion_skipped,
+            "faces_seen": tracker_stats["faces_seen"],
+            "embeddings": tracker_stats["embeddings"],
+            "fps": round(self.frames / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+    def table(self):
+        with self._lock:
+            return sorted((dict(record) for record in self.records.values()), key=lambda r: r["identity"])
+
+    def snapshot(self):
+        """Write the attendance table to the database"""
+        try:
+            database.save_attendance_snapshot(self.session_id, self.table(), self.status, json.dumps(self.stats()))
+        except Exception as e:
+            print(f"Error saving attendance snapshot for {self.session_id}: {e}")
+
+    def summary(self):
+        table = self.table()
+        present = [r["identity"] for r in table if r["present"]]
+        return {
+            "session_id": self.session_id,
+            "year": self.year,
+            "department": self.department,
+            "source": self.source,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "stats": self.stats(),
+            "present_count": len(present),
+            "absent_count": len(table) - len(present),
+            "present": present,
+            "absent": [r["identity"] for r in table if not r["present"]],
+            "records": table
+        }
+
+# Sessions running in this process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def start_session(year, department, gallery_path, source, model, device, yolo_model, **options):
+    """
+    Start an attendance session in a background thread
+
+    Returns:
+        The running AttendanceSession
+    """
+    session_id = uuid.uuid4().hex[:12]
+    session = AttendanceSession(session_id, year, department, gallery_path, source,
+                                model, device, yolo_model, **options)
+    database.create_attendance_session(session_id, year, department, str(source))
+    with _sessions_lock:
+        _sessions[session_id] = session
+    session.start()
+    return session
+
+def _forget(session_id):
+    """Drop an ended session; its records stay in the database"""
+    with _sessions_lock:
+        _sessions.pop(session_id, None)
+
+def get_session(session_id):
+    """Session running in this process, or None"""
+    return _sessions.get(session_id)
+
+def stop_session(session_id, timeout=10.0):
+    """Stop a session and wait for its final snapshot"""
+    session = _sessions.get(session_id)
+    if session is None:
+        return None
+    session.stop()
+    session.join(timeout)
+    return session
+
+def list_sessions():
+    with _sessions_lock:
+        return list(_sessions.values())
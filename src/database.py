@@ -1,4 +1,5 @@
 import os
+import json
 import sqlite3
 from contextlib import contextmanager
 from typing import List, Optional, Dict, Any
@@ -56,6 +57,61 @@ def init_db():
         )
         ''')
         
+        # Create attendance_sessions table for camera attendance sessions
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT UNIQUE NOT NULL,
+            year TEXT NOT NULL,
+            department TEXT NOT NULL,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            stats TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            stopped_at TIMESTAMP
+        )
+        ''')
+        
+        # Create attendance_records table with the latest snapshot of each session's table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_records (
+            session_id TEXT NOT NULL,
+            identity TEXT NOT NULL,
+            present INTEGER DEFAULT 0,
+            confidence REAL DEFAULT 0,
+            sightings INTEGER DEFAULT 0,
+            first_seen TIMESTAMP,
+            last_seen TIMESTAMP,
+            PRIMARY KEY (session_id, identity),
+            FOREIGN KEY (session_id) REFERENCES attendance_sessions (session_id)
+        )
+        ''')
+        
+        # Create camera_rois table with the detection region of interest of each camera source
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS camera_rois (
+            source TEXT PRIMARY KEY,
+            polygons TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Create gallery_build_jobs table with the progress of background gallery rebuilds
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gallery_build_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT UNIQUE NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            galleries TEXT,
+            summary TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''')
+        
         # Insert default data if tables are empty
         cursor.execute("SELECT COUNT(*) FROM batch_years")
         if cursor.fetchone()[0] == 0:
@@ -274,5 +330,143 @@ def get_database_stats() -> Dict[str, Any]:
             "database_path": DB_PATH
         }
 
+def create_attendance_session(session_id: str, year: str, department: str, source: str) -> bool:
+    """Register a new attendance session."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            INSERT INTO attendance_sessions (session_id, year, department, source)
+            VALUES (?, ?, ?, ?)
+            ''', (session_id, year, department, source))
+            conn.commit()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+def save_attendance_snapshot(session_id: str, records: List[Dict[str, Any]], status: str = "running",
+                             stats: Optional[str] = None) -> bool:
+    """Replace the stored attendance table of a session with its current state."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT OR REPLACE INTO attendance_records
+            (session_id, identity, present, confidence, sightings, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(session_id, r["identity"], int(r["present"]), r["confidence"], r["sightings"],
+               r["first_seen"], r["last_seen"]) for r in records])
+        cursor.execute('''
+        UPDATE attendance_sessions
+        SET status = ?, stats = ?, updated_at = CURRENT_TIMESTAMP,
+            stopped_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE session_id = ?
+        ''', (status, stats, status, session_id))
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_attendance_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Get an attendance session with its latest stored attendance table."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM attendance_sessions WHERE session_id = ?", (session_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        session = dict(row)
+        cursor.execute('''
+        SELECT identity, present, confidence, sightings, first_seen, last_seen
+        FROM attendance_records WHERE session_id = ? ORDER BY identity
+        ''', (session_id,))
+        session["records"] = [dict(r) for r in cursor.fetchall()]
+        return session
+
+def list_attendance_sessions() -> List[Dict[str, Any]]:
+    """List all attendance sessions, newest first, with their present counts."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT s.*, COALESCE(SUM(r.present), 0) as present_count, COUNT(r.identity) as roster_count
+        FROM attendance_sessions s
+        LEFT JOIN attendance_records r ON r.session_id = s.session_id
+        GROUP BY s.id
+        ORDER BY s.started_at DESC, s.id DESC
+        ''')
+        return [dict(row) for row in cursor.fetchall()]
+
+def create_build_job(job_id: str, total: int) -> bool:
+    """Register a new background rebuild of the given number of galleries."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            INSERT INTO gallery_build_jobs (job_id, total, galleries) VALUES (?, ?, '[]')
+            ''', (job_id, total))
+            conn.commit()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+def update_build_job(job_id: str, galleries: List[Dict[str, Any]], status: str = "running",
+                     summary: Optional[Dict[str, Any]] = None) -> bool:
+    """Store the per-gallery results of a rebuild so far, and its summary once it ended."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE gallery_build_jobs
+        SET status = ?, galleries = ?, summary = ?, updated_at = CURRENT_TIMESTAMP,
+            finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE job_id = ?
+        ''', (status, json.dumps(galleries), json.dumps(summary) if summary is not None else None,
+              status, job_id))
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_build_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Get a background rebuild with its per-gallery results so far."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM gallery_build_jobs WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job["galleries"] = json.loads(job["galleries"]) if job["galleries"] else []
+        job["summary"] = json.loads(job["summary"]) if job["summary"] else None
+        return job
+
+def set_camera_roi(source: str, polygons: List[List[List[int]]]) -> bool:
+    """Store the region of interest polygons of a camera source, replacing any previous ones."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT OR REPLACE INTO camera_rois (source, polygons, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (source, json.dumps(polygons)))
+        conn.commit()
+        return True
+
+def get_camera_roi(source: str) -> Optional[List[List[List[int]]]]:
+    """Get the region of interest polygons of a camera source, or None if it has none."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT polygons FROM camera_rois WHERE source = ?", (source,))
+        row = cursor.fetchone()
+        return json.loads(row["polygons"]) if row else None
+
+def list_camera_rois() -> List[Dict[str, Any]]:
+    """List the regions of interest of all camera sources."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM camera_rois ORDER BY source")
+        return [{**dict(row), "polygons": json.loads(row["polygons"])} for row in cursor.fetchall()]
+
+def delete_camera_roi(source: str) -> bool:
+    """Remove the region of interest of a camera source."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM camera_rois WHERE source = ?", (source,))
+        conn.commit()
+        return cursor.rowcount > 0
+
 # Initialize the database when the module is imported
 init_db()
\ No newline at end of file
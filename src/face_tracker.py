@@ -0,0 +1,475 @@
+import os
+import time
+import itertools
+from collections import Counter, deque
+
+import cv2
+import numpy as np
+
+from gallery_manager import detect_faces, detect_faces_batch, embed_face_images, match_embeddings
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise intersection-over-union of two sets of (x1, y1, x2, y2) boxes
+
+    Returns:
+        (len(boxes_a), len(boxes_b)) array
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+def face_signature(face, size=16):
+    """Tiny normalised grayscale thumbnail of a face crop, used to notice appearance changes"""
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    thumb = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return (thumb - thumb.mean()) / (thumb.std() + 1e-6)
+
+def _box_to_state(box):
+    x1, y1, x2, y2 = box
+    return np.array([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1], dtype=np.float32)
+
+def _state_to_box(state):
+    cx, cy, w, h = state
+    return (cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2)
+
+class Track:
+    """
+    One face followed across frames
+
+    The box is predicted with a constant-velocity alpha-beta filter over its centre and
+    size, which is what the IoU association is done against. The identity comes from
+    a vote over the last few embeddings of the track.
+    """
+
+    def __init__(self, track_id, box, frame_index, vote_window=5):
+        self.track_id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.hits = 1
+        self.missed = 0
+        self.embeddings = 0
+        self.needs_embedding = True
+
+        self._state = _box_to_state(box)
+        self._velocity = np.zeros(4, dtype=np.float32)
+        self._embedded_box = None
+        self._embedded_frame = None
+        self._embedded_signature = None
+        self._votes = deque(maxlen=vote_window)
+        self._best = Counter()
+
+    def predict(self, frame_index=None):
+        """Box expected at frame_index (default: the frame after the last detection)"""
+        frames = 1 if frame_index is None else max(1, frame_index - self.last_frame)
+        return _state_to_box(self._state + self._velocity * frames)
+
+    def update(self, box, frame_index, alpha=0.6, beta=0.2):
+        """Associate a detection with the track"""
+        frames = max(1, frame_index - self.last_frame)
+        predicted = self._state + self._velocity * frames
+        residual = _box_to_state(box) - predicted
+        self._state = predicted + alpha * residual
+        self._velocity = self._velocity + beta * residual / frames
+        self.box = tuple(int(v) for v in box)
+        self.last_frame = frame_index
+        self.hits += 1
+        self.missed = 0
+
+    def mark_missed(self):
+        self.missed += 1
+
+    def observe(self, matches, frame_index, signature=None):
+        """
+        Record the gallery matches of a fresh embedding of this track
+
+        Args:
+            matches: (identity, similarity) tuples for the embedding, best first
+            frame_index: Frame the embedding was taken from
+            signature: face_signature() of the embedded crop
+        """
+        self.mark_embedded(frame_index, signature)
+        self.vote(matches)
+
+    def mark_embedded(self, frame_index, signature=None):
+        """Remember the box, frame and appearance the track's current crop is embedded at"""
+        self._embedded_box = self.box
+        self._embedded_frame = frame_index
+        self._embedded_signature = signature
+        self.needs_embedding = False
+
+    def vote(self, matches):
+        """Add the gallery matches of an embedding marked with mark_embedded() to the vote window"""
+        self._votes.append(list(matches))
+        for identity, score in matches[:1]:
+            self._best[identity] = max(self._best[identity], float(score))
+        self.embeddings += 1
+
+    def candidates(self):
+        """
+        Identities voted for by the recent embeddings, most supported first
+
+        Every embedding in the vote window votes for each of its matches with its
+        similarity; an identity's confidence is its summed similarity divided by the
+        number of votes cast, so identities missing from some frames lose confidence.
+
+        Returns:
+            List of (identity, confidence) tuples
+        """
+        if not self._votes:
+            return []
+        totals = Counter()
+        for matches in self._votes:
+            for identity, score in matches:
+                totals[identity] += float(score)
+        return [(identity, total / len(self._votes)) for identity, total in totals.most_common()]
+
+    @property
+    def identity(self):
+        candidates = self.candidates()
+        return candidates[0][0] if candidates else None
+
+    def summary(self, fps=None):
+        """Track summary: identity, confidence and first/last frame (and time when fps is known)"""
+        candidates = self.candidates()
+        identity, confidence = candidates[0] if candidates else ("Unknown", 0.0)
+        summary = {
+            "track_id": self.track_id,
+            "identity": identity,
+            "confidence": float(confidence),
+            "best_similarity": float(self._best.get(identity, 0.0)),
+            "first_frame": self.first_frame,
+            "last_frame": self.last_frame,
+            "detections": self.hits,
+            "embeddings": self.embeddings
+        }
+        if fps:
+            summary["first_seen"] = round(self.first_frame / fps, 3)
+            summary["last_seen"] = round(self.last_frame / fps, 3)
+        return summary
+
+class FaceTracker:
+    """
+    IoU tracker that decides which faces actually need a new embedding
+
+    A detected face is associated with the track whose predicted box overlaps it most.
+    A track is only re-embedded every reembed_every frames, or earlier when its box has
+    moved or resized so that it overlaps its box at the last embedding by less than
+    reembed_iou, or when its appearance (a small thumbnail) changed by more than
+    appearance_change. Between embeddings the track keeps its voted identity. Tracks
+    that go undetected for more than max_missed processed frames are retired.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=10, reembed_every=15, reembed_iou=0.6,
+                 appearance_change=0.6, vote_window=5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.reembed_every = reembed_every
+        self.reembed_iou = reembed_iou
+        self.appearance_change = appearance_change
+        self.vote_window = vote_window
+        self.tracks = []
+        self.finished = []
+        self.faces_seen = 0
+        self._ids = itertools.count(1)
+
+    def update(self, boxes, frame_index, signatures=None):
+        """
+        Associate a frame's detections with tracks
+
+        Args:
+            boxes: (x1, y1, x2, y2) face boxes of the frame
+            frame_index: Index of the frame (may skip frames)
+            signatures: Optional face_signature() per box
+
+        Returns:
+            List of Track objects, one per box; needs_embedding tells which to embed
+        """
+        self.faces_seen += len(boxes)
+        assigned = [None] * len(boxes)
+        unmatched_tracks = set(range(len(self.tracks)))
+
+        if self.tracks and boxes:
+            iou = box_iou(boxes, [track.predict(frame_index) for track in self.tracks])
+            for flat in np.argsort(-iou, axis=None):
+                b, t = np.unravel_index(flat, iou.shape)
+                if iou[b, t] < self.iou_threshold:
+                    break
+                if assigned[b] is None and t in unmatched_tracks:
+                    assigned[b] = self.tracks[t]
+                    unmatched_tracks.discard(t)
+
+        for t in unmatched_tracks:
+            self.tracks[t].mark_missed()
+
+        for b, box in enumerate(boxes):
+            signature = signatures[b] if signatures is not None else None
+            track = assigned[b]
+            if track is None:
+                track = Track(next(self._ids), box, frame_index, self.vote_window)
+                self.tracks.append(track)
+                assigned[b] = track
+            else:
+                track.update(box, frame_index)
+                track.needs_embedding = self._needs_embedding(track, frame_index, signature)
+
+        # Retire tracks that haven't been seen for a while
+        alive = []
+        for track in self.tracks:
+            (alive if track.missed <= self.max_missed else self.finished).append(track)
+        self.tracks = alive
+        return assigned
+
+    def _needs_embedding(self, track, frame_index, signature):
+        if track._embedded_frame is None:
+            return True
+        if frame_index - track._embedded_frame >= self.reembed_every:
+            return True
+        if box_iou([track.box], [track._embedded_box])[0, 0] < self.reembed_iou:
+            return True
+        if signature is not None and track._embedded_signature is not None:
+            if float(np.mean(np.abs(signature - track._embedded_signature))) > self.appearance_change:
+                return True
+        return False
+
+    def all_tracks(self):
+        """Finished and live tracks, in order of appearance"""
+        return sorted(self.finished + self.tracks, key=lambda track: track.track_id)
+
+    def stats(self):
+        embedded = sum(track.embeddings for track in self.all_tracks())
+        return {
+            "faces_seen": self.faces_seen,
+            "embeddings": embedded,
+            "embeddings_skipped": self.faces_seen - embedded,
+            "tracks": len(self.finished) + len(self.tracks)
+        }
+
+class VideoRecognizer:
+    """
+    Recognize faces in consecutive frames of one video or camera feed
+
+    Detects faces in every processed frame, but only embeds the faces whose track asks
+    for it (see FaceTracker), in one batch per frame or per batch of frames (see
+    process_detections). Identities are assigned without
+    duplicates within a frame, most confident track first, like recognize_faces in the API.
+    With an inference client (see inference_server.InferenceClient) detection and
+    embedding run on the inference processes, and model, device and yolo_model may be None.
+    """
+
+    def __init__(self, model, device, yolo_model, gallery, threshold=0.45, conf=0.65,
+                 top_k=5, nprobe=None, roi=None, inference=None, **tracker_options):
+        self.model = model
+        self.device = device
+        self.yolo_model = yolo_model
+        self.inference = inference
+        self.gallery = gallery
+        self.threshold = threshold
+        self.conf = conf
+        self.top_k = top_k
+        self.nprobe = nprobe
+        self.roi = roi
+        self.tracker = FaceTracker(**tracker_options)
+        self.frame_index = -1
+        
+        # Tracks already voted to one of these identities are not re-embedded
+        self.settled_identities = set()
+
+    def process_frame(self, frame, frame_index=None, detections=None):
+        """
+        Track and recognize the faces in a frame
+
+        Args:
+            frame: BGR frame
+            frame_index: Index of the frame in the video (default: previous index + 1)
+            detections: Precomputed detect_faces() output for the frame (optional)
+
+        Returns:
+            List of dicts with track_id, bbox, identity, similarity and whether the
+            face was embedded in this frame
+        """
+        frame_index = self.frame_index + 1 if frame_index is None else frame_index
+        if detections is None:
+            detections = self.detect_faces(frame)
+        return self.process_detections([frame_index], [detections])[0]
+
+    def process_detections(self, frame_indices, detections):
+        """
+        Track and recognize the faces of consecutive frames, embedding them in one batch
+
+        The frames are tracked in order and the faces whose track asks for an embedding
+        in any of them are embedded and matched together; then each frame's identities
+        are assigned from the votes up to that frame, as process_frame() would. A track
+        embedded in one frame isn't embedded again in the following frames of the batch.
+        A track voted to a settled identity only stops being embedded after the batch.
+
+        Args:
+            frame_indices: Index of each frame in the video
+            detections: detect_faces() output of each frame
+
+        Returns:
+            One process_frame() result per frame
+        """
+        staged = []
+        for frame_index, frame_detections in zip(frame_indices, detections):
+            self.frame_index = frame_index
+            boxes = [box for box, _ in frame_detections]
+            signatures = [face_signature(face) for _, face in frame_detections]
+            tracks = self.tracker.update(boxes, frame_index, signatures)
+
+            pending = []
+            if len(self.gallery):
+                pending = [i for i, track in enumerate(tracks)
+                           if track.needs_embedding and (track.embeddings == 0 or track.identity not in self.settled_identities)]
+            for i in pending:
+                tracks[i].mark_embedded(frame_index, signatures[i])
+            staged.append((boxes, tracks, pending, [frame_detections[i][1] for i in pending]))
+
+        faces = [face for _, _, _, crops in staged for face in crops]
+        matches = []
+        if faces:
+            matches = match_embeddings(self.gallery, self.embed_faces(faces), self.threshold,
+                                       top_k=self.top_k, nprobe=self.nprobe)
+
+        results = []
+        offset = 0
+        for boxes, tracks, pending, _ in staged:
+            for i, face_matches in zip(pending, matches[offset:offset + len(pending)]):
+                tracks[i].vote(face_matches)
+            offset += len(pending)
+            results.append(self._assign_identities(boxes, tracks, pending))
+        return results
+
+    def _assign_identities(self, boxes, tracks, embedded):
+        """Assign identities without duplicates - most confident track first"""
+        candidates = [track.candidates() for track in tracks]
+        order = sorted(range(len(tracks)), key=lambda i: candidates[i][0][1] if candidates[i] else 0.0, reverse=True)
+        taken = set()
+        results = [None] * len(tracks)
+        for i in order:
+            identity, similarity = "Unknown", 0.0
+            for candidate, confidence in candidates[i]:
+                if candidate not in taken:
+                    identity, similarity = candidate, confidence
+                    taken.add(candidate)
+                    break
+            results[i] = {
+                "track_id": tracks[i].track_id,
+                "bbox": [int(v) for v in boxes[i]],
+                "identity": identity,
+                "similarity": float(similarity),
+                "embedded": i in embedded
+            }
+        return results
+
+    def detect_faces(self, frame):
+        """detect_faces() with this recognizer's detector, confidence and region of interest"""
+        if self.inference is not None:
+            return self.inference.detect_faces(frame, conf=self.conf, roi=self.roi)
+        return detect_faces(self.yolo_model, frame, conf=self.conf, roi=self.roi)
+
+    def detect_faces_batch(self, frames):
+        """detect_faces() for several frames, in one detector call when the detector is local"""
+        if self.inference is not None:
+            return [self.inference.detect_faces(frame, conf=self.conf, roi=self.roi) for frame in frames]
+        return detect_faces_batch(self.yolo_model, frames, conf=self.conf, roi=self.roi)
+
+    def embed_faces(self, faces):
+        """Embeddings of face crops with this recognizer's model"""
+        if self.inference is not None:
+            return self.inference.embed_face_images(faces)
+        return embed_face_images(self.model, self.device, faces)
+
+    def summaries(self, fps=None, min_detections=1):
+        """One summary per track seen so far (see Track.summary)"""
+        return [track.summary(fps) for track in self.tracker.all_tracks() if track.hits >= min_detections]
+
+def recognize_video(model, device, yolo_model, gallery, video_path, threshold=0.45, sample_fps=5.0,
+                    batch_size=16, min_detections=2, nprobe=None, progress=False, inference=None):
+    """
+    Recognize and track the faces in a recorded video
+
+    Only sample_fps frames per second are decoded (the others are skipped with grab(),
+    which doesn't decode them), detection and embedding run on batches of batch_size
+    sampled frames, and tracked faces are only re-embedded when their track asks for it.
+
+    Args:
+        model: Loaded LightCNN model
+        device: Device of the model
+        yolo_model: YOLO face detector (not shared with other threads while this runs)
+        gallery: Gallery to recognize against
+        video_path: Path of the video file
+        threshold: Similarity threshold
+        sample_fps: Frames per second to analyse (default 5, all frames if <= 0)
+        batch_size: Sampled frames per detection batch
+        min_detections: Tracks with fewer detections are left out of the summary
+        nprobe: ANN probes for very large galleries
+        progress: Print progress while processing
+        inference: Inference client to detect and embed with instead of model/yolo_model
+
+    Returns:
+        Dictionary with the video properties, processing time and one summary per track
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    step = max(1, int(round(fps / sample_fps))) if sample_fps and sample_fps > 0 else 1
+
+    # Re-embed a tracked face about every 3 seconds of video at most
+    recognizer = VideoRecognizer(model, device, yolo_model, gallery, threshold=threshold, nprobe=nprobe,
+                                 inference=inference, reembed_every=max(1, int(3 * fps)),
+                                 max_missed=max(2, int(2 * fps / step)))
+
+    def process_batch(batch):
+        detections = recognizer.detect_faces_batch([frame for _, frame in batch])
+        recognizer.process_detections([frame_index for frame_index, _ in batch], detections)
+
+    start = time.time()
+    frame_index = 0
+    sampled = 0
+    batch = []
+    try:
+        while True:
+            if frame_index % step == 0:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                batch.append((frame_index, frame))
+                sampled += 1
+                if len(batch) >= batch_size:
+                    process_batch(batch)
+                    batch = []
+                    if progress:
+                        print(f"  {frame_index}/{total_frames or '?'} frames, {recognizer.tracker.stats()['tracks']} tracks")
+            elif not capture.grab():
+                break
+            frame_index += 1
+        if batch:
+            process_batch(batch)
+    finally:
+        capture.release()
+
+    seconds = time.time() - start
+    duration = frame_index / fps
+    return {
+        "video": os.path.basename(video_path),
+        "fps": fps,
+        "frames": frame_index,
+        "sampled_frames": sampled,
+        "duration_seconds": round(duration, 2),
+        "processing_seconds": round(seconds, 2),
+        "realtime_factor": round(duration / seconds, 2) if seconds > 0 else None,
+        "stats": recognizer.tracker.stats(),
+        "tracks": recognizer.summaries(fps, min_detections)
+    }
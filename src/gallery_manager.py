@@ -3,17 +3,32 @@ import torch.nn as nn
 import torchvision.transforms as transforms
 from PIL import Image
 import os
+import json
+import hashlib
+import struct
+import zipfile
 import numpy as np
 import argparse
+from datetime import datetime
 from LightCNN.light_cnn import LightCNN_29Layers_v2
-from scipy.spatial.distance import cosine
 from ultralytics import YOLO
 import cv2
 from tqdm import tqdm
 import pandas as pd
 import random
+import time
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import albumentations as A
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 # Consistent image transformation
 transform = transforms.Compose([
     transforms.Resize((128, 128)),
@@ -55,115 +70,1935 @@ def create_face_augmentations():
 
 def augment_face_image(image, num_augmentations=3):
     """
-    Generate augmented versions of a face image in-memory
+    Generate augmented versions of a face image in-memory
+    
+    This function applies a specific augmentation strategy:
+    1. Always applies both downscale-upscale augmentations (32x32 and 24x24)
+    2. Applies one additional random augmentation from the remaining list
+    
+    Args:
+        image: Original face image (numpy array)
+        num_augmentations: Number of augmented versions to generate (default 3)
+    
+    Returns:
+        List of augmented images (numpy arrays)
+    """
+    augmentations_list = create_face_augmentations()
+    augmented_images = []
+    
+    # Define the two specific downscale-upscale augmentations that should always be applied
+    mandatory_augmentations = [
+        # 32x32 downscale-upscale (index 0)
+        A.Compose([
+            A.Resize(height=32, width=32),
+            A.Resize(height=128, width=128)
+        ]),
+        # 24x24 downscale-upscale (index 1)
+        A.Compose([
+            A.Resize(height=24, width=24),
+            A.Resize(height=128, width=128)
+        ])
+    ]
+    
+    # Apply the two mandatory downscale-upscale augmentations
+    for aug in mandatory_augmentations:
+        augmented = aug(image=image)
+        augmented_images.append(augmented['image'])
+    
+    # Apply additional random augmentations from the remaining list
+    # Exclude the first two augmentations (the downscale-upscale ones)
+    remaining_augmentations = augmentations_list[2:]  # Skip the first two
+    
+    additional_augs_needed = max(0, num_augmentations - 2)  # We already applied 2
+    for i in range(additional_augs_needed):
+        # Select random augmentation from remaining list
+        selected_aug = random.choice(remaining_augmentations)
+        
+        # Apply augmentation
+        if isinstance(selected_aug, A.Compose):
+            augmented = selected_aug(image=image)
+        else:
+            aug_pipeline = A.Compose([selected_aug])
+            augmented = aug_pipeline(image=image)
+        
+        augmented_images.append(augmented['image'])
+    
+    return augmented_images
+
+SLIM_CHECKPOINT_FORMAT = "lightcnn-embedding-v1"
+
+# Channels-last weights and inputs speed up LightCNN's convolutions on many CPUs
+CHANNELS_LAST = os.environ.get("GALLERY_MANAGER_CHANNELS_LAST", "false").lower() in ("1", "true", "yes")
+
+def slim_checkpoint_path(model_path):
+    """Path of the slim inference checkpoint for a training checkpoint (e.g. X.pth.tar -> X.slim.pth)"""
+    if model_path.endswith(".slim.pth"):
+        return model_path
+    base = model_path
+    for suffix in (".tar", ".pth", ".pt"):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    return base + ".slim.pth"
+
+def _embedding_state_dict(checkpoint):
+    """Weights of a training checkpoint without the fc2 classifier and the DataParallel "module." prefix"""
+    state_dict = checkpoint["state_dict"] if "state_dict" in checkpoint else checkpoint
+    return {k.replace("module.", ""): v for k, v in state_dict.items() if "fc2" not in k}
+
+def _read_slim_checkpoint(path):
+    """Memory-map a slim checkpoint, or None if there is none"""
+    if not os.path.exists(path):
+        return None
+    try:
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 can't memory-map checkpoints
+        checkpoint = torch.load(path, map_location="cpu")
+    if not isinstance(checkpoint, dict) or checkpoint.get("format") != SLIM_CHECKPOINT_FORMAT:
+        return None
+    return checkpoint
+
+def convert_checkpoint(model_path, output_path=None):
+    """
+    Write an inference-only checkpoint with just the embedding layers
+    
+    The fc2 classifier, the "module." prefixes and the training state are dropped once,
+    instead of on every load. The fingerprint of the source checkpoint is stored
+    along, so galleries built with either file stay compatible, and load_model()
+    uses the slim file as long as the source checkpoint is unchanged. A slim file
+    written elsewhere can be passed to load_model() itself.
+    
+    Args:
+        model_path: Training checkpoint
+        output_path: Slim checkpoint path ending in ".slim.pth" (default: slim_checkpoint_path(model_path))
+    
+    Returns:
+        Path of the slim checkpoint
+    """
+    output_path = output_path or slim_checkpoint_path(model_path)
+    if not output_path.endswith(".slim.pth"):
+        raise ValueError(f"Slim checkpoint path must end in .slim.pth for load_model() to use it: {output_path}")
+    checkpoint = torch.load(model_path, map_location="cpu")
+    # Clone, so views into the full checkpoint's storages don't drag the classifier along
+    state_dict = {k: v.detach().clone().contiguous() for k, v in _embedding_state_dict(checkpoint).items()}
+    stat = os.stat(model_path)
+    slim = {
+        "format": SLIM_CHECKPOINT_FORMAT,
+        "arch": "LightCNN_29Layers_v2",
+        "state_dict": state_dict,
+        "fingerprint": model_fingerprint(model_path),
+        "source": os.path.basename(model_path),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns
+    }
+    
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(output_path)}.", suffix=".tmp", dir=output_dir)
+    try:
+        _set_new_file_mode(fd)
+        with os.fdopen(fd, "wb") as f:
+            torch.save(slim, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(output_dir)
+    
+    params = sum(v.numel() for v in state_dict.values())
+    print(f"Wrote slim checkpoint {output_path}: {params:,} parameters, "
+          f"{os.path.getsize(output_path) / 1e6:.1f} MB (from {stat.st_size / 1e6:.1f} MB)")
+    return output_path
+
+def _load_slim_state_dict(model_path):
+    """State dict of the slim checkpoint for model_path, or None if missing or stale"""
+    slim_path = slim_checkpoint_path(model_path)
+    slim = _read_slim_checkpoint(slim_path)
+    if slim is None:
+        return None
+    if slim_path != model_path and os.path.exists(model_path):
+        stat = os.stat(model_path)
+        if (stat.st_size, stat.st_mtime_ns) != (slim.get("source_size"), slim.get("source_mtime_ns")):
+            print(f"Slim checkpoint is older than {model_path}, loading the full checkpoint "
+                  f"(re-run --mode slim to update it)")
+            return None
+    return slim["state_dict"]
+
+def load_model(model_path, channels_last=None):
+    """
+    Load LightCNN model with correct architecture
+    
+    The model is built without the fc2 classifier; use model.embed() for embeddings.
+    The slim inference checkpoint next to model_path (see convert_checkpoint()) is used
+    when present: it is memory-mapped, and its tensors become the model's weights, so
+    workers share them through the page cache instead of each holding a copy.
+    
+    Args:
+        model_path: Path to the LightCNN model file (a training checkpoint or a *.slim.pth one)
+        channels_last: Use the channels-last layout on CPU (default: GALLERY_MANAGER_CHANNELS_LAST)
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using {device} for computation")
+    
+    # Embedding layers only, recognition never uses the classifier
+    model = LightCNN_29Layers_v2(num_classes=None)
+    
+    new_state_dict = _load_slim_state_dict(model_path)
+    if new_state_dict is not None:
+        try:
+            model.load_state_dict(new_state_dict, strict=False, assign=True)
+        except TypeError:
+            # torch < 2.1 copies into the model's own parameters
+            model.load_state_dict(new_state_dict, strict=False)
+    else:
+        # Load checkpoint, without the fc2 layer parameters the model doesn't have
+        checkpoint = torch.load(model_path, map_location=device)
+        model.load_state_dict(_embedding_state_dict(checkpoint), strict=False)
+    
+    model = model.to(device)
+    model.eval()
+    if device.type == "cpu" and (CHANNELS_LAST if channels_last is None else channels_last):
+        model = model.to_channels_last()
+    return model, device
+
+def extract_embedding(model, img_path, device):
+    """Extract a face embedding from an image using LightCNN"""
+    try:
+        # Load and transform image
+        img = Image.open(img_path).convert('L')  # Convert to grayscale
+        img_tensor = transform(img).unsqueeze(0).to(device)
+        
+        # Extract embedding
+        embedding = model.embed(img_tensor)
+        return embedding.cpu().squeeze().numpy()
+    except Exception as e:
+        print(f"Error processing {img_path}: {e}")
+        return None
+
+def embed_face_images(model, device, faces, batch_size=64):
+    """
+    Extract embeddings for already cropped face images in batches
+    
+    Args:
+        model: Loaded LightCNN model
+        device: Device of the model
+        faces: Face crops as BGR/grayscale numpy arrays or PIL images
+        batch_size: Faces per forward pass
+    
+    Returns:
+        (N, D) float32 numpy array of embeddings, one row per face
+    """
+    tensors = []
+    for face in faces:
+        if isinstance(face, np.ndarray):
+            face = Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face)
+        tensors.append(transform(face.convert('L')))
+    
+    embeddings = []
+    for start in range(0, len(tensors), batch_size):
+        batch = torch.stack(tensors[start:start + batch_size]).to(device)
+        features = model.embed(batch)
+        embeddings.append(features.cpu().numpy().astype(np.float32))
+    if not embeddings:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.concatenate(embeddings)
+
+class DetectionROI:
+    """
+    Region of interest of a fixed camera, as polygons in frame pixel coordinates
+    
+    Frames are cropped to the bounding box of all polygons and everything outside
+    the polygons is blacked out before detection, so the detector gets a smaller
+    input and walls, windows or corridors produce no detections. The crop and mask
+    are computed once per frame size.
+    """
+    
+    def __init__(self, polygons):
+        self.polygons = [np.asarray(polygon, dtype=np.int32).reshape(-1, 2) for polygon in polygons]
+        if not self.polygons or any(len(polygon) < 3 for polygon in self.polygons):
+            raise ValueError("A region of interest needs at least one polygon of 3 or more points")
+        self._regions = {}
+    
+    def _region(self, shape):
+        region = self._regions.get(shape)
+        if region is None:
+            h, w = shape
+            points = np.concatenate(self.polygons)
+            x0, y0 = np.clip(points.min(axis=0), 0, [w, h])
+            x1, y1 = np.clip(points.max(axis=0) + 1, 0, [w, h])
+            mask = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=np.uint8)
+            cv2.fillPoly(mask, [polygon - [x0, y0] for polygon in self.polygons], 255)
+            # A rectangle covering its whole bounding box needs no masking
+            region = (int(x0), int(y0), int(x1), int(y1), None if mask.all() else mask)
+            self._regions[shape] = region
+        return region
+    
+    def apply(self, frame):
+        """
+        Crop and mask a frame to the region
+        
+        Returns:
+            (image, (x offset, y offset)); image is None when the region lies outside the frame
+        """
+        x0, y0, x1, y1, mask = self._region(frame.shape[:2])
+        if x1 <= x0 or y1 <= y0:
+            return None, (x0, y0)
+        image = frame[y0:y1, x0:x1]
+        if mask is not None:
+            image = cv2.bitwise_and(image, image, mask=mask)
+        return image, (x0, y0)
+    
+    def to_list(self):
+        return [polygon.tolist() for polygon in self.polygons]
+
+def tile_origins(length, tile_size, overlap=0.2):
+    """
+    Start offsets of tiles covering [0, length) with at least overlap * tile_size overlap
+    
+    The last tile is aligned to the end, so every tile lies fully inside the frame.
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1.0 - overlap)))
+    count = int(np.ceil((length - tile_size) / stride)) + 1
+    return sorted({min(i * stride, length - tile_size) for i in range(count)})
+
+def nms_boxes(boxes, scores, iou_threshold=0.5):
+    """
+    Greedy non-maximum suppression
+    
+    Args:
+        boxes: (N, 4) array of x1, y1, x2, y2
+        scores: (N,) confidences
+        iou_threshold: Boxes overlapping a kept box by more than this are dropped
+    
+    Returns:
+        Indices of the kept boxes, highest score first
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    order = np.argsort(-np.asarray(scores, dtype=np.float32), kind="stable")
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        order = rest[iou <= iou_threshold]
+    return keep
+
+def detect_face_boxes(yolo_model, frames, conf=0.65, tile_size=None, overlap=0.2, nms_iou=0.5, edge_margin=2,
+                      roi=None, imgsz=None):
+    """
+    Raw face boxes for several frames with one YOLO call, optionally tiled
+    
+    With tile_size set, frames larger than a tile are split into overlapping
+    tile_size x tile_size tiles that go through the detector at native resolution,
+    so small faces in the back rows of a high-resolution photo aren't lost to
+    downscaling. The whole frame is added as one more (downscaled) input for faces
+    too big for a tile. Tile boxes cut by an inner tile edge are dropped, since the
+    neighbouring tile or the whole-frame pass sees the full face, and the remaining
+    boxes are merged with NMS. All tiles of all frames go to the detector as a single
+    batch. With a DetectionROI only the region of interest is searched. imgsz sets
+    the detector input size of untiled detection (default: the model's).
+    
+    Returns:
+        One (N, 5) float32 array per frame of x1, y1, x2, y2, confidence in frame coordinates
+    """
+    if not frames:
+        return []
+    
+    # Region searched in each frame and its offset in the frame
+    regions = [roi.apply(frame) if roi is not None else (frame, (0, 0)) for frame in frames]
+    
+    # Detector inputs as (frame number, x offset, y offset, image), offsets within the region
+    inputs = []
+    for n, (region, _) in enumerate(regions):
+        if region is None:
+            continue
+        h, w = region.shape[:2]
+        if tile_size and max(h, w) > tile_size:
+            for y0 in tile_origins(h, tile_size, overlap):
+                for x0 in tile_origins(w, tile_size, overlap):
+                    inputs.append((n, x0, y0, region[y0:y0 + tile_size, x0:x0 + tile_size]))
+        inputs.append((n, 0, 0, region))
+    
+    per_frame = [[] for _ in frames]
+    if inputs:
+        options = {"conf": conf, "verbose": False}
+        if tile_size or imgsz:
+            options["imgsz"] = tile_size or imgsz
+        results = yolo_model([image for _, _, _, image in inputs], **options)
+        
+        for (n, x0, y0, image), result in zip(inputs, results):
+            if not len(result.boxes):
+                continue
+            boxes = result.boxes.xyxy.cpu().numpy().astype(np.float32)
+            scores = result.boxes.conf.cpu().numpy().astype(np.float32)
+            th, tw = image.shape[:2]
+            h, w = regions[n][0].shape[:2]
+            if (th, tw) != (h, w):
+                # Drop boxes touching a tile edge that lies inside the region
+                cut = (((boxes[:, 0] <= edge_margin) & (x0 > 0)) |
+                       ((boxes[:, 1] <= edge_margin) & (y0 > 0)) |
+                       ((boxes[:, 2] >= tw - edge_margin) & (x0 + tw < w)) |
+                       ((boxes[:, 3] >= th - edge_margin) & (y0 + th < h)))
+                boxes, scores = boxes[~cut], scores[~cut]
+                boxes += np.array([x0, y0, x0, y0], dtype=np.float32)
+            per_frame[n].append(np.column_stack([boxes, scores]))
+    
+    detections = []
+    for n, (_, (rx, ry)) in enumerate(regions):
+        merged = np.concatenate(per_frame[n]) if per_frame[n] else np.zeros((0, 5), dtype=np.float32)
+        if tile_size and len(merged):
+            merged = merged[nms_boxes(merged[:, :4], merged[:, 4], nms_iou)]
+        merged[:, :4] += np.array([rx, ry, rx, ry], dtype=np.float32)
+        detections.append(merged)
+    return detections
+
+def detect_faces_batch(yolo_model, frames, conf=0.65, pad=0.2, min_size=32, tile_size=None, overlap=0.2, roi=None,
+                       imgsz=None):
+    """
+    Detect faces in several frames with one YOLO call
+    
+    Boxes are padded by pad times the face size on each side (like recognize_faces in
+    the API) and faces smaller than min_size pixels are skipped. tile_size enables
+    tiled detection for large frames and roi restricts detection to a camera's
+    DetectionROI, see detect_face_boxes().
+    
+    Returns:
+        One list per frame of ((x1, y1, x2, y2), BGR face crop) tuples
+    """
+    detections = []
+    for frame, boxes in zip(frames, detect_face_boxes(yolo_model, frames, conf, tile_size, overlap, roi=roi, imgsz=imgsz)):
+        h, w = frame.shape[:2]
+        faces = []
+        for x1, y1, x2, y2, _ in boxes:
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+            pad_x = int((x2 - x1) * pad)
+            pad_y = int((y2 - y1) * pad)
+            x1, y1 = max(0, x1 - pad_x), max(0, y1 - pad_y)
+            x2, y2 = min(w, x2 + pad_x), min(h, y2 + pad_y)
+            if (x2 - x1) < min_size or (y2 - y1) < min_size:
+                continue
+            faces.append(((x1, y1, x2, y2), frame[y1:y2, x1:x2]))
+        detections.append(faces)
+    return detections
+
+def detect_faces(yolo_model, frame, conf=0.65, pad=0.2, min_size=32, tile_size=None, overlap=0.2, roi=None,
+                 imgsz=None):
+    """Detect faces in one frame, see detect_faces_batch()"""
+    return detect_faces_batch(yolo_model, [frame], conf, pad, min_size, tile_size, overlap, roi, imgsz)[0]
+
+def embed_identity_images(model, device, image_paths, augment_ratio=0.0, augs_per_image=3, inference=None):
+    """
+    Extract embeddings for an identity's face images, optionally adding augmented versions
+    
+    Args:
+        model: Loaded LightCNN model
+        device: Device of the model
+        image_paths: Paths of preprocessed face images
+        augment_ratio: Ratio of images to augment (0.0 to 1.0)
+        augs_per_image: Number of augmentations per selected image
+        inference: Inference client (see inference_server.InferenceClient) to embed with
+            instead of model, which may then be None
+    
+    Returns:
+        List of embeddings (numpy arrays)
+    """
+    if inference is not None:
+        # Read the images (and their augmentations) here and embed them all in one go
+        faces = []
+        for img_path in image_paths:
+            img = cv2.imread(img_path)
+            if img is None:
+                print(f"Error processing {img_path}: could not read image")
+                continue
+            faces.append(img)
+            if augment_ratio > 0 and random.random() < augment_ratio:
+                try:
+                    faces.extend(augment_face_image(img, augs_per_image))
+                except Exception as e:
+                    print(f"Warning: Failed to augment {img_path}: {e}")
+        return list(inference.embed_face_images(faces)) if faces else []
+    
+    embeddings = []
+    for img_path in image_paths:
+        embedding = extract_embedding(model, img_path, device)
+        if embedding is None:
+            continue
+        embeddings.append(embedding)
+        
+        # Apply augmentation if specified
+        if augment_ratio > 0 and random.random() < augment_ratio:
+            try:
+                # Load original image as numpy array for augmentation
+                img = cv2.imread(img_path)
+                if img is not None:
+                    # Generate augmented versions
+                    augmented_images = augment_face_image(img, augs_per_image)
+                    
+                    # Extract embeddings from augmented images
+                    for aug_img in augmented_images:
+                        # Convert numpy array to PIL Image
+                        aug_pil = Image.fromarray(cv2.cvtColor(aug_img, cv2.COLOR_BGR2GRAY))
+                        
+                        # Transform and extract embedding
+                        aug_tensor = transform(aug_pil).unsqueeze(0).to(device)
+                        aug_embedding = model.embed(aug_tensor)
+                        embeddings.append(aug_embedding.cpu().squeeze().numpy())
+            except Exception as e:
+                print(f"Warning: Failed to augment {img_path}: {e}")
+    return embeddings
+
+# Gallery file format version written by save_gallery
+GALLERY_FORMAT_VERSION = 2
+
+# Storage dtypes supported for the embedding matrix of a v2 gallery. int8 rows are
+# quantised symmetrically with a per-row scale (stored in the "scales" member).
+GALLERY_DTYPES = ("float32", "float16", "int8")
+
+# Rows of a float16/int8 gallery upcast at a time while matching, into one reused
+# float32 buffer of about 1 MiB at 256 dimensions, so it stays in cache for the product
+GALLERY_MATCH_CHUNK = 1024
+
+# Cache of model fingerprints keyed by (path, size, mtime) so checkpoints are hashed (or,
+# for slim checkpoints, loaded) only once
+_model_fingerprints = {}
+
+def model_fingerprint(model_path):
+    """
+    Get a short fingerprint identifying the weights a gallery was built with
+    
+    Returns:
+        First 16 hex digits of the SHA-256 of the checkpoint file, or None if it doesn't exist
+        (nor a slim checkpoint made from it)
+    """
+    if not model_path:
+        return None
+    if model_path.endswith(".slim.pth") or not os.path.exists(model_path):
+        # Deployments may ship (or load) only the slim checkpoint, which carries the source's fingerprint
+        slim_path = slim_checkpoint_path(model_path)
+        if not os.path.exists(slim_path):
+            return None
+        stat = os.stat(slim_path)
+        key = (os.path.abspath(slim_path), stat.st_size, stat.st_mtime_ns)
+        if key not in _model_fingerprints:
+            slim = _read_slim_checkpoint(slim_path)
+            _model_fingerprints[key] = slim["fingerprint"] if slim is not None else None
+        return _model_fingerprints[key]
+    
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _model_fingerprints:
+        sha = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _model_fingerprints[key] = sha.hexdigest()[:16]
+    return _model_fingerprints[key]
+
+def quantize_int8(matrix):
+    """
+    Symmetric int8 quantisation with one scale per row
+    
+    Returns:
+        (int8 matrix, float32 scales) such that matrix ~= q * scales[:, None]
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    scales = (np.abs(matrix).max(axis=1) / 127.0).astype(np.float32) if matrix.size else np.zeros(len(matrix), np.float32)
+    q = np.round(matrix / np.where(scales > 0, scales, 1.0)[:, None])
+    return np.clip(q, -127, 127).astype(np.int8), scales
+
+def gallery_checksum(identities, embeddings, norms, counts=None, sq_norm_sums=None, scales=None):
+    """Compute the SHA-256 checksum stored in (and verified against) a v2 gallery file"""
+    sha = hashlib.sha256()
+    sha.update("\n".join(identities).encode("utf-8"))
+    sha.update(np.ascontiguousarray(embeddings).tobytes())
+    sha.update(np.ascontiguousarray(norms, dtype=np.float32).tobytes())
+    if counts is not None:
+        sha.update(np.ascontiguousarray(counts, dtype=np.int64).tobytes())
+    if sq_norm_sums is not None:
+        sha.update(np.ascontiguousarray(sq_norm_sums, dtype=np.float64).tobytes())
+    if scales is not None:
+        sha.update(np.ascontiguousarray(scales, dtype=np.float32).tobytes())
+    return sha.hexdigest()
+
+# Galleries with at least this many identities are searched through their ANN index;
+# smaller ones are always searched exactly
+ANN_MIN_IDENTITIES = 4096
+
+# Default number of inverted lists probed per query (the recall knob: higher is slower but more exact)
+ANN_DEFAULT_NPROBE = 8
+
+# A full save keeps a gallery's ANN index until its list count is this many times off
+# the default for the gallery's size (about sqrt(N)); then the rows are re-clustered
+ANN_RECLUSTER_FACTOR = 2.0
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over a gallery matrix
+    
+    Rows are clustered with spherical k-means; a query only scores the rows of the
+    nprobe clusters whose centroids are closest to it. The index only stores the
+    centroids and each row's cluster, so it can follow identity-level changes
+    (append, update, delete) without re-clustering.
+    """
+    
+    def __init__(self, centroids, assignments):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assignments = np.ascontiguousarray(assignments, dtype=np.int32)
+        self._lists = None
+    
+    @classmethod
+    def build(cls, matrix, nlist=None, iterations=10, seed=0):
+        """Cluster an L2-normalised (N, D) matrix into nlist inverted lists"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n = len(matrix)
+        nlist = int(nlist or max(1, min(n, round(np.sqrt(n)))))
+        rng = np.random.default_rng(seed)
+        
+        # Train on a sample, which is plenty to place the centroids
+        sample = matrix[rng.choice(n, size=min(n, 256 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = cls._nearest(sample, centroids)
+            order = np.argsort(labels, kind="stable")
+            sizes = np.bincount(labels, minlength=nlist)
+            empty = sizes == 0
+            sums = np.zeros_like(centroids)
+            starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1.0)
+        
+        return cls(centroids, cls._nearest(matrix, centroids))
+    
+    @staticmethod
+    def _nearest(vectors, centroids, chunk=16384):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+            labels[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+    
+    @property
+    def nlist(self):
+        return len(self.centroids)
+    
+    def lists(self):
+        """Row indices grouped by inverted list, and the offset of each list"""
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable").astype(np.int32)
+            offsets = np.searchsorted(self.assignments[order], np.arange(self.nlist + 1)).astype(np.int64)
+            self._lists = (order, offsets)
+        return self._lists
+    
+    def candidates(self, query, nprobe=ANN_DEFAULT_NPROBE):
+        """Rows in the nprobe lists closest to a normalised query vector"""
+        order, offsets = self.lists()
+        nprobe = min(max(1, int(nprobe)), self.nlist)
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([order[offsets[l]:offsets[l + 1]] for l in probe])
+    
+    def fits(self, n):
+        """Whether the index covers n rows with about the list count a fresh build would use"""
+        default = max(1, min(n, round(np.sqrt(n))))
+        return (len(self.assignments) == n and self.assignments.max(initial=0) < self.nlist
+                and default / ANN_RECLUSTER_FACTOR <= self.nlist <= default * ANN_RECLUSTER_FACTOR)
+    
+    def copy(self):
+        return IVFIndex(self.centroids, self.assignments.copy())
+    
+    def update(self, i, vector):
+        self.assignments[i] = self._nearest(np.asarray(vector)[None, :], self.centroids)[0]
+        self._lists = None
+    
+    def append(self, vector):
+        self.assignments = np.append(self.assignments, self._nearest(np.asarray(vector)[None, :], self.centroids))
+        self._lists = None
+    
+    def delete(self, i):
+        self.assignments = np.delete(self.assignments, i)
+        self._lists = None
+
+# Best coarse candidates re-scored with the full vectors when a gallery has a PCA index
+PCA_DEFAULT_CANDIDATES = 100
+
+class PCAIndex:
+    """
+    Low-dimensional PCA projection of a gallery for coarse-to-fine matching
+    
+    A row x is approximated as mean + components.T @ r with r = components @ (x - mean),
+    so x . q ~= r . (components @ q) + mean . q. The second term is the same for every row
+    and the first only needs the dim-dimensional reduced rows, which are kept next to
+    the full matrix. The best coarse candidates are then re-scored with the full vectors.
+    """
+    
+    def __init__(self, mean, components, reduced):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.reduced = np.asarray(reduced, dtype=np.float32)
+    
+    @classmethod
+    def build(cls, matrix, dim, max_samples=20000, seed=0):
+        """Fit a dim-dimensional projection to an (N, D) normalised matrix"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        sample = matrix
+        if len(matrix) > max_samples:
+            sample = matrix[np.random.default_rng(seed).choice(len(matrix), size=max_samples, replace=False)]
+        mean = sample.mean(axis=0)
+        _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        index = cls(mean, vt[:dim], np.zeros((0, min(dim, len(vt))), dtype=np.float32))
+        index.reduced = index.project(matrix)
+        return index
+    
+    @property
+    def dim(self):
+        return len(self.components)
+    
+    def project(self, vectors):
+        """Reduced coordinates of (N, D) gallery rows"""
+        return (np.atleast_2d(np.asarray(vectors, dtype=np.float32)) - self.mean) @ self.components.T
+    
+    def candidates(self, query, count=PCA_DEFAULT_CANDIDATES):
+        """Rows with the count best coarse scores for a normalised query"""
+        coarse = self.reduced @ (self.components @ query)
+        if count >= len(coarse):
+            return np.arange(len(coarse))
+        return np.argpartition(-coarse, count - 1)[:count]
+    
+    def copy(self):
+        return PCAIndex(self.mean, self.components, np.array(self.reduced))
+    
+    def update(self, i, vector):
+        self.reduced[i] = self.project(vector)[0]
+    
+    def append(self, vector):
+        self.reduced = np.vstack([self.reduced, self.project(vector)])
+    
+    def delete(self, i):
+        self.reduced = np.delete(self.reduced, i, axis=0)
+
+class Gallery:
+    """
+    In-memory face gallery with one row per identity
+    
+    Embeddings are kept as a contiguous, L2-normalised matrix so that matching a face
+    against the whole gallery is a single matrix product. The original (un-normalised)
+    mean embeddings can be recovered by multiplying each row with its norm.
+    
+    Each identity also carries running statistics: the number of image embeddings that
+    were averaged into it and the sum of their squared norms. Together with the mean
+    these let new images be folded in (or earlier ones taken out) in O(dim) without
+    re-embedding the identity's other images.
+    
+    The matrix may be stored as float32, float16 or int8; int8 rows come with a
+    per-row dequantisation scale in scales.
+    """
+    
+    def __init__(self, identities, embeddings, norms=None, model_fingerprint=None, path=None,
+                 counts=None, sq_norm_sums=None, scales=None):
+        self.identities = [str(identity) for identity in identities]
+        self.model_fingerprint = model_fingerprint
+        self.path = path
+        
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2:
+            embeddings = embeddings.reshape(len(self.identities), -1)
+        
+        if norms is None:
+            # Raw embeddings: normalise them and remember the original norms
+            embeddings = embeddings.astype(np.float32)
+            norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+            embeddings = embeddings / np.where(norms > 0, norms, 1.0)[:, None]
+        
+        self.embeddings = np.ascontiguousarray(embeddings)
+        self.norms = np.ascontiguousarray(norms, dtype=np.float32)
+        if self.embeddings.dtype == np.int8 and scales is None:
+            raise ValueError("int8 gallery embeddings need per-row scales")
+        self.scales = np.ascontiguousarray(scales, dtype=np.float32) if self.embeddings.dtype == np.int8 else None
+        
+        # Galleries without statistics (legacy files) count each identity as a single sample
+        if counts is None:
+            counts = np.ones(len(self.identities), dtype=np.int64)
+        if sq_norm_sums is None:
+            sq_norm_sums = self.norms.astype(np.float64) ** 2
+        self.counts = np.ascontiguousarray(counts, dtype=np.int64)
+        self.sq_norm_sums = np.ascontiguousarray(sq_norm_sums, dtype=np.float64)
+        
+        # Sequence number of the last delta log record reflected in this gallery
+        self.delta_seq = 0
+        
+        # Optional IVFIndex over the rows (see ANN_MIN_IDENTITIES)
+        self.ann_index = None
+        
+        # Dimension of the PCA coarse matching index to keep with this gallery (None: no cascade)
+        self.pca_dim = None
+        self.pca_index = None
+        self._positions = None
+    
+    @classmethod
+    def from_dict(cls, embeddings_dict, model_fingerprint=None, stats=None):
+        """
+        Build a gallery from a {identity: embedding} dictionary
+        
+        Args:
+            embeddings_dict: Mean embedding per identity
+            model_fingerprint: Fingerprint of the model the embeddings came from
+            stats: Optional {identity: (count, sum of squared norms)} of the averaged samples
+        """
+        identities = list(embeddings_dict.keys())
+        if not identities:
+            return cls([], np.zeros((0, 0), dtype=np.float32), model_fingerprint=model_fingerprint)
+        embeddings = np.stack([np.asarray(embeddings_dict[identity], dtype=np.float32).reshape(-1)
+                               for identity in identities])
+        gallery = cls(identities, embeddings, model_fingerprint=model_fingerprint)
+        for i, identity in enumerate(identities):
+            if stats and identity in stats:
+                gallery.counts[i], gallery.sq_norm_sums[i] = stats[identity]
+        return gallery
+    
+    @property
+    def dim(self):
+        return int(self.embeddings.shape[1]) if self.embeddings.ndim == 2 else 0
+    
+    def __len__(self):
+        return len(self.identities)
+    
+    def __contains__(self, identity):
+        return identity in self.positions
+    
+    @property
+    def positions(self):
+        """Mapping of identity -> row index"""
+        if self._positions is None:
+            self._positions = {identity: i for i, identity in enumerate(self.identities)}
+        return self._positions
+    
+    @property
+    def dtype(self):
+        """Storage dtype name of the embedding matrix"""
+        return self.embeddings.dtype.name
+    
+    def matrix(self):
+        """Normalised embedding matrix as float32 (upcasts float16 and dequantises int8 storage)"""
+        if self.embeddings.dtype == np.float32:
+            return self.embeddings
+        if self.scales is not None:
+            return self.embeddings.astype(np.float32) * self.scales[:, None]
+        return self.embeddings.astype(np.float32)
+    
+    def row(self, i):
+        """Normalised embedding of row i as float32"""
+        row = self.embeddings[i].astype(np.float32)
+        return row * self.scales[i] if self.scales is not None else row
+    
+    def raw_embedding(self, identity):
+        """Original (un-normalised) mean embedding of an identity"""
+        i = self.positions[identity]
+        return self.row(i) * self.norms[i]
+    
+    def to_dict(self):
+        """Convert to the legacy {identity: embedding} dictionary"""
+        return {identity: self.raw_embedding(identity) for identity in self.identities}
+    
+    def checksum(self):
+        return gallery_checksum(self.identities, self.embeddings, self.norms, self.counts, self.sq_norm_sums,
+                                self.scales)
+    
+    def build_ann_index(self, nlist=None):
+        """Cluster the gallery into an IVF index (replacing any existing one)"""
+        self.ann_index = IVFIndex.build(self.matrix(), nlist) if len(self) else None
+        return self.ann_index
+    
+    def build_pca_index(self, dim=None):
+        """Fit the PCA coarse matching index (default: at the gallery's pca_dim)"""
+        dim = dim or self.pca_dim
+        self.pca_index = PCAIndex.build(self.matrix(), dim) if dim and len(self) > dim else None
+        return self.pca_index
+    
+    def copy(self):
+        """
+        Private, writable copy of the gallery
+        
+        Snapshots handed out by the gallery cache are shared between requests (and possibly
+        memory-mapped read-only), so modify a copy and publish it with save_gallery.
+        """
+        gallery = Gallery(list(self.identities), np.array(self.embeddings), self.norms.copy(),
+                          model_fingerprint=self.model_fingerprint, path=self.path,
+                          counts=self.counts.copy(), sq_norm_sums=self.sq_norm_sums.copy(),
+                          scales=self.scales.copy() if self.scales is not None else None)
+        gallery.delta_seq = self.delta_seq
+        gallery.ann_index = self.ann_index.copy() if self.ann_index is not None else None
+        gallery.pca_dim = self.pca_dim
+        gallery.pca_index = self.pca_index.copy() if self.pca_index is not None else None
+        return gallery
+    
+    def identity_stats(self, identity):
+        """Sample count, mean norm and spread (mean squared distance to the mean) of an identity"""
+        i = self.positions[identity]
+        count = int(self.counts[i])
+        norm = float(self.norms[i])
+        spread = max(0.0, float(self.sq_norm_sums[i]) / count - norm ** 2) if count else 0.0
+        return {"identity": identity, "count": count, "norm": norm, "spread": spread}
+    
+    def _set_row(self, i, total, count, sq_norm_sum):
+        """Store the statistics of row i given the sum of its sample embeddings"""
+        mean = total / count
+        norm = float(np.linalg.norm(mean))
+        normalised = mean / (norm if norm > 0 else 1.0)
+        if self.scales is not None:
+            q, scale = quantize_int8(normalised)
+            self.embeddings[i], self.scales[i] = q[0], scale[0]
+        else:
+            self.embeddings[i] = normalised
+        self.norms[i] = norm
+        self.counts[i] = count
+        self.sq_norm_sums[i] = sq_norm_sum
+        if self.ann_index is not None:
+            self.ann_index.update(i, self.row(i))
+        if self.pca_index is not None:
+            self.pca_index.update(i, self.row(i))
+    
+    def _append_row(self, identity):
+        """Add an empty row for a new identity and return its index"""
+        dim = self.dim
+        embeddings = self.embeddings if dim else np.zeros((0, 0), dtype=np.float32)
+        self.embeddings = np.ascontiguousarray(np.vstack([embeddings.reshape(len(self), dim),
+                                                          np.zeros((1, dim), dtype=embeddings.dtype)]))
+        self.norms = np.append(self.norms, np.float32(0))
+        if self.scales is not None:
+            self.scales = np.append(self.scales, np.float32(0))
+        self.counts = np.append(self.counts, np.int64(0))
+        self.sq_norm_sums = np.append(self.sq_norm_sums, 0.0)
+        self.identities.append(identity)
+        if self.ann_index is not None:
+            self.ann_index.append(self.row(len(self) - 1))
+        if self.pca_index is not None:
+            self.pca_index.append(self.row(len(self) - 1))
+        self._positions = None
+        return len(self) - 1
+    
+    def _delete_row(self, i):
+        keep = np.arange(len(self)) != i
+        self.embeddings = np.ascontiguousarray(self.embeddings[keep])
+        self.norms = self.norms[keep]
+        if self.scales is not None:
+            self.scales = self.scales[keep]
+        self.counts = self.counts[keep]
+        self.sq_norm_sums = self.sq_norm_sums[keep]
+        del self.identities[i]
+        if self.ann_index is not None:
+            self.ann_index.delete(i)
+        if self.pca_index is not None:
+            self.pca_index.delete(i)
+        self._positions = None
+    
+    def fold_in(self, identity, embeddings):
+        """
+        Add image embeddings to an identity's running statistics (in place)
+        
+        Creates the identity if it isn't in the gallery yet.
+        """
+        samples = np.atleast_2d(np.asarray(embeddings, dtype=np.float64))
+        if samples.size:
+            self.fold_sum(identity, samples.sum(axis=0), len(samples), float((samples ** 2).sum()))
+    
+    def fold_out(self, identity, embeddings):
+        """
+        Remove image embeddings that were previously folded into an identity (in place)
+        
+        The identity is removed once no samples remain.
+        """
+        samples = np.atleast_2d(np.asarray(embeddings, dtype=np.float64))
+        if samples.size:
+            self.unfold_sum(identity, samples.sum(axis=0), len(samples), float((samples ** 2).sum()))
+    
+    def fold_sum(self, identity, sample_sum, sample_count, sample_sq_norm_sum):
+        """fold_in() for pre-aggregated samples: their sum, count and sum of squared norms"""
+        sample_sum = np.asarray(sample_sum, dtype=np.float64).reshape(-1)
+        if not self.dim:
+            self.embeddings = np.zeros((0, len(sample_sum)), dtype=np.float32)
+            self.scales = None
+        if len(sample_sum) != self.dim:
+            raise ValueError(f"Embedding dimension {len(sample_sum)} does not match gallery dimension {self.dim}")
+        
+        if identity in self:
+            i = self.positions[identity]
+            total = self.raw_embedding(identity).astype(np.float64) * self.counts[i]
+            count = int(self.counts[i])
+            sq_norm_sum = float(self.sq_norm_sums[i])
+        else:
+            i = self._append_row(identity)
+            total = np.zeros(self.dim, dtype=np.float64)
+            count = 0
+            sq_norm_sum = 0.0
+        
+        self._set_row(i, total + sample_sum, count + int(sample_count), sq_norm_sum + float(sample_sq_norm_sum))
+    
+    def unfold_sum(self, identity, sample_sum, sample_count, sample_sq_norm_sum):
+        """fold_out() for pre-aggregated samples: their sum, count and sum of squared norms"""
+        i = self.positions[identity]
+        count = int(self.counts[i])
+        if sample_count > count:
+            raise ValueError(f"Cannot remove {sample_count} samples from '{identity}', it only has {count}")
+        if sample_count == count:
+            self._delete_row(i)
+            return
+        
+        total = self.raw_embedding(identity).astype(np.float64) * count - np.asarray(sample_sum, dtype=np.float64)
+        sq_norm_sum = max(0.0, float(self.sq_norm_sums[i]) - float(sample_sq_norm_sum))
+        self._set_row(i, total, count - int(sample_count), sq_norm_sum)
+    
+    def set_identity(self, identity, embedding, count=1, sq_norm_sum=None):
+        """Add an identity, or replace all of its statistics, given its mean embedding (in place)"""
+        embedding = np.asarray(embedding, dtype=np.float64).reshape(-1)
+        if not self.dim:
+            self.embeddings = np.zeros((0, len(embedding)), dtype=np.float32)
+            self.scales = None
+        if len(embedding) != self.dim:
+            raise ValueError(f"Embedding dimension {len(embedding)} does not match gallery dimension {self.dim}")
+        if sq_norm_sum is None:
+            sq_norm_sum = float(count * np.dot(embedding, embedding))
+        i = self.positions[identity] if identity in self else self._append_row(identity)
+        self._set_row(i, embedding * count, int(count), float(sq_norm_sum))
+    
+    def remove_identity(self, identity):
+        """Remove an identity (in place)"""
+        self._delete_row(self.positions[identity])
+    
+    def rename_identity(self, identity, new_identity):
+        """Rename an identity (in place)"""
+        if new_identity in self:
+            raise ValueError(f"Identity '{new_identity}' already exists")
+        self.identities[self.positions[identity]] = str(new_identity)
+        self._positions = None
+
+def _gallery_from_legacy(gallery_data, path=None):
+    """Convert the legacy gallery shapes saved with torch.save into a Gallery"""
+    def to_numpy(value):
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu().numpy()
+        return np.asarray(value, dtype=np.float32).reshape(-1)
+    
+    if isinstance(gallery_data, dict) and "identities" in gallery_data and "embeddings" in gallery_data:
+        # update_gallery format: {"identities": [...], "embeddings": [...]}
+        embeddings_dict = {identity: to_numpy(embedding)
+                           for identity, embedding in zip(gallery_data["identities"], gallery_data["embeddings"])}
+    elif isinstance(gallery_data, dict):
+        # create_gallery format: {identity: embedding}
+        embeddings_dict = {identity: to_numpy(embedding) for identity, embedding in gallery_data.items()}
+    else:
+        raise ValueError(f"Unrecognised gallery format in {path}: {type(gallery_data).__name__}")
+    
+    gallery = Gallery.from_dict(embeddings_dict)
+    gallery.path = path
+    return gallery
+
+def is_v2_gallery_file(path):
+    """Check whether a file uses the versioned (v2) gallery format"""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as zf:
+        return "meta.npy" in zf.namelist()
+
+def _mmap_archive_member(path, name):
+    """
+    Memory-map an array stored uncompressed inside a v2 gallery archive
+    
+    np.savez stores members without compression, so the .npy payload of a member is a
+    contiguous byte range of the gallery file and can be mapped directly. Every process
+    mapping the same file then shares the same page-cache pages.
+    
+    Returns:
+        Read-only np.memmap, or None if the member is compressed
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    
+    with open(path, "rb") as f:
+        # Skip the zip local file header to reach the .npy payload
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise ValueError(f"Corrupt gallery archive: {path}")
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    # np.memmap raises if the file is shorter than the array, so truncated files are detected here
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                     order="F" if fortran_order else "C")
+
+def load_gallery(gallery_path, verify=True, mmap=False, apply_deltas=True):
+    """
+    Load a gallery file of any known format
+    
+    v2 files are read directly as arrays (no pickle). Legacy torch.save files, either a
+    {identity: embedding} dict or {"identities": [...], "embeddings": [...]}, are upgraded
+    in memory.
+    
+    Args:
+        gallery_path: Path to the gallery file
+        verify: Verify the checksum of v2 files
+        mmap: Memory-map the embedding matrix of v2 files instead of reading it. The
+            matrix then lives in the shared page cache rather than in private memory,
+            so every worker process opening the same gallery shares one copy.
+        apply_deltas: Replay identity changes from the gallery's delta log that are not
+            yet compacted into the file
+    
+    Returns:
+        Gallery
+    """
+    gallery = _load_gallery_file(gallery_path, verify, mmap)
+    if apply_deltas:
+        gallery = apply_gallery_deltas(gallery, read_gallery_deltas(gallery_path, gallery.delta_seq))
+    return gallery
+
+def _load_gallery_file(gallery_path, verify=True, mmap=False):
+    """Load the base gallery file, without its delta log"""
+    if not is_v2_gallery_file(gallery_path):
+        gallery_data = torch.load(gallery_path, map_location="cpu", weights_only=False)
+        return _gallery_from_legacy(gallery_data, gallery_path)
+    
+    with np.load(gallery_path, allow_pickle=False) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta.get("format_version", 0) > GALLERY_FORMAT_VERSION:
+            raise ValueError(f"Gallery {gallery_path} uses unsupported format version {meta['format_version']}")
+        identities = [str(identity) for identity in data["identities"]]
+        norms = data["norms"]
+        counts = data["counts"] if "counts" in data.files else None
+        sq_norm_sums = data["sq_norm_sums"] if "sq_norm_sums" in data.files else None
+        scales = data["scales"] if "scales" in data.files else None
+        embeddings = _mmap_archive_member(gallery_path, "embeddings") if mmap else None
+        if embeddings is None:
+            embeddings = data["embeddings"]
+        ann_index = None
+        if "ivf_centroids" in data.files:
+            ann_index = IVFIndex(data["ivf_centroids"], data["ivf_assignments"])
+        pca_index = None
+        if "pca_components" in data.files:
+            reduced = _mmap_archive_member(gallery_path, "pca_embeddings") if mmap else None
+            if reduced is None:
+                reduced = data["pca_embeddings"]
+            pca_index = PCAIndex(data["pca_mean"], data["pca_components"], reduced)
+    
+    if verify and meta.get("checksum") != gallery_checksum(identities, embeddings, norms, counts, sq_norm_sums, scales):
+        raise ValueError(f"Gallery checksum mismatch, file may be corrupt: {gallery_path}")
+    
+    gallery = Gallery(identities, embeddings, norms,
+                      model_fingerprint=meta.get("model_fingerprint"), path=gallery_path,
+                      counts=counts, sq_norm_sums=sq_norm_sums, scales=scales)
+    gallery.delta_seq = meta.get("delta_seq", 0)
+    if ann_index is not None:
+        if len(ann_index.assignments) == len(gallery) and ann_index.assignments.max(initial=0) < ann_index.nlist:
+            gallery.ann_index = ann_index
+        else:
+            print(f"Warning: Ignoring inconsistent ANN index in {gallery_path}")
+    gallery.pca_dim = meta.get("pca_dim")
+    if pca_index is not None:
+        if pca_index.reduced.shape == (len(gallery), pca_index.dim) and pca_index.components.shape[1] == gallery.dim:
+            gallery.pca_index = pca_index
+        else:
+            print(f"Warning: Ignoring inconsistent PCA index in {gallery_path}")
+    return gallery
+
+def save_gallery(gallery, output_path, dtype=None):
+    """
+    Save a gallery in the versioned (v2) format
+    
+    Args:
+        gallery: Gallery or {identity: embedding} dictionary
+        output_path: Path to write the gallery file to
+        dtype: Storage dtype of the embedding matrix ("float32", "float16" or "int8",
+            default: keep the gallery's current dtype)
+    
+    A full save supersedes the gallery's delta log: pending identity changes are
+    considered part of the saved gallery and the log is reset.
+    
+    Returns:
+        The saved Gallery
+    """
+    if not isinstance(gallery, Gallery):
+        gallery = Gallery.from_dict(gallery)
+    with _gallery_lock(output_path):
+        return _write_gallery_file(gallery, output_path, dtype)
+
+def _write_gallery_file(gallery, output_path, dtype=None):
+    """Write a gallery file and reset its delta log (caller holds the gallery lock)"""
+    if dtype is None:
+        dtype = gallery.dtype if gallery.dtype in GALLERY_DTYPES else "float32"
+    if dtype not in GALLERY_DTYPES:
+        raise ValueError(f"Unsupported gallery dtype: {dtype}")
+    
+    scales = None
+    if dtype == gallery.dtype:
+        embeddings = np.ascontiguousarray(gallery.embeddings)
+        scales = gallery.scales
+    elif dtype == "int8":
+        embeddings, scales = quantize_int8(gallery.matrix().reshape(len(gallery), gallery.dim))
+    else:
+        embeddings = np.ascontiguousarray(gallery.matrix(), dtype=dtype)
+    norms = np.ascontiguousarray(gallery.norms, dtype=np.float32)
+    counts = np.ascontiguousarray(gallery.counts, dtype=np.int64)
+    sq_norm_sums = np.ascontiguousarray(gallery.sq_norm_sums, dtype=np.float64)
+    delta_seq = _last_delta_seq(output_path)
+    
+    # Large galleries are saved with an ANN index. The gallery's own index follows identity
+    # changes without re-clustering, so it is kept while it still fits the gallery's size
+    # and compactions don't pay for k-means.
+    ann_index = None
+    index_arrays = {}
+    if len(gallery) >= ANN_MIN_IDENTITIES:
+        if gallery.ann_index is not None and gallery.ann_index.fits(len(gallery)):
+            ann_index = gallery.ann_index.copy()
+        else:
+            ann_index = IVFIndex.build(gallery.matrix())
+        index_arrays = {"ivf_centroids": ann_index.centroids, "ivf_assignments": ann_index.assignments}
+    
+    # The PCA index is refitted on every full save
+    pca_index = None
+    if gallery.pca_dim and len(gallery) > gallery.pca_dim:
+        pca_index = PCAIndex.build(gallery.matrix(), gallery.pca_dim)
+        index_arrays.update(pca_mean=pca_index.mean, pca_components=pca_index.components,
+                          pca_embeddings=np.ascontiguousarray(pca_index.reduced))
+    meta = {
+        "format_version": GALLERY_FORMAT_VERSION,
+        "delta_seq": delta_seq,
+        "model_fingerprint": gallery.model_fingerprint,
+        "embedding_dim": gallery.dim,
+        "dtype": dtype,
+        "count": len(gallery),
+        "pca_dim": gallery.pca_dim,
+        "checksum": gallery_checksum(gallery.identities, embeddings, norms, counts, sq_norm_sums, scales),
+        "created_at": datetime.now().isoformat(timespec="seconds")
+    }
+    
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Write to a temporary file in the same directory, fsync it and atomically rename it over
+    # the live path. Readers (including processes that memory-mapped the old file) never see
+    # a partially written gallery; they keep the old version until they reopen the path.
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(output_path)}.", suffix=".tmp", dir=output_dir)
+    try:
+        _set_new_file_mode(fd)
+        # Write through a file object so numpy doesn't append ".npz" to the .pth path
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f,
+                     meta=np.array(json.dumps(meta)),
+                     identities=np.array(gallery.identities, dtype=str),
+                     embeddings=embeddings,
+                     norms=norms,
+                     counts=counts,
+                     sq_norm_sums=sq_norm_sums,
+                     **({"scales": scales} if scales is not None else {}),
+                     **index_arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(output_dir)
+    
+    # Everything in the delta log up to delta_seq is now part of the file. If we crash before
+    # the log is reset, the loader skips those records because of the delta_seq in the meta.
+    if delta_seq:
+        _reset_delta_log(output_path, delta_seq)
+    
+    saved = Gallery(gallery.identities, embeddings, norms,
+                    model_fingerprint=gallery.model_fingerprint, path=output_path,
+                    counts=counts, sq_norm_sums=sq_norm_sums, scales=scales)
+    saved.delta_seq = delta_seq
+    saved.ann_index = ann_index
+    saved.pca_dim = gallery.pca_dim
+    saved.pca_index = pca_index
+    gallery_cache.publish(output_path, saved)
+    return saved
+
+# The process umask, read once at import (reading it means setting it, which isn't thread-safe)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _set_new_file_mode(fd):
+    """Give a mkstemp() file (created 0600) the mode open() would have, so replaced files stay readable"""
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, 0o666 & ~_UMASK)
+
+def _fsync_directory(path):
+    """Persist a rename by fsyncing its directory (not supported on every platform)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Number of delta log records after which identity changes are compacted into the gallery file
+GALLERY_DELTA_COMPACT_OPS = 64
+
+def delta_log_path(gallery_path):
+    """Path of the append-only log of identity changes made to a gallery since its last full save"""
+    return f"{gallery_path}.delta"
+
+def _lock_path(gallery_path):
+    directory, name = os.path.split(os.path.abspath(gallery_path))
+    return os.path.join(directory, f".{name}.lock")
+
+class _gallery_lock:
+    """
+    Exclusive lock serialising writers of a gallery file and its delta log across processes
+    
+    Readers never take it. The lock is re-entrant within a thread. On platforms without
+    fcntl only threads of this process are serialised.
+    """
+    _states = {}
+    _states_guard = threading.Lock()
+    
+    def __init__(self, gallery_path):
+        path = _lock_path(gallery_path)
+        with self._states_guard:
+            self.state = self._states.setdefault(path, {"path": path, "lock": threading.RLock(),
+                                                        "depth": 0, "file": None})
+    
+    def __enter__(self):
+        state = self.state
+        state["lock"].acquire()
+        state["depth"] += 1
+        if state["depth"] == 1 and fcntl is not None:
+            try:
+                state["file"] = open(state["path"], "a")
+                fcntl.flock(state["file"].fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                state["depth"] -= 1
+                state["lock"].release()
+                raise
+        return self
+    
+    def __exit__(self, *exc_info):
+        state = self.state
+        state["depth"] -= 1
+        if state["depth"] == 0 and state["file"] is not None:
+            fcntl.flock(state["file"].fileno(), fcntl.LOCK_UN)
+            state["file"].close()
+            state["file"] = None
+        state["lock"].release()
+
+def read_gallery_deltas(gallery_path, after_seq=0):
+    """Read the delta log records of a gallery with a sequence number above after_seq"""
+    path = delta_log_path(gallery_path)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a crashed writer; everything before it is intact
+                print(f"Warning: Ignoring unreadable record in {path}")
+                break
+            if record.get("seq", 0) > after_seq:
+                records.append(record)
+    return records
+
+def _last_delta_seq(gallery_path):
+    path = delta_log_path(gallery_path)
+    if not os.path.exists(path):
+        return 0
+    seq = 0
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                seq = max(seq, json.loads(line).get("seq", 0))
+            except json.JSONDecodeError:
+                break
+    return seq
+
+def _reset_delta_log(gallery_path, seq):
+    """Atomically replace the delta log with a checkpoint record that keeps the sequence going"""
+    path = delta_log_path(gallery_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps({"seq": seq, "op": "checkpoint"}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def apply_gallery_delta(gallery, record):
+    """Apply one delta log record to a gallery (in place)"""
+    op = record["op"]
+    if op == "add":
+        gallery.set_identity(record["identity"], record["embedding"], record["count"], record["sq_norm_sum"])
+    elif op == "remove":
+        gallery.remove_identity(record["identity"])
+    elif op == "rename":
+        gallery.rename_identity(record["identity"], record["new_identity"])
+    elif op == "fold":
+        gallery.fold_sum(record["identity"], record["sum"], record["count"], record["sq_norm_sum"])
+    elif op == "unfold":
+        gallery.unfold_sum(record["identity"], record["sum"], record["count"], record["sq_norm_sum"])
+    elif op != "checkpoint":
+        raise ValueError(f"Unknown gallery delta operation: {op}")
+    gallery.delta_seq = record["seq"]
+
+def apply_gallery_deltas(gallery, records):
+    """Return the gallery with delta log records applied (a copy if there is anything to apply)"""
+    records = [record for record in records if record["seq"] > gallery.delta_seq]
+    if not records:
+        return gallery
+    gallery = gallery.copy()
+    for record in records:
+        try:
+            apply_gallery_delta(gallery, record)
+        except (KeyError, ValueError) as e:
+            print(f"Warning: Skipping gallery delta {record.get('seq')} ({record.get('op')}): {e}")
+            gallery.delta_seq = record["seq"]
+    return gallery
+
+def update_gallery_identities(gallery_path, record, compact_after=GALLERY_DELTA_COMPACT_OPS):
+    """
+    Apply an identity-level change to a gallery without rewriting it
+    
+    The change is applied to a copy of the current in-memory snapshot, appended to the
+    gallery's delta log and the new snapshot is published to the cache. Once the log
+    holds compact_after records it is compacted into the gallery file.
+    
+    Args:
+        gallery_path: Path to the gallery file
+        record: Delta record without "seq", e.g. {"op": "remove", "identity": "21CS001"}
+        compact_after: Compact once the log holds this many records
+    
+    Returns:
+        The updated Gallery
+    """
+    with _gallery_lock(gallery_path):
+        gallery = gallery_cache.get(gallery_path)
+        if gallery is None:
+            raise FileNotFoundError(f"Gallery not found: {gallery_path}")
+        
+        # Validate by applying to a private copy first; a failing change is never logged
+        record = dict(record, seq=gallery.delta_seq + 1, time=datetime.now().isoformat(timespec="seconds"))
+        updated = gallery.copy()
+        apply_gallery_delta(updated, record)
+        
+        with open(delta_log_path(gallery_path), "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        gallery_cache.publish(gallery_path, updated)
+        
+        pending = [r for r in read_gallery_deltas(gallery_path) if r["op"] != "checkpoint"]
+        if len(pending) >= compact_after:
+            updated = _write_gallery_file(updated, gallery_path)
+        return updated
+
+def compact_gallery(gallery_path):
+    """
+    Fold the delta log of a gallery into the gallery file
     
-    This function applies a specific augmentation strategy:
-    1. Always applies both downscale-upscale augmentations (32x32 and 24x24)
-    2. Applies one additional random augmentation from the remaining list
+    Returns:
+        Tuple of the compacted Gallery and the number of delta records folded in
+    """
+    with _gallery_lock(gallery_path):
+        base = _load_gallery_file(gallery_path, verify=False)
+        records = [r for r in read_gallery_deltas(gallery_path, base.delta_seq) if r["op"] != "checkpoint"]
+        gallery = apply_gallery_deltas(base, records)
+        if records:
+            gallery = _write_gallery_file(gallery, gallery_path)
+        return gallery, len(records)
+
+def set_gallery_pca_dim(gallery_path, dim):
+    """
+    Enable (or, with dim 0/None, disable) PCA coarse-to-fine matching for a gallery
     
-    Args:
-        image: Original face image (numpy array)
-        num_augmentations: Number of augmented versions to generate (default 3)
+    The gallery file is rewritten with a projection fitted to its current embeddings.
     
     Returns:
-        List of augmented images (numpy arrays)
+        The saved Gallery
     """
-    augmentations_list = create_face_augmentations()
-    augmented_images = []
+    with _gallery_lock(gallery_path):
+        base = _load_gallery_file(gallery_path, verify=False)
+        gallery = apply_gallery_deltas(base, read_gallery_deltas(gallery_path, base.delta_seq))
+        if dim and dim >= gallery.dim:
+            raise ValueError(f"PCA dimension {dim} must be smaller than the embedding dimension {gallery.dim}")
+        gallery.pca_dim = int(dim) if dim else None
+        return _write_gallery_file(gallery, gallery_path)
+
+def remove_gallery_files(gallery_path):
+    """Delete a gallery file together with its delta log"""
+    with _gallery_lock(gallery_path):
+        for path in (gallery_path, delta_log_path(gallery_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        gallery_cache.invalidate(gallery_path)
+
+class GalleryCache:
+    """
+    Process-wide cache of loaded galleries with read-copy-update semantics
     
-    # Define the two specific downscale-upscale augmentations that should always be applied
-    mandatory_augmentations = [
-        # 32x32 downscale-upscale (index 0)
-        A.Compose([
-            A.Resize(height=32, width=32),
-            A.Resize(height=128, width=128)
-        ]),
-        # 24x24 downscale-upscale (index 1)
-        A.Compose([
-            A.Resize(height=24, width=24),
-            A.Resize(height=128, width=128)
-        ])
-    ]
+    Each entry is an immutable (file signatures, Gallery) snapshot. Readers only stat the
+    gallery file and its delta log and do a dictionary lookup, without taking a lock.
+    When a gallery changes, the next reader builds the new version and swaps the entry in
+    a single assignment; recognitions already holding the old snapshot finish on it
+    undisturbed. If only the delta log grew, the new records are applied on top of the
+    cached snapshot instead of reloading the file.
+    """
     
-    # Apply the two mandatory downscale-upscale augmentations
-    for aug in mandatory_augmentations:
-        augmented = aug(image=image)
-        augmented_images.append(augmented['image'])
+    def __init__(self, mmap=True):
+        self.mmap = mmap
+        self._snapshots = {}
+        self._load_lock = threading.Lock()
     
-    # Apply additional random augmentations from the remaining list
-    # Exclude the first two augmentations (the downscale-upscale ones)
-    remaining_augmentations = augmentations_list[2:]  # Skip the first two
+    @staticmethod
+    def _file_signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
     
-    additional_augs_needed = max(0, num_augmentations - 2)  # We already applied 2
-    for i in range(additional_augs_needed):
-        # Select random augmentation from remaining list
-        selected_aug = random.choice(remaining_augmentations)
+    def _signature(self, path):
+        base = self._file_signature(path)
+        if base is None:
+            raise FileNotFoundError(path)
+        return (base, self._file_signature(delta_log_path(path)))
+    
+    def get(self, path):
+        """Get the current snapshot of a gallery, or None if the file doesn't exist"""
+        try:
+            signature = self._signature(path)
+        except FileNotFoundError:
+            self._snapshots.pop(path, None)
+            return None
         
-        # Apply augmentation
-        if isinstance(selected_aug, A.Compose):
-            augmented = selected_aug(image=image)
-        else:
-            aug_pipeline = A.Compose([selected_aug])
-            augmented = aug_pipeline(image=image)
+        entry = self._snapshots.get(path)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
         
-        augmented_images.append(augmented['image'])
+        # Slow path: only one thread loads, the others wait and reuse its snapshot
+        with self._load_lock:
+            entry = self._snapshots.get(path)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+            if entry is not None and entry[0][0] == signature[0]:
+                # Same gallery file, only new delta records
+                gallery = apply_gallery_deltas(entry[1], read_gallery_deltas(path, entry[1].delta_seq))
+            else:
+                gallery = load_gallery(path, verify=False, mmap=self.mmap)
+            self._snapshots[path] = (signature, gallery)
+            return gallery
     
-    return augmented_images
+    def version(self, path):
+        """Version token of a gallery (changes whenever its file or delta log changes), None if missing"""
+        try:
+            return self._signature(path)
+        except FileNotFoundError:
+            return None
+    
+    def publish(self, path, gallery):
+        """Swap in a gallery that this process has just written to path"""
+        try:
+            self._snapshots[path] = (self._signature(path), gallery)
+        except FileNotFoundError:
+            self._snapshots.pop(path, None)
+    
+    def invalidate(self, path):
+        self._snapshots.pop(path, None)
 
-def load_model(model_path):
-    """Load LightCNN model with correct architecture"""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using {device} for computation")
+# Galleries loaded by this process
+gallery_cache = GalleryCache()
+
+def merge_galleries(galleries):
+    """
+    Combine several galleries into one
     
-    # Initialize model with arbitrary number of classes (we only need embeddings)
-    model = LightCNN_29Layers_v2(num_classes=100)
+    When an identity appears in more than one gallery the last one wins, like dict.update().
+    """
+    galleries = [gallery for gallery in galleries if len(gallery)]
+    if not galleries:
+        return Gallery([], np.zeros((0, 0), dtype=np.float32))
+    if len(galleries) == 1:
+        return galleries[0]
     
-    # Load checkpoint
-    checkpoint = torch.load(model_path, map_location=device)
+    # Galleries without a fingerprint (built from raw embeddings) are assumed to match the others
+    fingerprints = {gallery.model_fingerprint for gallery in galleries if gallery.model_fingerprint}
+    if len(fingerprints) > 1:
+        print(f"Warning: merging galleries built with different models: {sorted(fingerprints)}")
     
-    # Filter out the fc2 layer parameters to avoid dimension mismatch
-    if 'state_dict' in checkpoint:
-        # Remove "module." prefix and fc2 layer parameters
-        new_state_dict = {}
-        for k, v in checkpoint["state_dict"].items():
-            # Skip fc2 layer parameters
-            if 'fc2' in k:
-                continue
-            # Remove module prefix if present
-            new_k = k.replace("module.", "")
-            new_state_dict[new_k] = v
+    identities = [identity for gallery in galleries for identity in gallery.identities]
+    
+    # Members sharing a storage dtype are merged without dequantising them
+    scales = None
+    if len({gallery.dtype for gallery in galleries}) == 1:
+        embeddings = np.concatenate([gallery.embeddings for gallery in galleries])
+        if galleries[0].scales is not None:
+            scales = np.concatenate([gallery.scales for gallery in galleries])
     else:
-        # Direct state dict without 'state_dict' key
-        new_state_dict = {}
-        for k, v in checkpoint.items():
-            if 'fc2' in k:
-                continue
-            new_k = k.replace("module.", "")
-            new_state_dict[new_k] = v
+        embeddings = np.concatenate([gallery.matrix() for gallery in galleries])
+    norms = np.concatenate([gallery.norms for gallery in galleries])
+    counts = np.concatenate([gallery.counts for gallery in galleries])
+    sq_norm_sums = np.concatenate([gallery.sq_norm_sums for gallery in galleries])
     
-    # Load the filtered state dict
-    model.load_state_dict(new_state_dict, strict=False)
+    # Combine the members' ANN indexes by concatenating their centroids; rows of members
+    # without an index go to their nearest centroid. No re-clustering is needed.
+    indexed = [gallery for gallery in galleries if gallery.ann_index is not None]
+    centroids = assignments = None
+    if indexed and len(identities) >= ANN_MIN_IDENTITIES:
+        centroids = np.concatenate([gallery.ann_index.centroids for gallery in indexed])
+        parts = []
+        offset = 0
+        for gallery in galleries:
+            if gallery.ann_index is not None:
+                parts.append(gallery.ann_index.assignments + offset)
+                offset += gallery.ann_index.nlist
+            else:
+                parts.append(IVFIndex._nearest(gallery.matrix(), centroids))
+        assignments = np.concatenate(parts)
     
-    model = model.to(device)
-    model.eval()
-    return model, device
+    last_position = {identity: i for i, identity in enumerate(identities)}
+    if len(last_position) < len(identities):
+        keep = np.array(sorted(last_position.values()))
+        identities = [identities[i] for i in keep]
+        embeddings = embeddings[keep]
+        norms = norms[keep]
+        counts = counts[keep]
+        sq_norm_sums = sq_norm_sums[keep]
+        if scales is not None:
+            scales = scales[keep]
+        if assignments is not None:
+            assignments = assignments[keep]
+    
+    fingerprint = fingerprints.pop() if len(fingerprints) == 1 else None
+    merged = Gallery(identities, embeddings, norms, model_fingerprint=fingerprint,
+                     counts=counts, sq_norm_sums=sq_norm_sums, scales=scales)
+    if assignments is not None:
+        merged.ann_index = IVFIndex(centroids, assignments)
+    
+    # Keep the PCA setting the members agree on; the projection itself is refitted when saved
+    pca_dims = {gallery.pca_dim for gallery in galleries}
+    if len(pca_dims) == 1:
+        merged.pca_dim = pca_dims.pop()
+    return merged
 
-def extract_embedding(model, img_path, device):
-    """Extract a face embedding from an image using LightCNN"""
-    try:
-        # Load and transform image
-        img = Image.open(img_path).convert('L')  # Convert to grayscale
-        img_tensor = transform(img).unsqueeze(0).to(device)
+class GalleryUnionCache:
+    """
+    Cache of merged galleries for gallery combinations that are requested often
+    
+    Every lookup counts the combination; once one has been requested min_requests times
+    its merged gallery (one contiguous, normalised float32 matrix) is kept until any of
+    its member snapshots in the GalleryCache is replaced. Member snapshots are compared
+    by identity, so a changed gallery file or delta log invalidates the union for free.
+    At most max_entries unions are kept, least recently used first out.
+    
+    A cached union with at least ANN_MIN_IDENTITIES identities gets an ANN index over
+    the whole union (unless its members' indexes were combined), so campus-wide lookups
+    over many small galleries are searched approximately like one large gallery.
+    """
+    
+    def __init__(self, cache=None, min_requests=2, max_entries=16):
+        self.cache = cache
+        self.min_requests = min_requests
+        self.max_entries = max_entries
+        self._requests = Counter()
+        self._unions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, paths):
+        """Get the merged gallery for the given gallery paths (in merge order)"""
+        cache = self.cache or gallery_cache
+        key = tuple(paths)
+        members = []
+        for path in key:
+            try:
+                gallery = cache.get(path)
+            except Exception as e:
+                print(f"Error loading gallery {path}: {e}")
+                gallery = None
+            members.append(gallery)
+        members = tuple(members)
+        loaded = [gallery for gallery in members if gallery is not None]
+        if len(loaded) < 2:
+            return merge_galleries(loaded)
         
-        # Extract embedding
-        with torch.no_grad():
-            # LightCNN returns a tuple (output, features)
-            _, embedding = model(img_tensor)
-            return embedding.cpu().squeeze().numpy()
-    except Exception as e:
-        print(f"Error processing {img_path}: {e}")
+        with self._lock:
+            self._requests[key] += 1
+            frequent = self._requests[key] >= self.min_requests
+            entry = self._unions.get(key)
+            if entry is not None and len(entry[0]) == len(members) and all(a is b for a, b in zip(entry[0], members)):
+                self._unions.move_to_end(key)
+                return entry[1]
+        
+        merged = merge_galleries(loaded)
+        if frequent:
+            if (merged.ann_index is None and len(merged) >= ANN_MIN_IDENTITIES
+                    and not any(merged is gallery for gallery in loaded)):
+                merged.build_ann_index()
+            with self._lock:
+                self._unions[key] = (members, merged)
+                self._unions.move_to_end(key)
+                while len(self._unions) > self.max_entries:
+                    self._unions.popitem(last=False)
+        return merged
+    
+    def stats(self):
+        """Most requested combinations and whether their union is currently cached"""
+        with self._lock:
+            return [{"galleries": list(key), "requests": n, "cached": key in self._unions}
+                    for key, n in self._requests.most_common(self.max_entries)]
+
+class GalleryNameIndex:
+    """
+    Maps gallery names as sent by clients to gallery files in a directory
+    
+    The directory listing is cached and only re-read when the directory's mtime changes
+    (galleries are created, deleted or atomically replaced). A name resolves to the file
+    of the same name, the name with ".pth" appended, or the name with a "gallery_" prefix.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._entry = (None, frozenset())
+    
+    def _files(self, refresh=False):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return frozenset()
+        entry = self._entry
+        if refresh or entry[0] != mtime:
+            entry = (mtime, frozenset(os.listdir(self.directory)))
+            self._entry = entry
+        return entry[1]
+    
+    def names(self):
+        """Sorted names of all gallery files"""
+        return sorted(f for f in self._files() if f.endswith(".pth"))
+    
+    def resolve(self, name):
+        """Path of the gallery file for a name, or None if there is none"""
+        name = name.strip()
+        candidates = (name, name if name.endswith(".pth") else f"{name}.pth", f"gallery_{name}")
+        files = self._files()
+        if not any(candidate in files for candidate in candidates):
+            # The mtime may not have ticked for a file created just now
+            files = self._files(refresh=True)
+        for candidate in candidates:
+            if candidate in files:
+                return os.path.join(self.directory, candidate)
         return None
 
+def _quantized_scores(gallery, queries, rows=None):
+    """
+    Coarse scores of normalised queries against a float16 or int8 gallery
+    
+    The stored matrix is read GALLERY_MATCH_CHUNK rows at a time and each block is
+    converted into the same float32 buffer, whose product with the queries is written
+    straight into the result, so matching reads 2 or 1 bytes per value from memory and
+    allocates nothing per block. For int8 galleries the queries are quantised too: the
+    block product is then a sum of small integers (exact in float32) that is rescaled
+    by both scales. A float32 product is used because NumPy has no fast integer or
+    float16 matrix product; both run far slower than the float32 BLAS one.
+    
+    Args:
+        gallery: float16 or int8 Gallery
+        queries: (M, D) normalised float32 queries
+        rows: Optional row indices to score (default: all rows)
+    
+    Returns:
+        (M, len(rows)) float32 scores
+    """
+    scales = gallery.scales
+    if scales is not None:
+        queries, query_scales = quantize_int8(queries)
+        queries = queries.astype(np.float32)
+    
+    n = len(gallery) if rows is None else len(rows)
+    scores = np.empty((len(queries), n), dtype=np.float32)
+    buffer = np.empty((min(n, GALLERY_MATCH_CHUNK), gallery.dim), dtype=np.float32)
+    for start in range(0, n, GALLERY_MATCH_CHUNK):
+        block_rows = slice(start, start + GALLERY_MATCH_CHUNK) if rows is None else rows[start:start + GALLERY_MATCH_CHUNK]
+        stored = gallery.embeddings[block_rows]
+        block = buffer[:len(stored)]
+        np.copyto(block, stored)
+        out = scores[:, start:start + len(stored)]
+        np.matmul(queries, block.T, out=out)
+        if scales is not None:
+            out *= scales[block_rows][None, :]
+    if scales is not None:
+        scores *= query_scales[:, None]
+    return scores
+
+def _rerank_int8(gallery, query, rows, coarse, threshold, top_k):
+    """
+    Re-score the candidates of an int8 match with the float32 query
+    
+    Quantising the query changes any score by at most |q - q_int8| * max |row|, so every
+    row whose coarse score is within that bound of the threshold (or of the k-th best
+    coarse score) is re-scored against the dequantised rows; the others can't match.
+    """
+    q, q_scale = quantize_int8(query)
+    error = float(np.linalg.norm(query - q[0] * q_scale[0]))
+    bound = error * (1.0 + 0.5 * np.sqrt(gallery.dim) * float(gallery.scales.max()))
+    floor = threshold - bound
+    if top_k is not None and len(coarse) > top_k:
+        floor = max(floor, float(np.partition(coarse, -top_k)[-top_k]) - 2 * bound)
+    rows = rows[coarse >= floor]
+    exact = (gallery.embeddings[rows].astype(np.float32) * gallery.scales[rows][:, None]) @ query
+    return rows, exact
+
+def match_embeddings(gallery, embeddings, threshold=0.45, top_k=None, nprobe=None, exact=False, candidates=None):
+    """
+    Match face embeddings against a gallery using cosine similarity
+    
+    Galleries with at least ANN_MIN_IDENTITIES identities and an ANN index are searched
+    approximately: only the rows in the nprobe inverted lists nearest to each query are
+    scored. Smaller galleries are always searched exactly. Otherwise galleries with a PCA
+    index are matched coarse-to-fine: only the best candidates in the reduced space are
+    scored with the full vectors. float16 and int8 galleries are scored directly on the
+    stored matrix; int8 candidates near the threshold are re-ranked in float32.
+    
+    Args:
+        gallery: Gallery to search
+        embeddings: Query embeddings, a single vector or an (M, D) matrix
+        threshold: Minimum similarity for a match
+        top_k: Maximum number of matches to return per query (default: all above threshold)
+        nprobe: Inverted lists probed per query (default: ANN_DEFAULT_NPROBE)
+        exact: Force an exact search
+        candidates: Rows re-scored per query after PCA coarse matching (default: PCA_DEFAULT_CANDIDATES)
+    
+    Returns:
+        One list per query of (identity, similarity) tuples, best match first
+    """
+    queries = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    if not len(gallery):
+        return [[] for _ in range(len(queries))]
+    
+    query_norms = np.linalg.norm(queries, axis=1)
+    queries = queries / np.where(query_norms > 0, query_norms, 1.0)[:, None]
+    
+    full_precision = gallery.embeddings.dtype == np.float32
+    use_ann = not exact and gallery.ann_index is not None and len(gallery) >= ANN_MIN_IDENTITIES
+    use_pca = not exact and not use_ann and gallery.pca_index is not None
+    if use_ann or use_pca:
+        rows_scores = []
+        for query in queries:
+            if use_ann:
+                rows = gallery.ann_index.candidates(query, nprobe or ANN_DEFAULT_NPROBE)
+            else:
+                rows = gallery.pca_index.candidates(query, max(candidates or PCA_DEFAULT_CANDIDATES, top_k or 0))
+            if full_precision:
+                rows_scores.append((rows, gallery.embeddings[rows] @ query))
+            else:
+                rows_scores.append((rows, _quantized_scores(gallery, query[None, :], rows)[0]))
+    else:
+        all_rows = np.arange(len(gallery))
+        scores = queries @ gallery.embeddings.T if full_precision else _quantized_scores(gallery, queries)
+        rows_scores = [(all_rows, row) for row in scores]
+    
+    if gallery.scales is not None:
+        rows_scores = [_rerank_int8(gallery, query, rows, coarse, threshold, top_k)
+                       for query, (rows, coarse) in zip(queries, rows_scores)]
+    
+    results = []
+    for rows, scores in rows_scores:
+        candidates = np.nonzero(scores >= threshold)[0]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        if top_k is not None:
+            candidates = candidates[:top_k]
+        results.append([(gallery.identities[rows[i]], float(scores[i])) for i in candidates])
+    return results
+
+def pca_recall(gallery, dims=(32, 64, 128), candidates=PCA_DEFAULT_CANDIDATES, queries=1000, noise=0.5, seed=0):
+    """
+    Measure how often PCA coarse-to-fine matching finds the same best match as the exact search
+    
+    Queries are generated like in ann_recall(). A projection is fitted for every dimension.
+    
+    Returns:
+        {dim: recall@1}
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=min(queries, len(gallery)), replace=False)
+    matrix = gallery.matrix()
+    probes = matrix[rows] + rng.normal(scale=noise / np.sqrt(gallery.dim), size=(len(rows), gallery.dim))
+    probes = (probes / np.linalg.norm(probes, axis=1, keepdims=True)).astype(np.float32)
+    
+    expected = np.argmax(probes @ matrix.T, axis=1)
+    recall = {}
+    for dim in dims:
+        index = PCAIndex.build(matrix, dim)
+        found = 0
+        for probe, target in zip(probes, expected):
+            shortlist = index.candidates(probe, candidates)
+            found += shortlist[np.argmax(matrix[shortlist] @ probe)] == target
+        recall[dim] = found / len(rows)
+    return recall
+
+def ann_recall(gallery, nprobe_values=(1, 2, 4, 8, 16, 32), queries=1000, noise=0.5, seed=0):
+    """
+    Measure how often the ANN search finds the same best match as the exact search
+    
+    Queries are gallery embeddings perturbed with Gaussian noise (relative to the
+    embedding scale), which resembles a new photo of an enrolled person.
+    
+    Returns:
+        {nprobe: recall@1}
+    """
+    if gallery.ann_index is None:
+        gallery.build_ann_index()
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=min(queries, len(gallery)), replace=False)
+    matrix = gallery.matrix()
+    probes = matrix[rows] + rng.normal(scale=noise / np.sqrt(gallery.dim), size=(len(rows), gallery.dim))
+    
+    expected = [m[0][0] if m else None for m in match_embeddings(gallery, probes, -1.0, top_k=1, exact=True)]
+    recall = {}
+    for nprobe in nprobe_values:
+        found = 0
+        for probe, target in zip(probes, expected):
+            query = probe / np.linalg.norm(probe)
+            candidates = gallery.ann_index.candidates(query.astype(np.float32), nprobe)
+            best = candidates[np.argmax(matrix[candidates] @ query)]
+            found += gallery.identities[best] == target
+        recall[nprobe] = found / len(rows)
+    return recall
+
+def upgrade_gallery_file(gallery_path, model_path=None, dtype=None):
+    """Rewrite a gallery file of any known format as v2"""
+    gallery = load_gallery(gallery_path)
+    if gallery.model_fingerprint is None and model_path:
+        gallery.model_fingerprint = model_fingerprint(model_path)
+    save_gallery(gallery, gallery_path, dtype=dtype)
+    print(f"Upgraded {gallery_path} to gallery format v{GALLERY_FORMAT_VERSION} ({len(gallery)} identities)")
+    return gallery
+
 def create_gallery(model_path, data_dir, output_path, augment_ratio=0.0, augs_per_image=3):
     """Create a face recognition gallery from preprocessed face images"""
     # Load model
@@ -171,6 +2006,7 @@ def create_gallery(model_path, data_dir, output_path, augment_ratio=0.0, augs_pe
     
     # Create gallery dictionary
     gallery = {}
+    stats = {}
     
     # Process each identity folder
     identities = [d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d))]
@@ -188,49 +2024,22 @@ def create_gallery(model_path, data_dir, output_path, augment_ratio=0.0, augs_pe
             continue
         
         # Extract embeddings for all images
-        embeddings = []
-        for img_file in image_files:
-            img_path = os.path.join(identity_dir, img_file)
-            embedding = extract_embedding(model, img_path, device)
-            if embedding is not None:
-                embeddings.append(embedding)
-                
-                # Apply augmentation if specified
-                if augment_ratio > 0 and random.random() < augment_ratio:
-                    try:
-                        # Load original image as numpy array for augmentation
-                        img = cv2.imread(img_path)
-                        if img is not None:
-                            # Generate augmented versions
-                            augmented_images = augment_face_image(img, augs_per_image)
-                            
-                            # Extract embeddings from augmented images
-                            for aug_img in augmented_images:
-                                # Convert numpy array to PIL Image
-                                aug_pil = Image.fromarray(cv2.cvtColor(aug_img, cv2.COLOR_BGR2GRAY))
-                                
-                                # Transform and extract embedding
-                                aug_tensor = transform(aug_pil).unsqueeze(0).to(device)
-                                with torch.no_grad():
-                                    _, aug_embedding = model(aug_tensor)
-                                    aug_embedding = aug_embedding.cpu().squeeze().numpy()
-                                    embeddings.append(aug_embedding)
-                    except Exception as e:
-                        print(f"Warning: Failed to augment {img_path}: {e}")
-                        continue
+        image_paths = [os.path.join(identity_dir, img_file) for img_file in image_files]
+        embeddings = embed_identity_images(model, device, image_paths, augment_ratio, augs_per_image)
         
         if not embeddings:
             print(f"Warning: No valid embeddings extracted for {identity}")
             continue
         
-        # Average embeddings to get a single representation
+        # Average embeddings to get a single representation, keeping the running statistics
         avg_embedding = np.mean(embeddings, axis=0)
+        stats[identity] = (len(embeddings), float(sum(np.sum(np.square(e)) for e in embeddings)))
         gallery[identity] = avg_embedding
     
     print(f"Gallery created with {len(gallery)} identities")
     
     # Save gallery
-    torch.save(gallery, output_path)
+    save_gallery(Gallery.from_dict(gallery, model_fingerprint(model_path), stats), output_path)
     print(f"Gallery saved to {output_path}")
     return gallery
 
@@ -240,24 +2049,16 @@ def update_gallery(model_path, gallery_path, new_data_dir, output_path=None, aug
         output_path = gallery_path
         
     # Load existing gallery
-    existing_gallery = {}
+    existing_gallery = Gallery.from_dict({})
     if os.path.exists(gallery_path):
         try:
-            gallery_data = torch.load(gallery_path)
-            
-            # Handle both the old format (dict of embeddings) and new format (separate lists)
-            if isinstance(gallery_data, dict) and "identities" in gallery_data:
-                identities = gallery_data["identities"]
-                embeddings = gallery_data["embeddings"]
-                for i, identity in enumerate(identities):
-                    existing_gallery[identity] = embeddings[i]
-            else:
-                existing_gallery = gallery_data
-                
+            existing_gallery = load_gallery(gallery_path)
+            if existing_gallery.model_fingerprint not in (None, model_fingerprint(model_path)):
+                print(f"Warning: {gallery_path} was built with a different model ({existing_gallery.model_fingerprint})")
             print(f"Loaded existing gallery with {len(existing_gallery)} identities")
         except Exception as e:
             print(f"Error loading existing gallery: {e}")
-            existing_gallery = {}
+            existing_gallery = Gallery.from_dict({})
     else:
         print("No existing gallery found, creating new one")
     
@@ -268,8 +2069,9 @@ def update_gallery(model_path, gallery_path, new_data_dir, output_path=None, aug
     identities = [d for d in os.listdir(new_data_dir) if os.path.isdir(os.path.join(new_data_dir, d))]
     print(f"Found {len(identities)} new identities to process")
     
-    # Create updated gallery
-    updated_gallery = existing_gallery.copy()
+    # Embeddings of the new identities
+    new_gallery = {}
+    stats = {}
     
     for identity in tqdm(identities, desc="Processing new identities"):
         identity_dir = os.path.join(new_data_dir, identity)
@@ -283,65 +2085,146 @@ def update_gallery(model_path, gallery_path, new_data_dir, output_path=None, aug
             continue
         
         # Extract embeddings for all images
-        embeddings = []
-        for img_file in image_files:
-            img_path = os.path.join(identity_dir, img_file)
-            embedding = extract_embedding(model, img_path, device)
-            if embedding is not None:
-                embeddings.append(embedding)
-                
-                # Apply augmentation if specified
-                if augment_ratio > 0 and random.random() < augment_ratio:
-                    try:
-                        # Load original image as numpy array for augmentation
-                        img = cv2.imread(img_path)
-                        if img is not None:
-                            # Generate augmented versions
-                            augmented_images = augment_face_image(img, augs_per_image)
-                            
-                            # Extract embeddings from augmented images
-                            for aug_img in augmented_images:
-                                # Convert numpy array to PIL Image
-                                aug_pil = Image.fromarray(cv2.cvtColor(aug_img, cv2.COLOR_BGR2GRAY))
-                                
-                                # Transform and extract embedding
-                                aug_tensor = transform(aug_pil).unsqueeze(0).to(device)
-                                with torch.no_grad():
-                                    _, aug_embedding = model(aug_tensor)
-                                    aug_embedding = aug_embedding.cpu().squeeze().numpy()
-                                    embeddings.append(aug_embedding)
-                    except Exception as e:
-                        print(f"Warning: Failed to augment {img_path}: {e}")
-                        continue
+        image_paths = [os.path.join(identity_dir, img_file) for img_file in image_files]
+        embeddings = embed_identity_images(model, device, image_paths, augment_ratio, augs_per_image)
         
         if not embeddings:
             print(f"Warning: No valid embeddings extracted for {identity}")
             continue
         
-        # Average embeddings to get a single representation
+        # Average embeddings to get a single representation, keeping the running statistics
         avg_embedding = np.mean(embeddings, axis=0)
-        updated_gallery[identity] = avg_embedding
+        stats[identity] = (len(embeddings), float(sum(np.sum(np.square(e)) for e in embeddings)))
+        new_gallery[identity] = avg_embedding
     
-    # Create directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    # Save updated gallery with identities and embeddings separately
-    serializable_gallery = {
-        "identities": list(updated_gallery.keys()),
-        "embeddings": [updated_gallery[identity] for identity in updated_gallery.keys()]
-    }
+    # New identities replace existing ones with the same name; the others keep their statistics
+    updated_gallery = merge_galleries([existing_gallery,
+                                       Gallery.from_dict(new_gallery, model_fingerprint(model_path), stats)])
     
     # Save updated gallery
-    torch.save(serializable_gallery, output_path)
+    save_gallery(updated_gallery, output_path)
     print(f"Updated gallery saved to {output_path}")
     print(f"Gallery now contains {len(updated_gallery)} identities")
-    return updated_gallery
+    return updated_gallery.to_dict()
+
+def append_identity_images(model_path, gallery_path, identity, image_paths, augment_ratio=0.0, augs_per_image=3,
+                           model=None, device=None, inference=None):
+    """
+    Fold new face images into an identity without re-embedding its existing images
+    
+    Only the new images are embedded; they are added to the identity's running statistics.
+    The identity is created if it isn't in the gallery yet.
+    
+    Args:
+        model_path: Path to the LightCNN model file
+        gallery_path: Path to the gallery file (created if missing)
+        identity: Identity to update
+        image_paths: Paths of preprocessed face images of the identity
+        augment_ratio: Ratio of images to augment (0.0 to 1.0)
+        augs_per_image: Number of augmentations per selected image
+        model: Pre-loaded model (optional)
+        device: Pre-loaded device (optional)
+        inference: Inference client to embed with instead of a model (optional)
+    
+    Returns:
+        Statistics of the updated identity, or None if no embedding could be extracted
+    """
+    if inference is None and (model is None or device is None):
+        model, device = load_model(model_path)
+    
+    embeddings = embed_identity_images(model, device, image_paths, augment_ratio, augs_per_image, inference)
+    if not embeddings:
+        print(f"Warning: No valid embeddings extracted for {identity}")
+        return None
+    
+    samples = np.asarray(embeddings, dtype=np.float64)
+    if os.path.exists(gallery_path):
+        gallery = update_gallery_identities(gallery_path, {
+            "op": "fold",
+            "identity": identity,
+            "sum": samples.sum(axis=0).tolist(),
+            "count": len(samples),
+            "sq_norm_sum": float((samples ** 2).sum())
+        })
+    else:
+        gallery = Gallery.from_dict({}, model_fingerprint(model_path))
+        gallery.fold_in(identity, samples)
+        save_gallery(gallery, gallery_path)
+    
+    stats = gallery.identity_stats(identity)
+    print(f"Added {len(embeddings)} embeddings to {identity} ({stats['count']} in total)")
+    return stats
+
+def remove_identity_images(model_path, gallery_path, identity, image_paths, model=None, device=None):
+    """
+    Take the contribution of specific face images back out of an identity
+    
+    Only un-augmented contributions can be removed this way, since augmentations are random.
+    The identity is removed from the gallery once no samples remain.
+    
+    Returns:
+        Statistics of the updated identity, or None if it was removed
+    """
+    if model is None or device is None:
+        model, device = load_model(model_path)
+    
+    embeddings = [e for e in (extract_embedding(model, img_path, device) for img_path in image_paths) if e is not None]
+    if not embeddings:
+        raise ValueError("No valid embeddings extracted from the given images")
+    
+    samples = np.asarray(embeddings, dtype=np.float64)
+    gallery = update_gallery_identities(gallery_path, {
+        "op": "unfold",
+        "identity": identity,
+        "sum": samples.sum(axis=0).tolist(),
+        "count": len(samples),
+        "sq_norm_sum": float((samples ** 2).sum())
+    })
+    return gallery.identity_stats(identity) if identity in gallery else None
+
+def add_identity(model_path, gallery_path, identity, image_paths, augment_ratio=0.0, augs_per_image=3,
+                 model=None, device=None, inference=None):
+    """
+    Add an identity to a gallery (or replace it) from its face images, without a rebuild
+    
+    The images are embedded with model/device, loaded from model_path if not given, or
+    on the inference processes through an inference client.
+    
+    Returns:
+        Statistics of the added identity, or None if no embedding could be extracted
+    """
+    if inference is None and (model is None or device is None):
+        model, device = load_model(model_path)
+    
+    embeddings = embed_identity_images(model, device, image_paths, augment_ratio, augs_per_image, inference)
+    if not embeddings:
+        print(f"Warning: No valid embeddings extracted for {identity}")
+        return None
+    
+    samples = np.asarray(embeddings, dtype=np.float64)
+    gallery = update_gallery_identities(gallery_path, {
+        "op": "add",
+        "identity": identity,
+        "embedding": samples.mean(axis=0).tolist(),
+        "count": len(samples),
+        "sq_norm_sum": float((samples ** 2).sum())
+    })
+    return gallery.identity_stats(identity)
+
+def remove_identity(gallery_path, identity):
+    """Remove an identity from a gallery without a rebuild"""
+    return update_gallery_identities(gallery_path, {"op": "remove", "identity": identity})
 
-def test_gallery(model_path, gallery_path, image_path, threshold=0.45, yolo_path=None, output_path=None):
-    """Test gallery recognition on a single image"""
+def rename_identity(gallery_path, identity, new_identity):
+    """Rename an identity in a gallery without a rebuild"""
+    return update_gallery_identities(gallery_path, {"op": "rename", "identity": identity,
+                                                    "new_identity": new_identity})
+
+def test_gallery(model_path, gallery_path, image_path, threshold=0.45, yolo_path=None, output_path=None, tile_size=None):
+    """Test gallery recognition on a single image (tile_size enables tiled detection for large images)"""
     # Load model and gallery
     model, device = load_model(model_path)
-    gallery = torch.load(gallery_path)
+    gallery = load_gallery(gallery_path)
     print(f"Loaded gallery with {len(gallery)} identities")
     
     # Load YOLO for face detection if provided
@@ -360,23 +2243,8 @@ def test_gallery(model_path, gallery_path, image_path, threshold=0.45, yolo_path
     
     # Extract faces using YOLO if available
     if yolo_model:
-        results = yolo_model(img)
-        for result in results:
-            for box in result.boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                # Add padding around face
-                h, w = img.shape[:2]
-                face_w = x2 - x1
-                face_h = y2 - y1
-                pad_x = int(face_w * 0.2)
-                pad_y = int(face_h * 0.2)
-                x1 = max(0, x1 - pad_x)
-                y1 = max(0, y1 - pad_y)
-                x2 = min(w, x2 + pad_x)
-                y2 = min(h, y2 + pad_y)
-                
-                face = img[y1:y2, x1:x2]
-                faces.append((face, (x1, y1, x2, y2)))
+        faces = [(face, coords) for coords, face in
+                 detect_faces(yolo_model, img, conf=0.25, min_size=1, tile_size=tile_size)]
     else:
         # If no YOLO, use whole image as face
         faces.append((img, (0, 0, img.shape[1], img.shape[0])))
@@ -391,21 +2259,11 @@ def test_gallery(model_path, gallery_path, image_path, threshold=0.45, yolo_path
         face_tensor = transform(face_pil).unsqueeze(0).to(device)
         
         # Extract embedding
-        with torch.no_grad():
-            _, embedding = model(face_tensor)
-            face_embedding = embedding.cpu().squeeze().numpy()
-        
-        # Find all potential matches above threshold
-        matches = []
-        for identity, gallery_embedding in gallery.items():
-            # Calculate cosine similarity (1 - cosine distance)
-            similarity = 1 - cosine(face_embedding, gallery_embedding)
-            
-            if similarity > threshold:
-                matches.append((identity, similarity))
+        embedding = model.embed(face_tensor)
+        face_embedding = embedding.cpu().squeeze().numpy()
         
-        # Sort matches by confidence (highest first)
-        matches.sort(key=lambda x: x[1], reverse=True)
+        # Find all potential matches above threshold, sorted by confidence (highest first)
+        matches = match_embeddings(gallery, face_embedding, threshold)[0]
         face_matches.append((i, coords, matches))
     
     # Sort all face matches by best confidence score (highest first)
@@ -454,14 +2312,14 @@ def test_gallery(model_path, gallery_path, image_path, threshold=0.45, yolo_path
     
     return result_img, detected_identities
 
-def test_gallery_batch(model_path, gallery_path, test_dir, output_dir, threshold=0.45, yolo_path=None):
-    """Test gallery recognition on all images in a directory"""
+def test_gallery_batch(model_path, gallery_path, test_dir, output_dir, threshold=0.45, yolo_path=None, tile_size=None):
+    """Test gallery recognition on all images in a directory (tile_size enables tiled detection for large images)"""
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     
     # Load model and gallery only once for efficiency
     model, device = load_model(model_path)
-    gallery = torch.load(gallery_path)
+    gallery = load_gallery(gallery_path)
     print(f"Loaded gallery with {len(gallery)} identities")
     
     # Load YOLO for face detection if provided
@@ -505,23 +2363,8 @@ def test_gallery_batch(model_path, gallery_path, test_dir, output_dir, threshold
         
         # Extract faces using YOLO if available
         if yolo_model:
-            results = yolo_model(img)
-            for result in results:
-                for box in result.boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    # Add padding around face
-                    h, w = img.shape[:2]
-                    face_w = x2 - x1
-                    face_h = y2 - y1
-                    pad_x = int(face_w * 0.2)
-                    pad_y = int(face_h * 0.2)
-                    x1 = max(0, x1 - pad_x)
-                    y1 = max(0, y1 - pad_y)
-                    x2 = min(w, x2 + pad_x)
-                    y2 = min(h, y2 + pad_y)
-                    
-                    face = img[y1:y2, x1:x2]
-                    faces.append((face, (x1, y1, x2, y2)))
+            faces = [(face, coords) for coords, face in
+                     detect_faces(yolo_model, img, conf=0.25, min_size=1, tile_size=tile_size)]
         else:
             # If no YOLO, use whole image as face
             faces.append((img, (0, 0, img.shape[1], img.shape[0])))
@@ -530,32 +2373,13 @@ def test_gallery_batch(model_path, gallery_path, test_dir, output_dir, threshold
         results_summary['Filename'].append(base_name)
         results_summary['Detected_Faces'].append(len(faces))
         
-        # Process each face - first get all potential matches
+        # Embed all faces of the image in one batch, then get all potential matches of each
+        # (above threshold, sorted by confidence, highest first)
         face_matches = []
-        for i, (face, coords) in enumerate(faces):
-            # Convert BGR to grayscale PIL image
-            face_pil = Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY))
-            
-            # Get face tensor
-            face_tensor = transform(face_pil).unsqueeze(0).to(device)
-            
-            # Extract embedding
-            with torch.no_grad():
-                _, embedding = model(face_tensor)
-                face_embedding = embedding.cpu().squeeze().numpy()
-            
-            # Find all potential matches above threshold
-            matches = []
-            for identity, gallery_embedding in gallery.items():
-                # Calculate cosine similarity (1 - cosine distance)
-                similarity = 1 - cosine(face_embedding, gallery_embedding)
-                
-                if similarity > threshold:
-                    matches.append((identity, similarity))
-            
-            # Sort matches by confidence (highest first)
-            matches.sort(key=lambda x: x[1], reverse=True)
-            face_matches.append((i, coords, matches))
+        if faces:
+            embeddings = embed_face_images(model, device, [face for face, _ in faces])
+            all_matches = match_embeddings(gallery, embeddings, threshold)
+            face_matches = [(i, coords, matches) for i, ((_, coords), matches) in enumerate(zip(faces, all_matches))]
         
         # Sort all face matches by best confidence score (highest first)
         face_matches.sort(key=lambda x: x[2][0][1] if x[2] else 0, reverse=True)
@@ -610,11 +2434,8 @@ def test_gallery_batch(model_path, gallery_path, test_dir, output_dir, threshold
 def create_gallery_from_embeddings(gallery_path, embeddings_dict):
     """Create a gallery from a dictionary of embeddings"""
     try:
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(gallery_path), exist_ok=True)
-        
-        # Save embeddings dictionary directly
-        torch.save(embeddings_dict, gallery_path)
+        # Save embeddings dictionary as a v2 gallery
+        save_gallery(embeddings_dict, gallery_path)
         print(f"Gallery created at {gallery_path} with {len(embeddings_dict)} identities")
         return embeddings_dict
     except Exception as e:
@@ -625,58 +2446,279 @@ def update_gallery_from_embeddings(gallery_path, new_embeddings_dict):
     """Update an existing gallery with new embeddings"""
     try:
         # Load existing gallery if it exists
-        existing_gallery = {}
+        existing_gallery = Gallery.from_dict({})
         if os.path.exists(gallery_path):
             try:
-                gallery_data = torch.load(gallery_path)
-                
-                # Handle both the old format (dict of embeddings) and new format (separate lists)
-                if isinstance(gallery_data, dict) and "identities" in gallery_data:
-                    identities = gallery_data["identities"]
-                    embeddings = gallery_data["embeddings"]
-                    for i, identity in enumerate(identities):
-                        existing_gallery[identity] = embeddings[i]
-                else:
-                    existing_gallery = gallery_data
-                    
+                existing_gallery = load_gallery(gallery_path)
                 print(f"Loaded existing gallery with {len(existing_gallery)} identities")
             except Exception as e:
                 print(f"Error loading existing gallery: {e}")
-                existing_gallery = {}
+                existing_gallery = Gallery.from_dict({})
         else:
             print("No existing gallery found, creating new one")
         
         # Merge with new embeddings
-        updated_gallery = existing_gallery.copy()
-        updated_gallery.update(new_embeddings_dict)
-        
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(gallery_path), exist_ok=True)
+        updated_gallery = merge_galleries([existing_gallery, Gallery.from_dict(new_embeddings_dict)])
         
         # Save updated gallery
-        torch.save(updated_gallery, gallery_path)
+        save_gallery(updated_gallery, gallery_path)
         print(f"Updated gallery saved to {gallery_path}")
         print(f"Gallery now contains {len(updated_gallery)} identities")
-        return updated_gallery
+        return updated_gallery.to_dict()
         
     except Exception as e:
         print(f"Error updating gallery from embeddings: {e}")
         return None
 
+def _count_identity_dirs(data_dir):
+    """Count identity folders in a data directory (used to schedule big galleries first)"""
+    if not os.path.isdir(data_dir):
+        return 0
+    return sum(1 for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+
+def _limit_process(threads, nice=None, cpu_set=None):
+    """Limit the current (pool worker) process's torch/OpenCV threads, priority and CPUs"""
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    if nice is not None and hasattr(os, "setpriority"):
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+    if cpu_set and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_set)
+
+def _bulk_job(job):
+    _limit_process(job["threads"], job.get("nice"), job.get("cpu_set"))
+    return job["function"](*job["args"], **job["kwargs"])
+
+def run_bulk_job(function, *args, threads=1, nice=None, cpu_set=None, **kwargs):
+    """
+    Run function(*args, **kwargs) in a separate process with limited threads and priority
+    
+    Used for long jobs started by the server (gallery builds, face extraction), so they
+    can't take the CPU from recognition in the server process: torch's thread count is
+    per process, so it can't be capped for one thread of the server. function and its
+    arguments must be picklable (module-level functions).
+    
+    Args:
+        function: Module-level function to run
+        threads: Torch/OpenCV threads of the job process
+        nice: Niceness of the job process (None keeps the server's)
+        cpu_set: CPU ids to pin the job process to (optional)
+    
+    Returns:
+        The function's return value (exceptions are re-raised)
+    """
+    job = {"function": function, "args": args, "kwargs": kwargs,
+           "threads": threads, "nice": nice, "cpu_set": cpu_set}
+    # Spawn instead of fork: forking a process that already initialised torch's thread pools can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_bulk_job, job).result()
+
+def build_gallery_file(model_path, data_path, gallery_path, update_existing=False, augment_ratio=0.0,
+                       augs_per_image=3):
+    """
+    Create a gallery file, or update it if update_existing and it exists
+    
+    Returns:
+        Number of identities in the gallery (not the gallery itself, which is cheaper
+        to send back from a job process)
+    """
+    if update_existing and os.path.exists(gallery_path):
+        gallery = update_gallery(model_path, gallery_path, data_path, gallery_path,
+                                 augment_ratio=augment_ratio, augs_per_image=augs_per_image)
+    else:
+        gallery = create_gallery(model_path, data_path, gallery_path,
+                                 augment_ratio=augment_ratio, augs_per_image=augs_per_image)
+    return len(gallery) if gallery is not None else 0
+
+def _build_gallery_job(job):
+    """
+    Build a single gallery inside a pool worker process.
+    
+    The worker limits torch and OpenCV to its share of the global CPU budget so
+    that several galleries can be built side by side without oversubscription.
+    
+    Identities of the existing gallery without a data folder (e.g. added through the
+    identity API) are kept by updating the gallery instead of recreating it, as long as
+    it was built with the same model; otherwise they are dropped with a warning.
+    """
+    _limit_process(job["threads"], job.get("nice"), job.get("cpu_set"))
+    
+    start = time.time()
+    result = {
+        "year": job["year"],
+        "department": job["department"],
+        "gallery_path": job["gallery_path"],
+        "data_path": job["data_path"],
+        "identities_count": 0,
+        "seconds": 0.0,
+        "success": False,
+        "error": None,
+        "kept_identities": [],
+        "dropped_identities": []
+    }
+    try:
+        orphans = []
+        same_model = False
+        if os.path.exists(job["gallery_path"]):
+            existing = load_gallery(job["gallery_path"], verify=False)
+            orphans = [identity for identity in existing.identities
+                       if not os.path.isdir(os.path.join(job["data_path"], identity))]
+            same_model = existing.model_fingerprint in (None, model_fingerprint(job["model_path"]))
+        if orphans and same_model:
+            result["kept_identities"] = orphans
+        elif orphans:
+            print(f"Warning: rebuilding {job['gallery_path']} with a different model drops "
+                  f"{len(orphans)} identities without a data folder: {', '.join(orphans)}")
+            result["dropped_identities"] = orphans
+        result["identities_count"] = build_gallery_file(
+            job["model_path"], job["data_path"], job["gallery_path"], update_existing=bool(result["kept_identities"]),
+            augment_ratio=job["augment_ratio"], augs_per_image=job["augs_per_image"])
+        result["success"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = round(time.time() - start, 2)
+    return result
+
+def build_all_galleries(model_path, data_root, augment_ratio=0.0, augs_per_image=3,
+                        cpu_budget=None, max_workers=None, nice=None, cpu_set=None, progress=None):
+    """
+    Rebuild every registered (year, department) gallery on a process pool
+    
+    Galleries are taken from database.list_all_galleries(). The data directory of each
+    gallery is derived from its file name (e.g. galleries/CS_2026.pth -> data_root/CS_2026).
+    
+    Args:
+        model_path: Path to the LightCNN model file
+        data_root: Directory containing the per-gallery face data folders
+        augment_ratio: Ratio of images to augment (0.0 to 1.0)
+        augs_per_image: Number of augmentations per selected image
+        cpu_budget: Total number of cores the rebuild may use (default: all cores)
+        max_workers: Maximum number of galleries built concurrently (default: as many as the budget allows)
+        nice: Niceness of the build processes, to leave the CPU to latency-sensitive work (optional)
+        cpu_set: CPU ids to pin the build processes to (optional)
+        progress: Called with each gallery's result as soon as it is known (optional)
+    
+    Returns:
+        Dictionary with per-gallery results (including timings) and overall totals
+    """
+    import database
+    
+    cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+    
+    jobs = []
+    skipped = []
+    for entry in database.list_all_galleries():
+        gallery_path = entry["file_path"]
+        data_path = os.path.join(data_root, os.path.splitext(os.path.basename(gallery_path))[0])
+        if not os.path.isdir(data_path):
+            skipped.append({
+                "year": entry["year"],
+                "department": entry["department_name"],
+                "gallery_path": gallery_path,
+                "data_path": data_path,
+                "identities_count": 0,
+                "seconds": 0.0,
+                "success": False,
+                "error": f"No processed data found at {data_path}",
+                "kept_identities": [],
+                "dropped_identities": []
+            })
+            continue
+        jobs.append({
+            "year": entry["year"],
+            "department": entry["department_name"],
+            "gallery_path": gallery_path,
+            "data_path": data_path,
+            "model_path": model_path,
+            "augment_ratio": augment_ratio,
+            "augs_per_image": augs_per_image,
+            "nice": nice,
+            "cpu_set": cpu_set,
+            "size": _count_identity_dirs(data_path)
+        })
+    
+    results = list(skipped)
+    if progress is not None:
+        for result in skipped:
+            progress(result)
+    start = time.time()
+    
+    if jobs:
+        # Largest galleries first so the longest builds do not end up running alone at the end
+        jobs.sort(key=lambda job: job["size"], reverse=True)
+        
+        workers = min(len(jobs), max_workers or cpu_budget, cpu_budget)
+        threads = max(1, cpu_budget // workers)
+        for job in jobs:
+            job["threads"] = threads
+        print(f"Building {len(jobs)} galleries with {workers} workers x {threads} threads "
+              f"(CPU budget: {cpu_budget})")
+        
+        # Spawn instead of fork: forking a process that already initialised torch's thread pools can deadlock
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(_build_gallery_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {
+                        "year": job["year"],
+                        "department": job["department"],
+                        "gallery_path": job["gallery_path"],
+                        "data_path": job["data_path"],
+                        "identities_count": 0,
+                        "seconds": 0.0,
+                        "success": False,
+                        "error": str(e),
+                        "kept_identities": [],
+                        "dropped_identities": []
+                    }
+                if result["success"]:
+                    database.update_gallery_count(result["gallery_path"], result["identities_count"])
+                    print(f"Built {result['gallery_path']} ({result['identities_count']} identities) "
+                          f"in {result['seconds']:.1f}s")
+                else:
+                    print(f"Failed to build {result['gallery_path']}: {result['error']}")
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    
+    return {
+        "galleries": results,
+        "built": sum(1 for r in results if r["success"]),
+        "failed": sum(1 for r in results if not r["success"]),
+        "total_seconds": round(time.time() - start, 2),
+        "cpu_budget": cpu_budget
+    }
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Face gallery manager")
-    parser.add_argument("--mode", choices=["create", "update", "test", "batch_test"], required=True,
-                        help="Operation mode: create, update, test gallery, or batch test gallery")
+    parser.add_argument("--mode", choices=["create", "update", "test", "batch_test", "build_all", "upgrade", "append",
+                                           "remove_identity", "rename_identity", "compact", "ann_report", "pca",
+                                           "pca_report", "video", "slim"], required=True,
+                        help="Operation mode: create, update, test gallery, batch test gallery, rebuild all registered galleries, "
+                             "upgrade a gallery file to the current format, append images to / remove / rename one identity, "
+                             "compact pending identity changes into the gallery file, report ANN recall per nprobe, "
+                             "set the PCA coarse matching dimension of a gallery, report PCA recall per dimension, "
+                             "recognize and track the faces in a video file, "
+                             "or write the slim inference checkpoint of --model")
     parser.add_argument(
         "--model", 
         default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
                              "src", "checkpoints", "LightCNN_29Layers_V2_checkpoint.pth.tar"), 
         help="Path to the LightCNN model file"
     )
-    parser.add_argument("--gallery", required=True, help="Path to face gallery")
-    parser.add_argument("--data", help="Path to face data directory (for create/update)")
-    parser.add_argument("--output", help="Output path (for update/batch_test)")
+    parser.add_argument("--gallery", help="Path to face gallery (required for all modes except build_all)")
+    parser.add_argument("--data", help="Path to face data directory (for create/update, or the data root for build_all)")
+    parser.add_argument("--output", help="Output path (for update/batch_test/slim, or a JSON summary for video)")
     parser.add_argument("--image", help="Path to test image (for test)")
+    parser.add_argument("--video", help="Path to a video file (for video)")
+    parser.add_argument("--sample_fps", type=float, default=5.0, help="Frames per second analysed (for video, 0 = all)")
+    parser.add_argument("--tile_size", type=int,
+                        help="Detect faces in overlapping tiles of this size for large images (for test and batch_test)")
     parser.add_argument("--test_dir", help="Directory of test images (for batch_test)")
     parser.add_argument("--threshold", type=float, default=0.45, help="Similarity threshold")
     parser.add_argument(
@@ -685,10 +2727,121 @@ if __name__ == "__main__":
                              "src", "yolo", "weights", "yolo11n-face.pt"), 
         help="Path to YOLO face detection model"
     )
+    parser.add_argument("--augment_ratio", type=float, default=0.0, help="Ratio of images to augment (for build_all/append)")
+    parser.add_argument("--augs_per_image", type=int, default=3, help="Augmentations per selected image (for build_all/append)")
+    parser.add_argument("--cpus", type=int, help="Total CPU budget for build_all (default: all cores)")
+    parser.add_argument("--workers", type=int, help="Maximum galleries built concurrently (for build_all)")
+    parser.add_argument("--dtype", choices=GALLERY_DTYPES, help="Embedding storage dtype (for upgrade)")
+    parser.add_argument("--identity", help="Identity to update (for append/remove_identity/rename_identity)")
+    parser.add_argument("--new_identity", help="New identity name (for rename_identity)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                        help="nprobe values to evaluate (for ann_report)")
+    parser.add_argument("--pca_dim", type=int, nargs="+",
+                        help="PCA dimension to use (required for pca, 0 disables) or dimensions to evaluate "
+                             "(for pca_report, default: 32 64 128)")
+    parser.add_argument("--candidates", type=int, default=PCA_DEFAULT_CANDIDATES,
+                        help="Candidates re-scored with the full vectors (for pca_report)")
     
     args = parser.parse_args()
     
-    if args.mode == "create":
+    if args.mode not in ("build_all", "slim") and not args.gallery:
+        parser.error("--gallery is required for this mode")
+    
+    if args.mode == "slim":
+        if args.output and not args.output.endswith(".slim.pth"):
+            parser.error("--output for slim mode must end in .slim.pth, so it can be passed as --model")
+        convert_checkpoint(args.model, args.output)
+    
+    elif args.mode == "build_all":
+        data_root = args.data or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
+                                              "gallery", "data")
+        summary = build_all_galleries(args.model, data_root, args.augment_ratio, args.augs_per_image,
+                                      cpu_budget=args.cpus, max_workers=args.workers)
+        for r in sorted(summary["galleries"], key=lambda r: r["gallery_path"]):
+            status = f"{r['identities_count']} identities" if r["success"] else f"FAILED: {r['error']}"
+            print(f"{os.path.basename(r['gallery_path']):<30} {r['seconds']:>8.1f}s  {status}")
+        print(f"Built {summary['built']} galleries, {summary['failed']} failed, "
+              f"total {summary['total_seconds']:.1f}s")
+    
+    elif args.mode == "upgrade":
+        upgrade_gallery_file(args.gallery, args.model, args.dtype)
+    
+    elif args.mode == "append":
+        if not args.identity or not args.data:
+            print("Error: --identity and --data (a folder of face images) required for append mode")
+        else:
+            image_paths = [os.path.join(args.data, f) for f in sorted(os.listdir(args.data))
+                           if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))]
+            append_identity_images(args.model, args.gallery, args.identity, image_paths,
+                                   args.augment_ratio, args.augs_per_image)
+    
+    elif args.mode == "remove_identity":
+        if not args.identity:
+            print("Error: --identity required for remove_identity mode")
+        else:
+            gallery = remove_identity(args.gallery, args.identity)
+            print(f"Removed {args.identity}, gallery now contains {len(gallery)} identities")
+    
+    elif args.mode == "rename_identity":
+        if not args.identity or not args.new_identity:
+            print("Error: --identity and --new_identity required for rename_identity mode")
+        else:
+            rename_identity(args.gallery, args.identity, args.new_identity)
+            print(f"Renamed {args.identity} to {args.new_identity}")
+    
+    elif args.mode == "compact":
+        gallery, folded = compact_gallery(args.gallery)
+        print(f"Compacted {folded} pending changes, gallery contains {len(gallery)} identities")
+    
+    elif args.mode == "ann_report":
+        # --gallery may list several comma-separated galleries to evaluate their union
+        gallery = merge_galleries([load_gallery(path) for path in args.gallery.split(",")])
+        if gallery.ann_index is None:
+            print(f"Gallery has no ANN index, clustering {len(gallery)} identities")
+        for nprobe, recall in ann_recall(gallery, args.nprobe).items():
+            print(f"nprobe={nprobe:<4} recall@1={recall:.3f}")
+        if len(gallery) < ANN_MIN_IDENTITIES:
+            print(f"Note: galleries with fewer than {ANN_MIN_IDENTITIES} identities are always searched exactly")
+    
+    elif args.mode == "pca":
+        if not args.pca_dim or len(args.pca_dim) != 1:
+            print("Error: --pca_dim with a single dimension required for pca mode (0 disables)")
+        else:
+            gallery = set_gallery_pca_dim(args.gallery, args.pca_dim[0])
+            if gallery.pca_index is not None:
+                print(f"Gallery {args.gallery} now uses {gallery.pca_index.dim}-d PCA coarse matching")
+            elif gallery.pca_dim:
+                print(f"PCA dimension set to {gallery.pca_dim}; the index is built once the gallery has more identities")
+            else:
+                print(f"PCA coarse matching disabled for {args.gallery}")
+    
+    elif args.mode == "pca_report":
+        gallery = load_gallery(args.gallery)
+        for dim, recall in pca_recall(gallery, args.pca_dim or (32, 64, 128), args.candidates).items():
+            print(f"dim={dim:<4} candidates={args.candidates:<5} recall@1={recall:.3f}")
+    
+    elif args.mode == "video":
+        if not args.video:
+            print("Error: --video required for video mode")
+        else:
+            from face_tracker import recognize_video
+            
+            model, device = load_model(args.model)
+            gallery = merge_galleries([load_gallery(path) for path in args.gallery.split(",")])
+            summary = recognize_video(model, device, YOLO(args.yolo), gallery, args.video, args.threshold,
+                                      args.sample_fps, progress=True)
+            for track in summary["tracks"]:
+                print(f"Track {track['track_id']:>4}  {track['identity']:<25} {track['confidence']:.3f}  "
+                      f"{track['first_seen']:>8.1f}s - {track['last_seen']:>8.1f}s")
+            stats = summary["stats"]
+            print(f"{summary['frames']} frames ({summary['duration_seconds']}s of video) in "
+                  f"{summary['processing_seconds']}s, {summary['realtime_factor']}x real time; "
+                  f"embedded {stats['embeddings']} of {stats['faces_seen']} detected faces")
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(summary, f, indent=2)
+    
+    elif args.mode == "create":
         if not args.data:
             print("Error: --data required for create mode")
         else:
@@ -704,11 +2857,12 @@ if __name__ == "__main__":
         if not args.image:
             print("Error: --image required for test mode")
         else:
-            test_gallery(args.model, args.gallery, args.image, args.threshold, args.yolo)
+            test_gallery(args.model, args.gallery, args.image, args.threshold, args.yolo, tile_size=args.tile_size)
     
     elif args.mode == "batch_test":
         if not args.test_dir:
             print("Error: --test_dir required for batch_test mode")
         else:
             output_dir = args.output if args.output else "gallery_results"
-            test_gallery_batch(args.model, args.gallery, args.test_dir, output_dir, args.threshold, args.yolo)
\ No newline at end of file
+            test_gallery_batch(args.model, args.gallery, args.test_dir, output_dir, args.threshold, args.yolo,
+                               tile_size=args.tile_size)
\ No newline at end of file
@@ -0,0 +1,368 @@
+import os
+import stat
+import time
+import queue
+import atexit
+import secrets
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Listener, Client
+
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+from gallery_manager import DetectionROI, detect_faces, embed_face_images, load_model
+
+# Sockets live in a directory only this user can enter
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), f"gallery-manager-{os.getuid() if hasattr(os, 'getuid') else 0}",
+                               "inference")
+
+# One slot holds a 4K BGR frame (3840 x 2160 x 3 bytes) with room to spare
+DEFAULT_SLOT_SIZE = 32 * 1024 * 1024
+
+# Shared secret of the inference processes and their clients; start_inference_servers()
+# generates one unless it is set, and child processes (HTTP workers) inherit it
+AUTHKEY_ENV = "GALLERY_MANAGER_INFERENCE_KEY"
+
+def inference_authkey():
+    """The key clients and servers authenticate with"""
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(f"{AUTHKEY_ENV} isn't set; start the inference processes with start_inference_servers() "
+                           f"or set the same key for the servers and the HTTP workers")
+    return key.encode()
+
+def server_addresses(address=DEFAULT_ADDRESS, processes=1):
+    """Unix socket path of each inference process"""
+    return [f"{address}.{i}.sock" for i in range(processes)]
+
+def _private_directory(path):
+    """Create the socket directory with mode 0700, refusing one that other users can get into"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError(f"Socket directory {path} isn't a directory")
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        raise RuntimeError(f"Socket directory {path} belongs to another user")
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+def _attach_shared_memory(name):
+    """Attach to a client's shared memory without this process's resource tracker unlinking it at exit"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+class InferenceServer:
+    """
+    Process owning the LightCNN and YOLO models, serving HTTP workers over a Unix socket
+
+    Every client connection is one slot of a client's shared-memory ring buffer: the
+    client writes a frame or a batch of face crops into the slot and sends a small
+    request; the server reads the input in place, writes embeddings back into the
+    slot and replies with the boxes and shapes. Connections are served by one thread
+    each; the models are used by one request at a time, as YOLO isn't thread-safe.
+    """
+
+    def __init__(self, address, model_path, yolo_path, threads=None):
+        self.address = address
+        self.authkey = inference_authkey()
+        if threads:
+            torch.set_num_threads(threads)
+            cv2.setNumThreads(threads)
+        self.model, self.device = load_model(model_path)
+        self.yolo_model = YOLO(yolo_path)
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        _private_directory(os.path.dirname(os.path.abspath(self.address)))
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            print(f"Inference server {os.getpid()} listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"Inference server: rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        shm = slot = None
+        try:
+            hello = conn.recv()
+            shm = _attach_shared_memory(hello["shm"])
+            slot = shm.buf[hello["offset"]:hello["offset"] + hello["size"]]
+            conn.send({"pid": os.getpid()})
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if request["op"] == "detect":
+                        reply = self._detect(request, slot)
+                    elif request["op"] == "embed":
+                        reply = self._embed(request, slot)
+                    else:
+                        reply = {"error": f"Unknown operation: {request['op']}"}
+                except Exception as e:
+                    reply = {"error": str(e)}
+                conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            if slot is not None:
+                slot.release()
+            if shm is not None:
+                shm.close()
+
+    def _detect(self, request, slot):
+        frame = np.ndarray(request["shape"], dtype=np.uint8, buffer=slot)
+        roi = DetectionROI(request["roi"]) if request.get("roi") else None
+        with self._lock:
+            faces = detect_faces(self.yolo_model, frame, conf=request["conf"], pad=request["pad"],
+                                 min_size=request["min_size"], tile_size=request["tile_size"],
+                                 overlap=request["overlap"], roi=roi, imgsz=request["imgsz"])
+        return {"boxes": [bbox for bbox, _ in faces]}
+
+    def _embed(self, request, slot):
+        faces = []
+        offset = 0
+        for shape in request["shapes"]:
+            face = np.ndarray(shape, dtype=np.uint8, buffer=slot, offset=offset)
+            faces.append(face)
+            offset += face.nbytes
+        with self._lock:
+            embeddings = embed_face_images(self.model, self.device, faces)
+        # The crops have been consumed, so the embeddings can go where they were
+        np.ndarray(embeddings.shape, dtype=np.float32, buffer=slot)[:] = embeddings
+        return {"shape": embeddings.shape}
+
+def _serve(address, model_path, yolo_path, threads, cpu_set=None):
+    if cpu_set and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_set)
+    InferenceServer(address, model_path, yolo_path, threads).serve_forever()
+
+def start_inference_servers(model_path, yolo_path, processes=1, address=DEFAULT_ADDRESS, threads=None,
+                            timeout=120.0, cpu_sets=None):
+    """
+    Start inference processes and wait until they accept connections
+
+    Unless GALLERY_MANAGER_INFERENCE_KEY is set, a random key is generated and put in
+    this process's environment, so processes started from it afterwards (the HTTP
+    workers) can connect and nobody else can.
+
+    Args:
+        model_path: Path to the LightCNN model file
+        yolo_path: Path to the YOLO face detection model
+        processes: Number of inference processes
+        address: Base path of their Unix sockets (see server_addresses)
+        threads: Torch/OpenCV threads per process (default: the cores split between the processes)
+        timeout: Seconds to wait for the models to load
+        cpu_sets: CPU ids to pin each process to (optional, one list per process)
+
+    Returns:
+        The started processes
+    """
+    threads = threads or max(1, (os.cpu_count() or 1) // processes)
+    if not os.environ.get(AUTHKEY_ENV):
+        os.environ[AUTHKEY_ENV] = secrets.token_hex(32)
+    _private_directory(os.path.dirname(os.path.abspath(address)))
+    addresses = server_addresses(address, processes)
+    for path in addresses:
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Spawn instead of fork: forking a process that already initialised torch's thread pools can deadlock
+    context = multiprocessing.get_context("spawn")
+    servers = []
+    for i, path in enumerate(addresses):
+        cpu_set = cpu_sets[i % len(cpu_sets)] if cpu_sets else None
+        server = context.Process(target=_serve, args=(path, model_path, yolo_path, threads, cpu_set),
+                                 name=f"inference-{os.path.basename(path)}", daemon=True)
+        server.start()
+        servers.append(server)
+
+    deadline = time.time() + timeout
+    while not all(os.path.exists(path) for path in addresses):
+        if any(not server.is_alive() for server in servers):
+            raise RuntimeError("An inference process exited during startup")
+        if time.time() > deadline:
+            raise TimeoutError(f"Inference processes not ready after {timeout:.0f}s")
+        time.sleep(0.1)
+    print(f"Started {processes} inference processes with {threads} threads each")
+    return servers
+
+class InferenceClient:
+    """
+    Connection of one HTTP worker to the inference processes
+
+    The client owns a shared-memory ring buffer of slots, each with its own connection
+    to one of the inference processes (slots are spread round-robin). A request takes
+    a free slot, so up to `slots` requests of the worker run at the same time, spread
+    over the processes, and a busy worker waits for the next free slot. A slot whose
+    connection broke (e.g. its inference process died) reconnects, to the next process
+    that accepts, and the request is sent again.
+
+    detect_faces() and embed_face_images() mirror the gallery_manager functions of
+    the same name, without needing the models in this process.
+    """
+
+    def __init__(self, addresses, slots=4, slot_size=DEFAULT_SLOT_SIZE):
+        self.addresses = list(addresses)
+        self.slot_size = slot_size
+        self._authkey = inference_authkey()
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._views = [self._shm.buf[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self._conns = [None] * slots
+        self._free = queue.Queue()
+        try:
+            for i in range(slots):
+                self._conns[i] = self._connect(i)
+                self._free.put(i)
+        except Exception:
+            self.close()
+            raise
+
+    def _connect(self, i):
+        """Connect slot i to its inference process, or the next one that accepts"""
+        error = None
+        for k in range(len(self.addresses)):
+            address = self.addresses[(i + k) % len(self.addresses)]
+            try:
+                conn = Client(address, family="AF_UNIX", authkey=self._authkey)
+                conn.send({"shm": self._shm.name, "offset": i * self.slot_size, "size": self.slot_size})
+                conn.recv()
+                return conn
+            except (EOFError, OSError) as e:
+                error = e
+        raise RuntimeError(f"No inference process accepts connections: {error}")
+
+    def _disconnect(self, i):
+        conn, self._conns[i] = self._conns[i], None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    @contextmanager
+    def _slot(self):
+        i = self._free.get()
+        try:
+            yield i, self._views[i]
+        finally:
+            self._free.put(i)
+
+    def _call(self, i, request):
+        # The input is still in the slot, so a request that failed with its connection can be sent again
+        for attempt in range(2):
+            try:
+                if self._conns[i] is None:
+                    self._conns[i] = self._connect(i)
+                self._conns[i].send(request)
+                reply = self._conns[i].recv()
+                break
+            except (EOFError, OSError) as e:
+                self._disconnect(i)
+                if attempt:
+                    raise RuntimeError(f"Lost the connection to the inference process: {e}") from e
+        if "error" in reply:
+            raise RuntimeError(f"Inference server: {reply['error']}")
+        return reply
+
+    def detect_faces(self, frame, conf=0.65, pad=0.2, min_size=32, tile_size=None, overlap=0.2, roi=None,
+                     imgsz=None):
+        """Detect faces in one frame on an inference process, see gallery_manager.detect_faces()"""
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.nbytes > self.slot_size:
+            raise ValueError(f"Frame of {frame.nbytes} bytes doesn't fit a {self.slot_size} byte slot")
+        with self._slot() as (i, slot):
+            np.ndarray(frame.shape, dtype=np.uint8, buffer=slot)[:] = frame
+            reply = self._call(i, {
+                "op": "detect", "shape": frame.shape, "conf": conf, "pad": pad, "min_size": min_size,
+                "tile_size": tile_size, "overlap": overlap, "imgsz": imgsz,
+                "roi": roi.to_list() if roi is not None else None
+            })
+        return [(tuple(bbox), frame[bbox[1]:bbox[3], bbox[0]:bbox[2]]) for bbox in reply["boxes"]]
+
+    def embed_face_images(self, faces):
+        """Embeddings of face crops computed on an inference process, see gallery_manager.embed_face_images()"""
+        # Crops travel as grayscale, which is all the model looks at
+        crops = [np.ascontiguousarray(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face,
+                                      dtype=np.uint8) for face in faces]
+        embeddings = []
+        start = 0
+        while start < len(crops):
+            # As many crops as fit in one slot
+            end, size = start, 0
+            while end < len(crops) and (end == start or size + crops[end].nbytes <= self.slot_size):
+                size += crops[end].nbytes
+                end += 1
+            if size > self.slot_size:
+                raise ValueError(f"Face crop of {size} bytes doesn't fit a {self.slot_size} byte slot")
+            with self._slot() as (i, slot):
+                offset = 0
+                for crop in crops[start:end]:
+                    np.ndarray(crop.shape, dtype=np.uint8, buffer=slot, offset=offset)[:] = crop
+                    offset += crop.nbytes
+                reply = self._call(i, {"op": "embed", "shapes": [crop.shape for crop in crops[start:end]]})
+                embeddings.append(np.ndarray(reply["shape"], dtype=np.float32, buffer=slot).copy())
+            start = end
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+    def close(self):
+        for i in range(len(self._conns)):
+            self._disconnect(i)
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._shm.close()
+        self._shm.unlink()
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_inference_client(address=DEFAULT_ADDRESS, processes=1, slots=4):
+    """This process's InferenceClient, connected on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = InferenceClient(server_addresses(address, processes), slots)
+                atexit.register(_client.close)
+    return _client
+
+if __name__ == "__main__":
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Run inference processes owning the face models")
+    parser.add_argument("--model", default=os.path.join(src_dir, "checkpoints", "LightCNN_29Layers_V2_checkpoint.pth.tar"),
+                        help="Path to the LightCNN model file")
+    parser.add_argument("--yolo", default=os.path.join(src_dir, "yolo", "weights", "yolo11n-face.pt"),
+                        help="Path to YOLO face detection model")
+    parser.add_argument("--processes", type=int, default=1, help="Number of inference processes")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="Base path of the Unix sockets")
+    parser.add_argument("--threads", type=int, help="Torch/OpenCV threads per process")
+    args = parser.parse_args()
+
+    # The HTTP workers are started separately, so they need to be given the same key
+    if not os.environ.get(AUTHKEY_ENV):
+        parser.error(f"set {AUTHKEY_ENV} to a random secret, and the same value for the server")
+
+    servers = start_inference_servers(args.model, args.yolo, args.processes, args.address, args.threads)
+    for server in servers:
+        server.join()
@@ -0,0 +1,101 @@
+import threading
+import time
+
+class StageTimings:
+    """
+    Running estimates (exponential moving averages, in ms) of how long pipeline stages take
+
+    Stages are keyed by name and an optional variant, e.g. ("detect", 320) for the
+    detector at input size 320. Shared by the threads of one worker process.
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, ms, variant=None):
+        key = (stage, variant)
+        with self._lock:
+            previous = self._estimates.get(key)
+            self._estimates[key] = ms if previous is None else previous + self.alpha * (ms - previous)
+
+    def estimate(self, stage, variant=None):
+        """Estimated ms of a stage, or None if it was never measured"""
+        return self._estimates.get((stage, variant))
+
+    def variants(self, stage):
+        """Measured variants of a stage with their estimates"""
+        with self._lock:
+            return {variant: ms for (name, variant), ms in self._estimates.items() if name == stage}
+
+    def stats(self):
+        with self._lock:
+            return {f"{stage}" if variant is None else f"{stage}:{variant}": round(ms, 2)
+                    for (stage, variant), ms in sorted(self._estimates.items(), key=str)}
+
+class Deadline:
+    """
+    Time budget of one request and the quality degradations applied to meet it
+
+    Args:
+        deadline_ms: Budget in milliseconds, counted from start
+        start: time.monotonic() at which the request arrived (default: now)
+    """
+
+    def __init__(self, deadline_ms, start=None):
+        self.deadline_ms = deadline_ms
+        self.start = time.monotonic() if start is None else start
+        self.applied = {}
+
+    def elapsed_ms(self):
+        return (time.monotonic() - self.start) * 1000
+
+    def remaining_ms(self):
+        return self.deadline_ms - self.elapsed_ms()
+
+    def fits(self, ms, share=1.0):
+        """Whether a stage estimated at ms fits in share of the remaining budget (unknown estimates fit)"""
+        return ms is None or ms <= self.remaining_ms() * share
+
+    def degrade(self, name, value=True):
+        """Record a degradation applied to meet the deadline"""
+        self.applied[name] = value
+
+    def report(self):
+        return {
+            "deadline_ms": self.deadline_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 1),
+            "met": self.remaining_ms() >= 0,
+            "degradations": dict(self.applied)
+        }
+
+def choose_variant(timings, stage, variants, deadline, share=1.0, cost=None):
+    """
+    Largest variant of a stage expected to fit in share of the remaining budget
+
+    Unmeasured variants are estimated from a measured one scaled by cost(variant),
+    e.g. the input area for a detector size. With no measurements at all the largest
+    variant is used, so the first request calibrates the estimates.
+
+    Args:
+        timings: StageTimings
+        stage: Stage name
+        variants: Candidate variants, best quality first
+        deadline: Deadline of the request
+        share: Share of the remaining budget the stage may use
+        cost: Relative cost of a variant (default: all equal)
+
+    Returns:
+        The chosen variant (the last one if none fits)
+    """
+    cost = cost or (lambda variant: 1.0)
+    measured = timings.variants(stage)
+    for variant in variants:
+        estimate = measured.get(variant)
+        if estimate is None and measured:
+            reference, reference_ms = next(iter(measured.items()))
+            estimate = reference_ms * cost(variant) / cost(reference)
+        if deadline.fits(estimate, share):
+            return variant
+    return variants[-1]
@@ -1,21 +1,28 @@
 import os
+import gc
 import cv2
 import shutil
 import uuid
+import tempfile
 import sqlite3
 import numpy as np
 import json
+import asyncio
+import hashlib
+import re
+from contextlib import nullcontext
 import time
+import threading
 from datetime import datetime
 from enum import Enum
 from typing import List, Optional, Dict, Tuple, Union, Any
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request, WebSocket
 from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 import base64
 from ultralytics import YOLO
 import torch
-from scipy.spatial.distance import cosine
 from PIL import Image
 from torchvision import transforms
 from fastapi.staticfiles import StaticFiles
@@ -28,10 +35,65 @@ from dotenv import load_dotenv
 # Load environment variables at module level
 load_dotenv()
 
-# Get host, port, and workers from environment variables or use defaults
+# Add src directory to system path for imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from gallery_manager import create_gallery, update_gallery, load_model, extract_embedding, embed_face_images, detect_faces, DetectionROI, model_fingerprint, create_gallery_from_embeddings, update_gallery_from_embeddings, build_all_galleries, load_gallery, match_embeddings, gallery_cache, GalleryUnionCache, GalleryNameIndex, append_identity_images, add_identity, remove_identity, rename_identity, compact_gallery, remove_gallery_files, build_gallery_file, run_bulk_job
+import database
+from result_cache import ResultCache
+from latency_budget import Deadline, StageTimings, choose_variant
+from admission import AdmissionController, AdmissionRejected, ProcessSlots, WorkClass
+from inference_server import DEFAULT_ADDRESS, get_inference_client, start_inference_servers
+from resource_planner import apply_thread_budget, claim_worker_index, current_resources, plan_resources
+from face_tracker import VideoRecognizer, recognize_video
+import attendance
+
+# Get host, port, and workers from environment variables or use defaults.
+# GALLERY_MANAGER_WORKERS=auto runs the worker count planned from the available cores.
 host = os.environ.get("GALLERY_MANAGER_HOST", "0.0.0.0")
 port = int(os.environ.get("GALLERY_MANAGER_PORT", 8000))
-workers = int(os.environ.get("GALLERY_MANAGER_WORKERS", 1))
+workers_setting = os.environ.get("GALLERY_MANAGER_WORKERS", "1").strip().lower()
+
+# Recognition responses kept per worker for byte-identical resubmissions (0 disables caching)
+result_cache_size = int(os.environ.get("GALLERY_MANAGER_RESULT_CACHE_SIZE", 64))
+# ...and at most this many MB of them per worker (responses include the annotated image)
+result_cache_mb = float(os.environ.get("GALLERY_MANAGER_RESULT_CACHE_MB", 32))
+
+# Inverted lists probed per face when matching against very large galleries (higher = better recall, slower)
+ann_nprobe = int(os.environ.get("GALLERY_MANAGER_ANN_NPROBE", 8))
+
+# Tile size (pixels) for tiled face detection in high-resolution photos
+detection_tile_size = int(os.environ.get("GALLERY_MANAGER_TILE_SIZE", 640))
+
+# Admission control: concurrent interactive requests (recognition) per worker, bulk jobs
+# (video processing, gallery builds) across all workers, and the total a worker runs
+interactive_limit = int(os.environ.get("GALLERY_MANAGER_INTERACTIVE_LIMIT", 8))
+bulk_limit = int(os.environ.get("GALLERY_MANAGER_BULK_LIMIT", 1))
+admission_total_limit = int(os.environ.get("GALLERY_MANAGER_ADMISSION_TOTAL", interactive_limit))
+
+# Niceness of gallery build processes, so rebuilds yield the CPU to recognition
+bulk_nice = int(os.environ.get("GALLERY_MANAGER_BULK_NICE", 10))
+
+# Model-server mode: with processes > 0, dedicated inference processes own LightCNN and YOLO
+# and HTTP workers send them frames and crops through shared memory
+inference_processes = int(os.environ.get("GALLERY_MANAGER_INFERENCE_PROCESSES", 0))
+inference_address = os.environ.get("GALLERY_MANAGER_INFERENCE_ADDRESS", DEFAULT_ADDRESS)
+inference_slots = int(os.environ.get("GALLERY_MANAGER_INFERENCE_SLOTS", 4))
+
+# CPU plan shared by HTTP workers, inference processes and bulk jobs, from the cores
+# actually available (affinity and cgroup quota), for GALLERY_MANAGER_WORKERS workers
+# (one by default); GALLERY_MANAGER_PIN_CPUS gives processes their own cores.
+resource_plan = plan_resources(
+    workers=None if workers_setting == "auto" else int(workers_setting),
+    inference_processes=inference_processes,
+    bulk_share=float(os.environ.get("GALLERY_MANAGER_BULK_SHARE", 0.25)),
+    pin=os.environ.get("GALLERY_MANAGER_PIN_CPUS", "false").lower() in ("1", "true", "yes"),
+    cpus=int(os.environ["GALLERY_MANAGER_CPUS"]) if os.environ.get("GALLERY_MANAGER_CPUS") else None
+)
+workers = resource_plan["http_workers"]
+
+# Preload mode: load the models and galleries once in a gunicorn master and fork the
+# workers from it, so they share those pages copy-on-write instead of loading their own
+preload = os.environ.get("GALLERY_MANAGER_PRELOAD", "false").lower() in ("1", "true", "yes")
 
 collection_app_host = os.environ.get("DATA_COLLECTION_HOST", "localhost")
 collection_app_port = int(os.environ.get("DATA_COLLECTION_PORT", 5001))
@@ -41,11 +103,6 @@ collection_app_port = int(os.environ.get("DATA_COLLECTION_PORT", 5001))
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 GALLERY_DIR = os.path.join(BASE_DIR, 'gallery')
 
-# Add src directory to system path for imports
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from gallery_manager import create_gallery, update_gallery, load_model, extract_embedding, create_gallery_from_embeddings, update_gallery_from_embeddings
-import database
-
 # Default paths using relative paths
 DEFAULT_MODEL_PATH = os.path.join(BASE_DIR, "src", "checkpoints", "LightCNN_29Layers_V2_checkpoint.pth.tar")
 DEFAULT_YOLO_PATH = os.path.join(BASE_DIR, "src", "yolo", "weights", "yolo11n-face.pt")
@@ -58,13 +115,126 @@ os.makedirs(BASE_DATA_DIR, exist_ok=True)
 os.makedirs(BASE_GALLERY_DIR, exist_ok=True)
 os.makedirs(STUDENT_DATA_DIR, exist_ok=True)
 
+# Pinned HTTP workers need an index to pick their cores. Preloaded workers get theirs from
+# the gunicorn master after the fork (see run_preloaded_server); workers that import this
+# module themselves (uvicorn --workers N, gunicorn without preload) take the lowest free
+# one. The process running main.py only starts the workers, so it takes none.
+worker_index = None
+if resource_plan["cpu_sets"] and __name__ != "__main__":
+    worker_index = claim_worker_index(os.path.join(BASE_DIR, "data", "locks"), workers)
+    if worker_index is None:
+        print(f"Warning: no free worker index out of {workers}, this worker is not pinned")
+apply_thread_budget(resource_plan, worker_index=worker_index)
+
+# Gallery name lookups and merged galleries for frequently combined selections
+gallery_names = GalleryNameIndex(BASE_GALLERY_DIR)
+gallery_unions = GalleryUnionCache(gallery_cache)
+
+# Models are loaded once per worker and shared by all requests
+_models = {}
+_models_lock = threading.Lock()
+
+# Recognition runs in the threadpool; the YOLO predictor isn't thread-safe, so one at a time
+_recognition_lock = threading.Lock()
+
+# /recognize results by (image hash, gallery versions, threshold), with single-flight coalescing
+recognition_results = ResultCache(result_cache_size, max_bytes=int(result_cache_mb * 1024 * 1024))
+
+# Measured stage times of this worker, used to plan requests with a deadline_ms.
+# Under a deadline detection may use half the remaining budget and embedding 80% of what is left.
+recognition_timings = StageTimings()
+DETECTOR_SIZES = (640, 480, 320)
+DETECT_BUDGET_SHARE = 0.5
+EMBED_BUDGET_SHARE = 0.8
+
+def get_embedding_model(model_path: str = DEFAULT_MODEL_PATH):
+    """Get the LightCNN model and its device, loading it on first use"""
+    key = ("lightcnn", model_path)
+    if key not in _models:
+        with _models_lock:
+            if key not in _models:
+                _models[key] = load_model(model_path)
+    return _models[key]
+
+def get_yolo_model(yolo_path: str = DEFAULT_YOLO_PATH):
+    """Get the YOLO face detector, loading it on first use"""
+    key = ("yolo", yolo_path)
+    if key not in _models:
+        with _models_lock:
+            if key not in _models:
+                _models[key] = YOLO(yolo_path)
+    return _models[key]
+
+def get_inference():
+    """This worker's inference server client in model-server mode, otherwise None"""
+    if inference_processes <= 0:
+        return None
+    return get_inference_client(inference_address, inference_processes, inference_slots)
+
+def get_tracking_models(private_yolo: bool = False):
+    """
+    (model, device, yolo_model, inference) for a VideoRecognizer or recognize_video
+    
+    In model-server mode detection and embedding go to the inference processes and this
+    worker loads no model. Otherwise the worker's cached models are used; private_yolo
+    gives a long job its own detector instead of holding the shared one.
+    """
+    inference = get_inference()
+    if inference is not None:
+        return None, None, None, inference
+    model, device = get_embedding_model()
+    return model, device, YOLO(DEFAULT_YOLO_PATH) if private_yolo else get_yolo_model(), None
+
 app = FastAPI(title="Face Recognition Gallery Manager", 
               description="API for managing face recognition galleries for students by batch and department")
 
 # Mount static files
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 
-# Add CORS middleware
+# Interactive requests are admitted first and bulk jobs one at a time; over capacity,
+# requests are rejected at once with 429/503 and a Retry-After instead of timing out.
+# Bulk slots are lock files shared by all workers, so the bulk limit is server-wide.
+bulk_slots = ProcessSlots(os.path.join(BASE_DIR, "data", "locks"), "bulk", bulk_limit)
+admission = AdmissionController([
+    WorkClass("interactive", interactive_limit, queue_size=4 * interactive_limit, queue_timeout=5.0,
+              retry_after=1, priority=0),
+    WorkClass("bulk", bulk_limit, queue_size=2, queue_timeout=10.0, retry_after=60, priority=1,
+              shared=bulk_slots)
+], total_limit=admission_total_limit)
+
+def bulk_job_limits() -> Dict[str, Any]:
+    """Thread count, niceness and CPU set for bulk jobs, from the resource plan (see run_bulk_job)"""
+    cpu_sets = resource_plan["cpu_sets"]
+    return {"threads": resource_plan["bulk_cpus"], "nice": bulk_nice,
+            "cpu_set": cpu_sets["bulk"] if cpu_sets else None}
+
+INTERACTIVE_ROUTES = re.compile(r"^/(recognize|embed|match)$")
+# /galleries/build-all returns at once and takes a bulk slot for its background rebuild itself
+BULK_ROUTES = re.compile(r"^/(process|galleries/create|recognize/video|student-data/[^/]+/[^/]+/process)$")
+
+def request_work_class(method: str, path: str) -> Optional[str]:
+    """Admission class of a request, or None for requests that aren't admission controlled"""
+    if method != "POST":
+        return None
+    if INTERACTIVE_ROUTES.match(path):
+        return "interactive"
+    if BULK_ROUTES.match(path):
+        return "bulk"
+    return None
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    work_class = request_work_class(request.method, request.url.path)
+    if work_class is None:
+        return await call_next(request)
+    try:
+        async with admission.admit(work_class):
+            return await call_next(request)
+    except AdmissionRejected as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail},
+                            headers={"Retry-After": str(e.retry_after)})
+
+# Add CORS middleware (added last so it wraps the admission responses too)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, specify exact origins
@@ -105,6 +275,14 @@ class StudentInfo(BaseModel):
     videoPath: str
     facesCount: int
 
+class MatchRequest(BaseModel):
+    galleries: List[str]
+    embeddings: Optional[List[List[float]]] = None
+    embeddings_b64: Optional[List[str]] = None
+    threshold: float = 0.45
+    top_k: int = Field(5, gt=0)
+    model_fingerprint: Optional[str] = None
+
 class StudentDataSummary(BaseModel):
     total_students: int
     students_with_video: int
@@ -371,23 +549,14 @@ def get_gallery_info(gallery_path: str) -> Optional[GalleryInfo]:
     if not os.path.exists(gallery_path):
         return None
     
-    # Load the gallery file
+    # Load the gallery file (any format version)
     try:
-        import torch
-        gallery_data = torch.load(gallery_path)
-        
-        # Handle both formats
-        if isinstance(gallery_data, dict) and "identities" in gallery_data:
-            identities = gallery_data["identities"]
-        else:
-            identities = list(gallery_data.keys())
-            
-        count = len(identities)
+        gallery = gallery_cache.get(gallery_path)
         
         return GalleryInfo(
             gallery_path=gallery_path,
-            identities=identities,
-            count=count
+            identities=gallery.identities,
+            count=len(gallery)
         )
     except Exception as e:
         print(f"Error loading gallery file: {e}")
@@ -401,7 +570,10 @@ def recognize_faces(
     threshold: float = 0.45,
     model=None,
     device=None,
-    yolo_model=None
+    yolo_model=None,
+    tile_size: Optional[int] = None,
+    roi: Optional[DetectionROI] = None,
+    deadline: Optional[Deadline] = None
 ) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
     """
     Recognize faces in a given frame using one or more galleries.
@@ -416,98 +588,87 @@ def recognize_faces(
         model: Pre-loaded model (optional)
         device: Pre-loaded device (optional)
         yolo_model: Pre-loaded YOLO model (optional)
+        tile_size: Detect faces in overlapping tiles of this size when the frame is larger (optional)
+        roi: Only detect faces inside this camera region of interest (optional)
+        deadline: Time budget; quality is degraded as needed to meet it and the
+            degradations are recorded on it (optional)
         
     Returns:
         Tuple containing:
-            - Annotated frame with bounding boxes and labels
+            - Annotated frame with bounding boxes and labels (None if annotation was skipped)
             - List of recognized identities with details
     """
     if isinstance(gallery_paths, str):
         gallery_paths = [gallery_paths]
     
-    # Load model and YOLO if not provided
-    if model is None or device is None:
-        model, device = load_model(model_path)
+    # In model-server mode the inference processes run the models, unless models are passed in
+    inference = get_inference() if model is None and yolo_model is None else None
     
-    if yolo_model is None:
-        yolo_model = YOLO(yolo_path)
+    # Use the worker's cached model and YOLO if not provided
+    if inference is None and (model is None or device is None):
+        model, device = get_embedding_model(model_path)
     
-    # Load and combine all galleries
-    combined_gallery = {}
-    for gallery_path in gallery_paths:
-        if os.path.exists(gallery_path):
-            try:
-                gallery_data = torch.load(gallery_path)
-                # Handle different gallery formats
-                if isinstance(gallery_data, dict):
-                    if "identities" in gallery_data:
-                        combined_gallery.update(gallery_data["identities"])
-                    else:
-                        combined_gallery.update(gallery_data)
-            except Exception as e:
-                print(f"Error loading gallery {gallery_path}: {e}")
-    
-    if not combined_gallery:
+    if inference is None and yolo_model is None:
+        yolo_model = get_yolo_model(yolo_path)
+    
+    # Load and combine all galleries. The cache hands out memory-mapped snapshots, so all
+    # workers share one copy of each matrix and a rebuild never exposes a half-written file.
+    # Combinations requested repeatedly reuse their merged matrix until a member changes.
+    combined_gallery = gallery_unions.get(gallery_paths)
+    
+    if not len(combined_gallery):
         return frame, []
     
-    # Step 1: Detect faces using YOLO
-    face_detections = []
-    results = yolo_model(frame,conf=0.65)
+    # Step 1: Detect faces using YOLO (tiled for large photos when tile_size is set),
+    # then embed all faces in one batch. Under a deadline, skip tiling and shrink the
+    # detector input until detection is expected to fit in its share of the budget.
+    imgsz = None
+    if deadline is not None:
+        if tile_size and not deadline.fits(recognition_timings.estimate("detect_tiled"), DETECT_BUDGET_SHARE):
+            tile_size = None
+            deadline.degrade("tiling_skipped")
+        if not tile_size:
+            imgsz = choose_variant(recognition_timings, "detect", DETECTOR_SIZES, deadline, DETECT_BUDGET_SHARE,
+                                   cost=lambda size: size * size)
+            if imgsz != DETECTOR_SIZES[0]:
+                deadline.degrade("detector_imgsz", imgsz)
+    
+    start = time.monotonic()
+    if inference is not None:
+        detections = inference.detect_faces(frame, conf=0.65, tile_size=tile_size, roi=roi, imgsz=imgsz)
+    else:
+        detections = detect_faces(yolo_model, frame, conf=0.65, tile_size=tile_size, roi=roi, imgsz=imgsz)
+    if tile_size:
+        recognition_timings.record("detect_tiled", (time.monotonic() - start) * 1000)
+    else:
+        recognition_timings.record("detect", (time.monotonic() - start) * 1000, imgsz or DETECTOR_SIZES[0])
+    
+    # Under a deadline, embed only as many faces as fit, largest first
+    skipped = []
+    per_face_ms = recognition_timings.estimate("embed_face")
+    if deadline is not None and detections and per_face_ms:
+        limit = max(0, int(deadline.remaining_ms() * EMBED_BUDGET_SHARE / per_face_ms))
+        if limit < len(detections):
+            detections.sort(key=lambda d: (d[0][2] - d[0][0]) * (d[0][3] - d[0][1]), reverse=True)
+            detections, skipped = detections[:limit], detections[limit:]
+            deadline.degrade("faces_skipped", len(skipped))
     
-    for result in results:
-        for box in result.boxes:
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            
-            # Add padding around face
-            h, w = frame.shape[:2]
-            face_w, face_h = x2 - x1, y2 - y1
-            pad_x = int(face_w * 0.2)
-            pad_y = int(face_h * 0.2)
-            x1 = max(0, x1 - pad_x)
-            y1 = max(0, y1 - pad_y)
-            x2 = min(w, x2 + pad_x)
-            y2 = min(h, y2 + pad_y)
-            
-            if (x2 - x1) < 32 or (y2 - y1) < 32:
-                print(f"  WOULD SKIP FACE  - too small (testing with 5000px threshold)")
-                continue
+    face_detections = []
+    if detections:
+        start = time.monotonic()
+        faces = [face for _, face in detections]
+        if inference is not None:
+            embeddings = inference.embed_face_images(faces)
+        else:
+            embeddings = embed_face_images(model, device, faces)
+        recognition_timings.record("embed_face", (time.monotonic() - start) * 1000 / len(detections))
         
-            # Extract face image
-            face = frame[y1:y2, x1:x2]
-            
-            # Skip if face is too small
-            if face.size == 0 or face.shape[0] < 10 or face.shape[1] < 10:
-                continue
-                
-            # Convert BGR to grayscale PIL image
-            face_pil = Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY))
-            
-            # Transform for model input
-            transform = transforms.Compose([
-                transforms.Resize((128, 128)),
-                transforms.ToTensor(),
-            ])
-            
-            # Prepare for the model
-            face_tensor = transform(face_pil).unsqueeze(0).to(device)
-            
-            # Extract embedding
-            with torch.no_grad():
-                _, embedding = model(face_tensor)
-                face_embedding = embedding.cpu().squeeze().numpy()
-            
-            # Find all potential matches above threshold
-            matches = []
-            for identity, gallery_embedding in combined_gallery.items():
-                similarity = 1 - cosine(face_embedding, gallery_embedding)
-                if similarity >= threshold:
-                    matches.append((identity, similarity))
-            
-            # Sort matches by similarity (highest first)
-            matches.sort(key=lambda x: x[1], reverse=True)
-            
+        # Find all potential matches above threshold, sorted by similarity (highest first)
+        all_matches = match_embeddings(combined_gallery, embeddings, threshold, nprobe=ann_nprobe)
+        
+        for (bbox, _), face_embedding, matches in zip(detections, embeddings, all_matches):
             face_detections.append({
-                "bbox": (x1, y1, x2, y2),
+                "bbox": bbox,
                 "matches": matches,
                 "embedding": face_embedding
             })
@@ -548,7 +709,23 @@ def recognize_faces(
                 "bounding_box": [int(x1), int(y1), int(x2), int(y2)]
             })
     
-    # Step 3: Draw annotations as the final step
+    # Faces left out to meet the deadline are reported without an identity
+    for (x1, y1, x2, y2), _ in skipped:
+        detected_faces.append({
+            "identity": "Unknown",
+            "similarity": 0.0,
+            "bounding_box": [int(x1), int(y1), int(x2), int(y2)],
+            "skipped": True
+        })
+    
+    # Step 3: Draw annotations as the final step, unless the deadline leaves no time for it
+    if deadline is not None:
+        estimates = [recognition_timings.estimate(stage) for stage in ("annotate", "encode")]
+        if not deadline.fits(sum(ms for ms in estimates if ms is not None) if any(estimates) else None):
+            deadline.degrade("annotation_skipped")
+            return None, detected_faces
+    
+    start = time.monotonic()
     result_img = frame.copy()
     
     for face_info in detected_faces:
@@ -585,6 +762,7 @@ def recognize_faces(
                    cv2.FONT_HERSHEY_SIMPLEX, 
                    0.5, (255, 255, 255), 2)
     
+    recognition_timings.record("annotate", (time.monotonic() - start) * 1000)
     return result_img, detected_faces
 
 @app.get("/", response_class=FileResponse)
@@ -642,7 +820,7 @@ async def get_gallery(year: str, department: str):
 
 @app.post("/process", response_model=ProcessingResult, 
           summary="Process videos to extract frames and detect faces")
-async def process_videos(
+def process_videos(
     year: str = Form(...),
     department: str = Form(...),
     videos_dir: str = Form(...)
@@ -679,6 +857,11 @@ async def process_videos(
     if not video_files:
         raise HTTPException(status_code=400, detail="No video files found in the specified directory")
     
+    # In a niced job process with the bulk thread budget, so recognition keeps its cores
+    return run_bulk_job(extract_video_faces, video_files, data_path, **bulk_job_limits())
+
+def extract_video_faces(video_files: List[Tuple[str, str]], data_path: str) -> Dict[str, Any]:
+    """Extract the faces of (video path, student name) videos into the data folder, see /process"""
     # Process each video - ONLY extract frames and faces
     processed_videos = 0
     processed_frames = 0
@@ -732,7 +915,7 @@ async def process_videos(
 
 @app.post("/galleries/create", 
           summary="Create or update a gallery from preprocessed face data")
-async def create_gallery_endpoint(
+def create_gallery_endpoint(
     year: str = Form(...),
     department: str = Form(...),
     update_existing: bool = Form(False),
@@ -768,15 +951,13 @@ async def create_gallery_endpoint(
         raise HTTPException(status_code=400, detail=f"Gallery already exists for {department} {year}. Use update_existing=True to update.")
     
     try:
-        if update_existing and os.path.exists(gallery_path):
-            # Update existing gallery with augmentation
-            update_gallery(DEFAULT_MODEL_PATH, gallery_path, data_path, gallery_path, 
-                          augment_ratio=augment_ratio, augs_per_image=augs_per_image)
+        # Built in a niced job process with the bulk thread budget, so recognition keeps its cores
+        updating = update_existing and os.path.exists(gallery_path)
+        run_bulk_job(build_gallery_file, DEFAULT_MODEL_PATH, data_path, gallery_path, updating,
+                     augment_ratio, augs_per_image, **bulk_job_limits())
+        if updating:
             message = f"Updated gallery for {department} {year} with augmentation"
         else:
-            # Create new gallery with augmentation
-            create_gallery(DEFAULT_MODEL_PATH, data_path, gallery_path,
-                          augment_ratio=augment_ratio, augs_per_image=augs_per_image)
             message = f"Created gallery for {department} {year} with augmentation"
         
         # Get gallery info
@@ -799,6 +980,76 @@ async def create_gallery_endpoint(
         print(f"Error creating/updating gallery with augmentation: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to create/update gallery: {str(e)}")
 
+def run_build_all_job(job_id: str, slot: int, **kwargs):
+    """Rebuild every registered gallery, storing each gallery's result as it finishes"""
+    finished = []
+    def progress(result):
+        finished.append(result)
+        database.update_build_job(job_id, finished)
+    try:
+        summary = build_all_galleries(DEFAULT_MODEL_PATH, BASE_DATA_DIR, progress=progress, **kwargs)
+        database.update_build_job(job_id, summary["galleries"], "completed", summary)
+        print(f"Build job {job_id}: rebuilt {summary['built']} galleries ({summary['failed']} failed)")
+    except Exception as e:
+        print(f"Error rebuilding galleries: {e}")
+        database.update_build_job(job_id, finished, "failed", {"error": str(e)})
+    finally:
+        bulk_slots.release(slot)
+
+@app.post("/galleries/build-all", status_code=202,
+          summary="Start rebuilding every registered gallery in parallel")
+def build_all_galleries_endpoint(
+    augment_ratio: float = Form(1.0),
+    augs_per_image: int = Form(2),
+    cpu_budget: Optional[int] = Form(None),
+    max_workers: Optional[int] = Form(None)
+):
+    """
+    Rebuild all registered department/year galleries on a process pool in the background
+    
+    Parameters:
+    - augment_ratio: Ratio of images to augment (0.0 to 1.0)
+    - augs_per_image: Number of augmentations per selected image
+    - cpu_budget: Total number of cores the rebuild may use (default: the planned bulk share of the cores)
+    - max_workers: Maximum number of galleries built at the same time
+    
+    Returns a job id; GET /galleries/build-all/jobs/{job_id} reports the per-gallery
+    timings and identity counts as the galleries finish.
+    """
+    galleries = database.list_all_galleries()
+    if not galleries:
+        raise HTTPException(status_code=404, detail="No registered galleries to rebuild")
+    
+    # The rebuild outlives this request, so it holds a bulk slot of its own until it ends
+    slot = bulk_slots.try_acquire()
+    if slot is None:
+        raise HTTPException(status_code=503, detail="Server busy with bulk work, try again later",
+                            headers={"Retry-After": "60"})
+    try:
+        job_id = uuid.uuid4().hex
+        database.create_build_job(job_id, len(galleries))
+        cpu_sets = resource_plan["cpu_sets"]
+        threading.Thread(target=run_build_all_job, args=(job_id, slot), daemon=True, kwargs={
+            "augment_ratio": augment_ratio, "augs_per_image": augs_per_image,
+            "cpu_budget": cpu_budget or resource_plan["bulk_cpus"], "max_workers": max_workers,
+            "nice": bulk_nice, "cpu_set": cpu_sets["bulk"] if cpu_sets else None
+        }).start()
+    except Exception as e:
+        bulk_slots.release(slot)
+        print(f"Error starting gallery rebuild: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to start gallery rebuild: {str(e)}")
+    
+    return {"job_id": job_id, "status": "running", "total": len(galleries)}
+
+@app.get("/galleries/build-all/jobs/{job_id}", summary="Get the progress of a gallery rebuild")
+async def get_build_all_job(job_id: str):
+    """Per-gallery results of a rebuild so far, and its summary once it ended"""
+    job = database.get_build_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Build job not found: {job_id}")
+    job["done"] = len(job["galleries"])
+    return job
+
 @app.post("/batches/year", status_code=201, summary="Add a new batch year")
 async def add_batch_year(year_data: dict):
     year = year_data.get("year")
@@ -913,6 +1164,11 @@ async def list_registered_galleries():
         "count": len(galleries)
     }
 
+@app.get("/galleries/combinations", summary="Get the most requested gallery combinations")
+async def list_gallery_combinations():
+    """List gallery combinations used for recognition in this worker and whether their merged gallery is cached"""
+    return {"combinations": gallery_unions.stats()}
+
 @app.get("/database/stats", summary="Get database statistics")
 async def get_database_stats():
     """Get comprehensive database statistics"""
@@ -935,8 +1191,8 @@ async def delete_gallery(year: str, department: str):
         raise HTTPException(status_code=404, detail=f"No gallery found for {department} {year}")
     
     try:
-        # Remove gallery file
-        os.remove(gallery_path)
+        # Remove gallery file and its log of pending identity changes
+        remove_gallery_files(gallery_path)
         
         # Remove from database
         database.remove_gallery(year, department)
@@ -985,11 +1241,420 @@ async def sync_gallery_with_database(year: str, department: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to sync gallery: {str(e)}")
 
+async def save_uploaded_faces(images: List[UploadFile], identity_dir: str, detect_faces: bool = True) -> List[str]:
+    """
+    Preprocess uploaded photos of one student and store the faces in their data folder
+    
+    Args:
+        images: Uploaded image files
+        identity_dir: Gallery data folder of the student
+        detect_faces: Detect and crop faces (False if the uploads are already face crops)
+    
+    Returns:
+        List of paths to preprocessed face images
+    """
+    uploads = [(upload.filename, await upload.read()) for upload in images]
+    # Decoding, detection and writing the crops would block the event loop
+    return await run_in_threadpool(save_face_images, uploads, identity_dir, detect_faces)
+
+def save_face_images(uploads: List[Tuple[str, bytes]], identity_dir: str, detect_faces: bool = True) -> List[str]:
+    """Preprocess (filename, contents) uploads of one student into their data folder, see save_uploaded_faces()"""
+    os.makedirs(identity_dir, exist_ok=True)
+    
+    face_paths = []
+    for filename, contents in uploads:
+        img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise HTTPException(status_code=400, detail=f"Invalid image file: {filename}")
+        
+        name = f"upload_{uuid.uuid4().hex[:8]}"
+        inference = get_inference() if detect_faces else None
+        if inference is not None:
+            # The inference processes detect with the same padding and minimum size
+            for j, (_, face) in enumerate(inference.detect_faces(img, conf=0.25)):
+                face_path = os.path.join(identity_dir, f"{name}_face_{j}.jpg")
+                write_face_crop(face, face_path)
+                face_paths.append(face_path)
+        elif detect_faces:
+            # Detect and preprocess faces the same way as video processing does
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{name}_", suffix=".jpg")
+            os.close(fd)
+            try:
+                cv2.imwrite(tmp_path, img)
+                face_paths.extend(detect_and_crop_faces(tmp_path, identity_dir))
+            finally:
+                os.remove(tmp_path)
+        else:
+            # Already a face crop
+            face_path = os.path.join(identity_dir, f"{name}_face_0.jpg")
+            write_face_crop(img, face_path)
+            face_paths.append(face_path)
+    
+    return face_paths
+
+def write_face_crop(face: np.ndarray, face_path: str):
+    """Store a face crop with the grayscale/resize/equalize preprocessing of detect_and_crop_faces()"""
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    resized = cv2.resize(gray, (128, 128), interpolation=cv2.INTER_LANCZOS4)
+    cv2.imwrite(face_path, cv2.equalizeHist(resized))
+
+def get_existing_gallery_path(year: str, department: str) -> str:
+    """Validate batch year and department and return the path of their existing gallery"""
+    if year not in database.get_batch_years():
+        raise HTTPException(status_code=400, detail=f"Invalid batch year: {year}")
+    if department not in database.get_department_ids():
+        raise HTTPException(status_code=400, detail=f"Invalid department: {department}")
+    
+    gallery_path = get_gallery_path(year, department)
+    if not os.path.exists(gallery_path):
+        raise HTTPException(status_code=404, detail=f"No gallery found for {department} {year}")
+    return gallery_path
+
+def get_identity_dir(year: str, department: str, identity: str) -> str:
+    """
+    Validate an identity name and return the path of its face data folder
+    
+    Identity names become folder names in the gallery data directory, so anything
+    that isn't a single plain path component (separators, "." or "..") is rejected.
+    """
+    data_path = get_data_path(year, department)
+    if (not identity or identity in (".", "..") or os.path.basename(identity) != identity
+            or os.sep in identity or (os.altsep and os.altsep in identity) or "\0" in identity):
+        raise HTTPException(status_code=400, detail=f"Invalid identity name: {identity!r}")
+    identity_dir = os.path.join(data_path, identity)
+    root = os.path.realpath(data_path)
+    if os.path.dirname(os.path.realpath(identity_dir)) != root:
+        raise HTTPException(status_code=400, detail=f"Invalid identity name: {identity!r}")
+    return identity_dir
+
+@app.post("/galleries/{year}/{department}/identities",
+          summary="Add (or replace) one identity without rebuilding the gallery")
+async def add_identity_endpoint(
+    year: str,
+    department: str,
+    identity: str = Form(...),
+    images: List[UploadFile] = File(...),
+    detect_faces: bool = Form(True),
+    augment_ratio: float = Form(0.0),
+    augs_per_image: int = Form(2)
+):
+    """
+    Enroll a single student into an existing gallery
+    
+    Parameters:
+    - identity: Identity name (register number)
+    - images: Photos of the student
+    - detect_faces: Detect and crop the face (set to false if the images are already face crops)
+    - augment_ratio: Ratio of images to augment (0.0 to 1.0)
+    - augs_per_image: Number of augmentations per selected image
+    """
+    gallery_path = get_existing_gallery_path(year, department)
+    identity_dir = get_identity_dir(year, department, identity)
+    face_paths = await save_uploaded_faces(images, identity_dir, detect_faces)
+    if not face_paths:
+        raise HTTPException(status_code=400, detail="No faces detected in the uploaded images")
+    
+    def enroll():
+        inference = get_inference()
+        model, device = get_embedding_model() if inference is None else (None, None)
+        return add_identity(DEFAULT_MODEL_PATH, gallery_path, identity, face_paths,
+                            augment_ratio=augment_ratio, augs_per_image=augs_per_image,
+                            model=model, device=device, inference=inference)
+    
+    try:
+        stats = await run_in_threadpool(enroll)
+        if stats is None:
+            raise HTTPException(status_code=500, detail="Failed to extract embeddings from the uploaded faces")
+        
+        identity_count = len(gallery_cache.get(gallery_path))
+        database.update_gallery_count(gallery_path, identity_count)
+        return {
+            "message": f"Added {identity} to gallery {department} {year}",
+            "identity": stats,
+            "identities_count": identity_count,
+            "success": True
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to add identity: {str(e)}")
+
+@app.delete("/galleries/{year}/{department}/identities/{identity}",
+            summary="Remove one identity without rebuilding the gallery")
+async def remove_identity_endpoint(year: str, department: str, identity: str, delete_data: bool = False):
+    """
+    Withdraw a student from a gallery
+    
+    Parameters:
+    - delete_data: Also delete the student's face data folder, so later rebuilds don't bring them back
+    """
+    gallery_path = get_existing_gallery_path(year, department)
+    identity_dir = get_identity_dir(year, department, identity)
+    try:
+        # Takes the gallery lock and fsyncs the delta log (or compacts), so not on the event loop
+        gallery = await run_in_threadpool(remove_identity, gallery_path, identity)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Identity '{identity}' not found in {department} {year}")
+    
+    if delete_data and os.path.isdir(identity_dir):
+        await run_in_threadpool(shutil.rmtree, identity_dir)
+    
+    database.update_gallery_count(gallery_path, len(gallery))
+    return {
+        "message": f"Removed {identity} from gallery {department} {year}",
+        "identities_count": len(gallery),
+        "data_deleted": delete_data,
+        "success": True
+    }
+
+@app.post("/galleries/{year}/{department}/identities/{identity}/rename",
+          summary="Rename one identity without rebuilding the gallery")
+async def rename_identity_endpoint(year: str, department: str, identity: str, new_identity: str = Form(...)):
+    """Rename an identity in a gallery (and its face data folder, if present)"""
+    gallery_path = get_existing_gallery_path(year, department)
+    old_dir = get_identity_dir(year, department, identity)
+    new_dir = get_identity_dir(year, department, new_identity)
+    try:
+        await run_in_threadpool(rename_identity, gallery_path, identity, new_identity)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Identity '{identity}' not found in {department} {year}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Keep the data folder in step so later rebuilds use the new name
+    if os.path.isdir(old_dir) and not os.path.exists(new_dir):
+        os.rename(old_dir, new_dir)
+    
+    return {"message": f"Renamed {identity} to {new_identity}", "success": True}
+
+@app.post("/galleries/{year}/{department}/compact",
+          summary="Fold pending identity changes into the gallery file")
+async def compact_gallery_endpoint(year: str, department: str):
+    """Compact the delta log of identity changes into the gallery file"""
+    gallery_path = get_existing_gallery_path(year, department)
+    try:
+        # Rewrites the whole gallery file and rebuilds its indexes
+        gallery, folded = await run_in_threadpool(compact_gallery, gallery_path)
+        return {
+            "message": f"Compacted {folded} pending changes into {os.path.basename(gallery_path)}",
+            "changes_compacted": folded,
+            "identities_count": len(gallery),
+            "success": True
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to compact gallery: {str(e)}")
+
+@app.post("/galleries/{year}/{department}/identities/{identity}/images",
+          summary="Add new images to one identity without rebuilding the gallery")
+async def append_identity_images_endpoint(
+    year: str,
+    department: str,
+    identity: str,
+    images: List[UploadFile] = File(...),
+    detect_faces: bool = Form(True),
+    augment_ratio: float = Form(0.0),
+    augs_per_image: int = Form(2)
+):
+    """
+    Fold new images of a student into their gallery identity (e.g. after a change in appearance)
+    
+    Only the uploaded images are embedded; they are added to the identity's running
+    statistics. The preprocessed faces are also stored in the gallery data folder so
+    that later rebuilds include them.
+    
+    Parameters:
+    - images: Photos of the student
+    - detect_faces: Detect and crop the face (set to false if the images are already face crops)
+    - augment_ratio: Ratio of images to augment (0.0 to 1.0)
+    - augs_per_image: Number of augmentations per selected image
+    """
+    gallery_path = get_existing_gallery_path(year, department)
+    identity_dir = get_identity_dir(year, department, identity)
+    face_paths = await save_uploaded_faces(images, identity_dir, detect_faces)
+    
+    if not face_paths:
+        raise HTTPException(status_code=400, detail="No faces detected in the uploaded images")
+    
+    def fold_in_images():
+        inference = get_inference()
+        model, device = get_embedding_model() if inference is None else (None, None)
+        return append_identity_images(DEFAULT_MODEL_PATH, gallery_path, identity, face_paths,
+                                      augment_ratio=augment_ratio, augs_per_image=augs_per_image,
+                                      model=model, device=device, inference=inference)
+    
+    try:
+        stats = await run_in_threadpool(fold_in_images)
+        if stats is None:
+            raise HTTPException(status_code=500, detail="Failed to extract embeddings from the uploaded faces")
+        
+        identity_count = len(gallery_cache.get(gallery_path))
+        database.update_gallery_count(gallery_path, identity_count)
+        
+        return {
+            "message": f"Added {len(face_paths)} face images to {identity}",
+            "faces_added": len(face_paths),
+            "identity": stats,
+            "identities_count": identity_count,
+            "success": True
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update identity: {str(e)}")
+
+def recognize_image_bytes(contents: bytes, gallery_paths: List[str], threshold: float,
+                          tile_size: Optional[int] = None, roi_polygons: Optional[list] = None,
+                          deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """Decode an uploaded image, recognize faces in it and build the /recognize response"""
+    nparr = np.frombuffer(contents, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    
+    if img is None:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    
+    print(f"DEBUG: Starting face recognition with {len(gallery_paths)} galleries, image shape: {img.shape}")
+    
+    # Perform recognition (inference processes serialise their own model use)
+    with _recognition_lock if get_inference() is None else nullcontext():
+        result_img, faces = recognize_faces(
+            img, 
+            gallery_paths=gallery_paths,
+            model_path=DEFAULT_MODEL_PATH,
+            yolo_path=DEFAULT_YOLO_PATH,
+            threshold=threshold,
+            tile_size=tile_size,
+            roi=DetectionROI(roi_polygons) if roi_polygons else None,
+            deadline=deadline
+        )
+    
+    print(f"DEBUG: Recognition completed, found {len(faces)} faces")
+    
+    # Convert result image to base64
+    img_base64 = None
+    if result_img is not None:
+        start = time.monotonic()
+        _, buffer = cv2.imencode('.jpg', result_img)
+        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        recognition_timings.record("encode", (time.monotonic() - start) * 1000)
+    
+    # Make sure all numpy values are converted to standard Python types
+    serializable_faces = []
+    for face in faces:
+        serializable_face = {
+            "identity": face["identity"],
+            "similarity": float(face["similarity"]),  # Convert numpy.float32 to Python float
+            "bounding_box": [int(x) for x in face["bounding_box"]]  # Convert numpy values to Python ints
+        }
+        if face.get("skipped"):
+            serializable_face["skipped"] = True
+        serializable_faces.append(serializable_face)
+    
+    response = {
+        "image": img_base64,
+        "faces": serializable_faces,
+        "count": len(serializable_faces)
+    }
+    if deadline is not None:
+        # Timing is reported per request by the endpoint; this result may be shared
+        response["degradations"] = dict(deadline.applied)
+    return response
+
+@app.post("/recognize/video", summary="Recognize and track faces in a recorded video")
+async def recognize_video_file(
+    galleries: List[str] = Form(...),
+    video: Optional[UploadFile] = File(None),
+    video_path: Optional[str] = Form(None),
+    threshold: float = Form(0.45),
+    sample_fps: float = Form(5.0),
+    min_detections: int = Form(2)
+):
+    """
+    Recognize the faces in a whole video and summarise them per track
+    
+    Parameters:
+    - galleries: List of gallery filenames
+    - video: Uploaded video file, or
+    - video_path: Path of a video file on the server
+    - threshold: Similarity threshold (0-1)
+    - sample_fps: Frames per second to analyse (0 analyses every frame)
+    - min_detections: Leave out tracks detected in fewer sampled frames
+    
+    Returns:
+    - One summary per track: identity, confidence, first and last seen (seconds)
+    - Processing statistics
+    """
+    if video is None and not video_path:
+        raise HTTPException(status_code=400, detail="Upload a video or give a video_path")
+    if video is None and not os.path.isfile(video_path):
+        raise HTTPException(status_code=404, detail=f"Video not found: {video_path}")
+    
+    gallery_paths = []
+    for gallery_name in galleries:
+        found_path = gallery_names.resolve(gallery_name)
+        if found_path is None:
+            raise HTTPException(status_code=404, detail=f"Gallery not found: {gallery_name}")
+        gallery_paths.append(found_path)
+    
+    temp_path = None
+    try:
+        if video is not None:
+            suffix = os.path.splitext(video.filename or "")[1] or ".mp4"
+            fd, temp_path = tempfile.mkstemp(suffix=suffix)
+            os.close(fd)
+        
+        def run():
+            # Everything here blocks: spooling a long upload, loading the model and galleries,
+            # and the recognition itself
+            if temp_path is not None:
+                with open(temp_path, "wb") as f:
+                    shutil.copyfileobj(video.file, f)
+            # A private YOLO instance, so the long job doesn't hold the shared detector
+            model, device, yolo_model, inference = get_tracking_models(private_yolo=True)
+            gallery = gallery_unions.get(gallery_paths)
+            return recognize_video(model, device, yolo_model, gallery, temp_path or video_path,
+                                   threshold, sample_fps, min_detections=min_detections, nprobe=ann_nprobe,
+                                   inference=inference)
+        
+        summary = await run_in_threadpool(run)
+        if video is not None:
+            summary["video"] = video.filename
+        return summary
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to process video: {str(e)}")
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@app.get("/recognize/cache", summary="Get recognition result cache statistics")
+async def get_recognition_cache_stats():
+    """Hits, misses and coalesced duplicate requests of this worker's recognition result cache"""
+    return recognition_results.stats()
+
+@app.get("/system/resources", summary="Get the CPU plan and this worker's effective settings")
+async def get_system_resources():
+    """Detected cores, the thread budgets of workers, inference processes and bulk jobs, and this worker's actual settings"""
+    return {"plan": resource_plan, "worker": current_resources()}
+
+@app.get("/system/admission", summary="Get admission control statistics")
+async def get_admission_stats():
+    """Running, queued, admitted and rejected requests per class of work in this worker"""
+    return admission.stats()
+
+@app.get("/recognize/timings", summary="Get measured recognition stage timings")
+async def get_recognition_timings():
+    """This worker's running estimates (ms) of each recognition stage, used to plan deadline_ms requests"""
+    return recognition_timings.stats()
+
 @app.post("/recognize", summary="Recognize faces in an uploaded image")
 async def recognize_image(
     image: UploadFile = File(...),
     galleries: List[str] = Form(...),
-    threshold: float = Form(0.45)
+    threshold: float = Form(0.45),
+    tiled: bool = Form(False),
+    source: Optional[str] = Form(None),
+    deadline_ms: Optional[int] = Form(None)
 ):
     """
     Recognize faces in an uploaded image using selected galleries
@@ -998,131 +1663,77 @@ async def recognize_image(
     - image: Image file to analyze
     - galleries: List of gallery filenames
     - threshold: Similarity threshold (0-1)
+    - tiled: Detect faces in overlapping tiles, for high-resolution group photos
+    - source: Camera source the image comes from; its stored region of interest limits detection
+    - deadline_ms: Answer within this many milliseconds, degrading quality as needed
+      (smaller detector input, only the largest faces embedded, no annotated image)
     
     Returns:
-    - Base64 encoded image with annotations
-    - List of recognized faces
+    - Base64 encoded image with annotations (null if annotation was skipped for the deadline)
+    - List of recognized faces; faces skipped for the deadline have "skipped": true
+    - With deadline_ms: elapsed_ms, whether the deadline was met and the degradations applied
     """
+    deadline = Deadline(deadline_ms) if deadline_ms else None
     try:
         print(f"DEBUG: Starting recognition process")
         print(f"DEBUG: Received image: {image.filename}")
         print(f"DEBUG: Received galleries: {galleries}")
         print(f"DEBUG: Received threshold: {threshold}")
         
-        # Read the image
         contents = await image.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            raise HTTPException(status_code=400, detail="Invalid image file")
-        
-        print(f"DEBUG: Image loaded successfully, shape: {img.shape}")
-        
-        # Debug: Print gallery directory info
-        print(f"DEBUG: Gallery directory: {BASE_GALLERY_DIR}")
-        print(f"DEBUG: Gallery directory exists: {os.path.exists(BASE_GALLERY_DIR)}")
-        
-        # List all files in gallery directory for debugging
-        if os.path.exists(BASE_GALLERY_DIR):
-            all_gallery_files = os.listdir(BASE_GALLERY_DIR)
-            print(f"DEBUG: All files in gallery directory: {all_gallery_files}")
-        else:
-            print(f"DEBUG: Gallery directory does not exist: {BASE_GALLERY_DIR}")
-            raise HTTPException(status_code=500, detail=f"Gallery directory does not exist: {BASE_GALLERY_DIR}")
+        tile_size = detection_tile_size if tiled else None
+        roi_polygons = database.get_camera_roi(source) if source else None
         
-        # Process galleries - Fixed logic to handle actual gallery files
+        # Resolve gallery names through the cached directory index
         gallery_paths = []
         for gallery_name in galleries:
-            print(f"DEBUG: Processing gallery name: '{gallery_name}'")
-            
-            # Clean the gallery name
-            clean_name = gallery_name.strip()
-            
-            # Try multiple naming patterns
-            possible_paths = [
-                os.path.join(BASE_GALLERY_DIR, clean_name),  # Direct name as received from frontend
-                os.path.join(BASE_GALLERY_DIR, f"{clean_name}.pth") if not clean_name.endswith('.pth') else os.path.join(BASE_GALLERY_DIR, clean_name),  # Add .pth if missing
-                os.path.join(BASE_GALLERY_DIR, f"gallery_{clean_name}"),  # With gallery_ prefix
-            ]
-            
-            # Remove duplicates while preserving order
-            seen = set()
-            unique_paths = []
-            for path in possible_paths:
-                if path not in seen:
-                    seen.add(path)
-                    unique_paths.append(path)
-            
-            # Find the first existing file
-            found_path = None
-            for path in unique_paths:
-                print(f"DEBUG: Checking path: {path}")
-                if os.path.exists(path):
-                    found_path = path
-                    print(f"DEBUG: Found gallery at: {path}")
-                    break
-            
+            found_path = gallery_names.resolve(gallery_name)
             if found_path:
                 gallery_paths.append(found_path)
-                print(f"DEBUG: Successfully added gallery path: {found_path}")
             else:
-                print(f"DEBUG: Gallery '{gallery_name}' not found. Tried paths:")
-                for path in unique_paths:
-                    print(f"  - {path} (exists: {os.path.exists(path)})")
+                print(f"DEBUG: Gallery '{gallery_name}' not found in {BASE_GALLERY_DIR}")
         
         print(f"DEBUG: Final gallery_paths list: {gallery_paths}")
         
         if not gallery_paths:
-            # Provide detailed error information
-            available_galleries = []
-            if os.path.exists(BASE_GALLERY_DIR):
-                available_galleries = [f for f in os.listdir(BASE_GALLERY_DIR) if f.endswith('.pth')]
-            
-            error_detail = {
-                "error": "No valid galleries found",
-                "requested_galleries": galleries,
-                "available_galleries": available_galleries,
-                "gallery_directory": BASE_GALLERY_DIR
-            }
-            print(f"DEBUG: Error details: {error_detail}")
+            available_galleries = gallery_names.names()
             raise HTTPException(status_code=400, detail=f"No valid galleries found. Requested: {galleries}, Available: {available_galleries}")
         
-        print(f"DEBUG: Starting face recognition with {len(gallery_paths)} galleries")
-        
-        # Perform recognition
-        result_img, faces = recognize_faces(
-            img, 
-            gallery_paths=gallery_paths,
-            model_path=DEFAULT_MODEL_PATH,
-            yolo_path=DEFAULT_YOLO_PATH,
-            threshold=threshold
+        # Identical images against unchanged galleries get the same answer; concurrent
+        # identical requests (client retries) share a single computation
+        cache_key = (
+            hashlib.sha256(contents).hexdigest(),
+            tuple((path, gallery_cache.version(path)) for path in gallery_paths),
+            float(threshold),
+            tile_size,
+            json.dumps(roi_polygons)
         )
+        if deadline is None:
+            return await recognition_results.get_or_compute(
+                cache_key,
+                lambda: run_in_threadpool(recognize_image_bytes, contents, gallery_paths, threshold, tile_size, roi_polygons)
+            )
         
-        print(f"DEBUG: Recognition completed, found {len(faces)} faces")
-        
-        # Convert result image to base64
-        _, buffer = cv2.imencode('.jpg', result_img)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        
-        # Make sure all numpy values are converted to standard Python types
-        serializable_faces = []
-        for face in faces:
-            serializable_face = {
-                "identity": face["identity"],
-                "similarity": float(face["similarity"]),  # Convert numpy.float32 to Python float
-                "bounding_box": [int(x) for x in face["bounding_box"]]  # Convert numpy values to Python ints
-            }
-            serializable_faces.append(serializable_face)
-        
-        print(f"DEBUG: Returning results with {len(serializable_faces)} faces")
-        
-        # Return results
-        return {
-            "image": img_base64,
-            "faces": serializable_faces,
-            "count": len(serializable_faces)
-        }
+        # A cached full-quality answer beats any degraded one. Degraded answers depend on
+        # the load at the time, so they are shared with concurrent duplicates but not cached;
+        # a full-quality one is cached as the answer without a deadline, which serves requests
+        # with or without one. Elapsed time and whether the deadline was met are always this
+        # request's own.
+        cached = recognition_results.peek(cache_key)
+        if cached is not None:
+            return {**cached, **deadline.report()}
+        
+        async def recognize_within_deadline():
+            result = await run_in_threadpool(recognize_image_bytes, contents, gallery_paths, threshold, tile_size,
+                                             roi_polygons, deadline)
+            if not result["degradations"]:
+                recognition_results.put(cache_key, {k: v for k, v in result.items() if k != "degradations"})
+            return result
+        
+        result = await recognition_results.get_or_compute(
+            cache_key + (deadline_ms,), recognize_within_deadline, cacheable=lambda result: False
+        )
+        return {**result, **deadline.report(), "degradations": result["degradations"]}
         
     except HTTPException:
         # Re-raise HTTP exceptions as-is
@@ -1133,6 +1744,370 @@ async def recognize_image(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+@app.post("/embed", summary="Compute embeddings for pre-cropped face images")
+async def embed_faces(
+    faces: List[UploadFile] = File(...),
+    encoding: str = Form("list")
+):
+    """
+    Compute LightCNN embeddings for face crops detected on the client
+    
+    Parameters:
+    - faces: Cropped face images (any size, they are resized to 128x128 grayscale)
+    - encoding: "list" for lists of floats, or "base64" for little-endian float16 vectors
+    
+    Returns:
+    - One embedding per decodable face, in upload order
+    - The fingerprint of the model, to send along to /match
+    """
+    if encoding not in ("list", "base64"):
+        raise HTTPException(status_code=400, detail="encoding must be 'list' or 'base64'")
+    
+    uploads = [(face.filename, await face.read()) for face in faces]
+    crops, filenames, failed = await run_in_threadpool(decode_face_uploads, uploads)
+    if not crops:
+        raise HTTPException(status_code=400, detail="No valid face images")
+    
+    try:
+        # Both paths block for the whole batch, so neither runs on the event loop
+        embeddings = await run_in_threadpool(embed_crops, crops)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to compute embeddings: {str(e)}")
+    
+    if encoding == "base64":
+        encoded = [base64.b64encode(e.astype("<f2").tobytes()).decode("ascii") for e in embeddings]
+    else:
+        encoded = embeddings.tolist()
+    
+    return {
+        "embeddings": [{"filename": name, "embedding": e} for name, e in zip(filenames, encoded)],
+        "dim": int(embeddings.shape[1]),
+        "encoding": encoding,
+        "model_fingerprint": model_fingerprint(DEFAULT_MODEL_PATH),
+        "failed": failed
+    }
+
+def decode_face_uploads(uploads: List[Tuple[str, bytes]]) -> Tuple[List[np.ndarray], List[str], List[str]]:
+    """Decode (filename, contents) face uploads into (images, their filenames, undecodable filenames)"""
+    crops = []
+    filenames = []
+    failed = []
+    for filename, contents in uploads:
+        img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            failed.append(filename)
+            continue
+        crops.append(img)
+        filenames.append(filename)
+    return crops, filenames, failed
+
+def embed_crops(crops: List[np.ndarray]) -> np.ndarray:
+    """Embeddings of face crops, on the inference processes if enabled, otherwise with this worker's model"""
+    inference = get_inference()
+    if inference is not None:
+        return inference.embed_face_images(crops)
+    model, device = get_embedding_model()
+    return embed_face_images(model, device, crops)
+
+@app.post("/match", summary="Match embedding vectors against galleries")
+async def match_faces(request: MatchRequest):
+    """
+    Match embeddings computed by /embed (or by the client) against the selected galleries
+    
+    Embeddings are sent either as lists of floats or base64 little-endian float16 vectors.
+    
+    Returns:
+    - The top_k matches above the threshold for every embedding, best first
+    """
+    if request.embeddings_b64:
+        try:
+            vectors = [np.frombuffer(base64.b64decode(v), dtype="<f2").astype(np.float32)
+                       for v in request.embeddings_b64]
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid base64 embedding")
+    elif request.embeddings:
+        vectors = [np.asarray(v, dtype=np.float32) for v in request.embeddings]
+    else:
+        raise HTTPException(status_code=400, detail="No embeddings provided")
+    
+    gallery_paths = []
+    for gallery_name in request.galleries:
+        found_path = gallery_names.resolve(gallery_name)
+        if found_path is None:
+            raise HTTPException(status_code=404, detail=f"Gallery not found: {gallery_name}")
+        gallery_paths.append(found_path)
+    
+    def match():
+        # A union missing from the cache is loaded and verified from disk, and matching
+        # a large one takes a while, so neither runs on the event loop
+        combined_gallery = gallery_unions.get(gallery_paths)
+        if not len(combined_gallery):
+            return [[] for _ in vectors]
+        
+        if (request.model_fingerprint and combined_gallery.model_fingerprint
+                and request.model_fingerprint != combined_gallery.model_fingerprint):
+            raise HTTPException(status_code=409,
+                                detail="Embeddings were computed with a different model than the galleries")
+        if any(v.ndim != 1 or len(v) != combined_gallery.dim for v in vectors):
+            raise HTTPException(status_code=400,
+                                detail=f"Embeddings must have {combined_gallery.dim} dimensions")
+        
+        return match_embeddings(combined_gallery, np.stack(vectors), request.threshold,
+                                top_k=request.top_k, nprobe=ann_nprobe)
+    
+    matches = await run_in_threadpool(match)
+    return {
+        "results": [
+            {"matches": [{"identity": identity, "similarity": score} for identity, score in face_matches]}
+            for face_matches in matches
+        ]
+    }
+
+def process_stream_frame(recognizer: VideoRecognizer, data: bytes, frame_index: int) -> Dict[str, Any]:
+    """Decode one frame of a recognition stream and track/recognize its faces"""
+    start = time.time()
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return {"frame": frame_index, "error": "Invalid frame"}
+    with _recognition_lock if recognizer.inference is None else nullcontext():
+        faces = recognizer.process_frame(frame, frame_index)
+    return {
+        "frame": frame_index,
+        "faces": [[f["track_id"], *f["bbox"], f["identity"], round(f["similarity"], 4)] for f in faces],
+        "embedded": sum(f["embedded"] for f in faces),
+        "ms": round((time.time() - start) * 1000, 1)
+    }
+
+@app.websocket("/ws/recognize")
+async def recognize_stream(websocket: WebSocket):
+    """
+    Recognize faces in a live stream of frames
+    
+    Protocol:
+    - A JSON text message configures the stream and must come first:
+      {"galleries": [...], "threshold": 0.45, "reembed_every": 15, "source": "camera-1"}
+      A source with a stored region of interest limits detection to that region.
+      Sending it again switches galleries/settings and resets the tracks.
+    - Binary messages are encoded frames (JPEG or PNG).
+    - For every processed frame the server sends
+      {"frame": n, "faces": [[track_id, x1, y1, x2, y2, identity, similarity], ...],
+       "embedded": faces embedded in this frame, "dropped": frames dropped so far, "ms": processing time}
+    
+    Frames that arrive while another one is being processed replace each other, so the
+    server always works on the newest frame and never builds up a backlog.
+    """
+    await websocket.accept()
+    state = {"frame": None, "received": 0, "dropped": 0, "closed": False,
+             "recognizer": None, "gallery_paths": [], "versions": None}
+    frame_ready = asyncio.Event()
+    
+    async def configure(config):
+        gallery_paths = [gallery_names.resolve(name) for name in config.get("galleries", [])]
+        missing = [name for name, path in zip(config.get("galleries", []), gallery_paths) if path is None]
+        if missing or not gallery_paths:
+            await websocket.send_json({"error": f"Galleries not found: {missing or 'none selected'}"})
+            return
+        
+        model, device, yolo_model, inference = await run_in_threadpool(get_tracking_models)
+        gallery = await run_in_threadpool(gallery_unions.get, gallery_paths)
+        roi_polygons = database.get_camera_roi(str(config["source"])) if config.get("source") else None
+        state["recognizer"] = VideoRecognizer(
+            model, device, yolo_model, gallery,
+            threshold=float(config.get("threshold", 0.45)),
+            nprobe=ann_nprobe,
+            roi=DetectionROI(roi_polygons) if roi_polygons else None,
+            inference=inference,
+            reembed_every=int(config.get("reembed_every", 15))
+        )
+        state["gallery_paths"] = gallery_paths
+        state["versions"] = tuple(gallery_cache.version(path) for path in gallery_paths)
+        await websocket.send_json({"configured": True, "galleries": [os.path.basename(p) for p in gallery_paths],
+                                   "identities": len(gallery)})
+    
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("text") is not None:
+                    try:
+                        await configure(json.loads(message["text"]))
+                    except (ValueError, AttributeError) as e:
+                        await websocket.send_json({"error": f"Invalid configuration: {e}"})
+                elif message.get("bytes") is not None:
+                    if state["frame"] is not None:
+                        state["dropped"] += 1
+                    state["frame"] = (state["received"], message["bytes"])
+                    state["received"] += 1
+                    frame_ready.set()
+        finally:
+            state["closed"] = True
+            frame_ready.set()
+    
+    receiver = asyncio.create_task(receive_frames())
+    try:
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if state["closed"]:
+                break
+            if state["frame"] is None:
+                continue
+            frame_index, data = state["frame"]
+            state["frame"] = None
+            
+            recognizer = state["recognizer"]
+            if recognizer is None:
+                await websocket.send_json({"frame": frame_index, "error": "Send the stream configuration first"})
+                continue
+            
+            # Pick up gallery changes (rebuilds, added identities) without resetting the tracks
+            versions = tuple(gallery_cache.version(path) for path in state["gallery_paths"])
+            if versions != state["versions"]:
+                recognizer.gallery = await run_in_threadpool(gallery_unions.get, state["gallery_paths"])
+                state["versions"] = versions
+            
+            result = await run_in_threadpool(process_stream_frame, recognizer, data, frame_index)
+            result["dropped"] = state["dropped"]
+            await websocket.send_json(result)
+    except Exception as e:
+        if not state["closed"]:
+            print(f"Error in recognition stream: {e}")
+    finally:
+        receiver.cancel()
+        if state["recognizer"] is not None:
+            stats = state["recognizer"].tracker.stats()
+            print(f"Recognition stream closed: {state['received']} frames received, "
+                  f"{state['dropped']} dropped, {stats['embeddings']} of {stats['faces_seen']} faces embedded")
+
+@app.get("/cameras/rois", summary="List camera regions of interest")
+async def list_camera_rois():
+    """Region of interest polygons of every camera source that has one"""
+    rois = database.list_camera_rois()
+    return {"rois": rois, "count": len(rois)}
+
+@app.post("/cameras/rois", summary="Set the region of interest of a camera source")
+async def set_camera_roi(
+    source: str = Form(...),
+    polygons: str = Form(...)
+):
+    """
+    Restrict face detection for a camera source to a region of interest
+    
+    Parameters:
+    - source: Camera source as given to attendance sessions, /recognize or /ws/recognize
+    - polygons: JSON list of polygons, each a list of [x, y] points in frame pixels,
+      e.g. [[[0, 200], [1920, 200], [1920, 1080], [0, 1080]]]
+    
+    Frames are cropped to the polygons' bounding box and masked outside the polygons
+    before detection. Running attendance sessions pick up the change at their next snapshot.
+    """
+    try:
+        roi = DetectionROI(json.loads(polygons))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid polygons: {e}")
+    
+    database.set_camera_roi(source, roi.to_list())
+    return {"source": source, "polygons": roi.to_list()}
+
+@app.delete("/cameras/rois", summary="Remove the region of interest of a camera source")
+async def delete_camera_roi(source: str = Query(...)):
+    """Detect faces in the whole frame of a camera source again"""
+    if not database.delete_camera_roi(source):
+        raise HTTPException(status_code=404, detail=f"No region of interest for source: {source}")
+    return {"source": source, "deleted": True}
+
+@app.post("/attendance/sessions", summary="Start a camera attendance session")
+async def start_attendance_session(
+    year: str = Form(...),
+    department: str = Form(...),
+    source: str = Form(...),
+    threshold: float = Form(0.45),
+    motion_threshold: float = Form(2.0),
+    confirm_votes: int = Form(3),
+    snapshot_interval: float = Form(30.0)
+):
+    """
+    Start taking attendance from a camera against a department/year gallery
+    
+    Parameters:
+    - year, department: Gallery to recognize against (its identities are the roster)
+    - source: Camera index, stream URL, video file or directory of frames
+    - threshold: Similarity threshold (0-1)
+    - motion_threshold: Frames differing less than this (mean absolute difference, 0-255)
+      from the last analysed frame skip detection
+    - confirm_votes: Matching embeddings needed to mark someone present
+    - snapshot_interval: Seconds between snapshots of the table to the database
+    
+    The session runs in a background thread of the worker that started it; other
+    workers serve its status from the latest database snapshot.
+    """
+    gallery_path = get_existing_gallery_path(year, department)
+    if not (source.isdigit() or "://" in source or os.path.exists(source)):
+        raise HTTPException(status_code=404, detail=f"Camera source not found: {source}")
+    
+    def start():
+        # Loading the models and the gallery and registering the session all block. Sessions
+        # use the worker's shared detector: they only run it holding the recognition lock.
+        model, device, yolo_model, inference = get_tracking_models()
+        return attendance.start_session(
+            year, department, gallery_path, source, model, device, yolo_model,
+            threshold=threshold, motion_threshold=motion_threshold, confirm_votes=confirm_votes,
+            snapshot_interval=snapshot_interval, nprobe=ann_nprobe,
+            lock=_recognition_lock if inference is None else None, inference=inference
+        )
+    
+    try:
+        session = await run_in_threadpool(start)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"session_id": session.session_id, "status": session.status, "roster_count": len(session.records)}
+
+@app.get("/attendance/sessions", summary="List attendance sessions")
+async def list_attendance_sessions():
+    """List all attendance sessions with their present counts"""
+    sessions = database.list_attendance_sessions()
+    running = {session.session_id: session.status for session in attendance.list_sessions()}
+    for session in sessions:
+        if session["session_id"] in running:
+            session["status"] = running[session["session_id"]]
+    return {"sessions": sessions, "count": len(sessions)}
+
+def get_stored_attendance_session(session_id: str) -> Dict[str, Any]:
+    """Latest database snapshot of a session that ended or runs in another worker"""
+    stored = database.get_attendance_session(session_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Attendance session not found: {session_id}")
+    stored["stats"] = json.loads(stored["stats"]) if stored.get("stats") else None
+    stored["present"] = [r["identity"] for r in stored["records"] if r["present"]]
+    stored["absent"] = [r["identity"] for r in stored["records"] if not r["present"]]
+    return stored
+
+@app.get("/attendance/sessions/{session_id}", summary="Get the attendance table of a session")
+async def get_attendance_session(session_id: str):
+    """Live present/absent table of a session, or its latest snapshot if it ended or runs in another worker"""
+    session = attendance.get_session(session_id)
+    if session is not None:
+        return session.summary()
+    return get_stored_attendance_session(session_id)
+
+@app.post("/attendance/sessions/{session_id}/stop", summary="Stop an attendance session")
+async def stop_attendance_session(session_id: str):
+    """Stop a running session and store its final attendance table"""
+    if attendance.get_session(session_id) is None:
+        stored = get_stored_attendance_session(session_id)
+        if stored["status"] == "running":
+            raise HTTPException(status_code=409, detail="Session is not running in this worker")
+        return stored
+    
+    session = await run_in_threadpool(attendance.stop_session, session_id)
+    if session is None:
+        # It ended on its own in the meantime
+        return get_stored_attendance_session(session_id)
+    return session.summary()
+
 def get_student_data_folders():
     """Get all department-year folders from student data directory"""
     folders = []
@@ -1426,45 +2401,49 @@ def process_student_video(student: StudentInfo) -> Dict[str, Any]:
 
 @app.post("/student-data/{dept}/{year}/process", 
           summary="Process students' videos to extract faces")
-async def process_students_videos(dept: str, year: str):
+def process_students_videos(dept: str, year: str):
     """Process all pending students' videos in a department-year to extract faces"""
     try:
-        # Get pending students
-        students = get_students_in_folder(dept, year)
-        pending_students = [s for s in students if s.videoUploaded and not s.facesExtracted]
-        
-        if not pending_students:
-            return {
-                "success": True,
-                "message": "No pending students to process",
-                "processed_count": 0
-            }
-        
-        # Process each student
-        results = []
-        processed_count = 0
-        
-        for student in pending_students:
-            result = process_student_video(student)
-            results.append({
-                "student": student.regNo,
-                "name": student.name,
-                "result": result
-            })
-            
-            if result["success"]:
-                processed_count += 1
-        
+        # In a niced job process with the bulk thread budget, so recognition keeps its cores
+        return run_bulk_job(process_pending_students, dept, year, **bulk_job_limits())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing students: {str(e)}")
+
+def process_pending_students(dept: str, year: str) -> Dict[str, Any]:
+    """Extract the faces of every student of a department-year whose video is still pending"""
+    # Get pending students
+    students = get_students_in_folder(dept, year)
+    pending_students = [s for s in students if s.videoUploaded and not s.facesExtracted]
+    
+    if not pending_students:
         return {
             "success": True,
-            "message": f"Processed {processed_count} out of {len(pending_students)} students",
-            "processed_count": processed_count,
-            "total_pending": len(pending_students),
-            "details": results
+            "message": "No pending students to process",
+            "processed_count": 0
         }
+    
+    # Process each student
+    results = []
+    processed_count = 0
+    
+    for student in pending_students:
+        result = process_student_video(student)
+        results.append({
+            "student": student.regNo,
+            "name": student.name,
+            "result": result
+        })
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing students: {str(e)}")
+        if result["success"]:
+            processed_count += 1
+    
+    return {
+        "success": True,
+        "message": f"Processed {processed_count} out of {len(pending_students)} students",
+        "processed_count": processed_count,
+        "total_pending": len(pending_students),
+        "details": results
+    }
 
 @app.get("/api/collection-app-config", summary="Get face collection app configuration")
 async def get_collection_app_config():
@@ -1473,8 +2452,99 @@ async def get_collection_app_config():
         "port": collection_app_port
     }
 
+def preload_for_workers():
+    """
+    Load the models and registered galleries in the master process before forking
+    
+    The models are switched to inference (eval, no gradients, YOLO layers fused, which
+    YOLO would otherwise do in every worker) and the loaded objects are moved out of
+    the garbage collector's reach with gc.freeze(), so collections in the workers don't
+    write to, and thereby copy, the shared pages. Nothing is run on the models here:
+    the workers' torch thread pools start after the fork.
+    """
+    start = time.time()
+    if inference_processes > 0:
+        print("Preload: models live in the inference processes, preloading galleries only")
+    elif torch.cuda.is_available():
+        # CUDA can't be used across fork; each worker initialises its own context
+        print("Preload: CUDA device found, models are loaded in the workers")
+    else:
+        model, _ = get_embedding_model()
+        model.eval()
+        for parameter in model.parameters():
+            parameter.requires_grad_(False)
+        yolo_model = get_yolo_model()
+        yolo_model.fuse()
+        for parameter in yolo_model.model.parameters():
+            parameter.requires_grad_(False)
+    
+    galleries = 0
+    for entry in database.list_all_galleries():
+        if os.path.exists(entry["file_path"]) and gallery_cache.get(entry["file_path"]) is not None:
+            galleries += 1
+    gallery_names.names()
+    
+    gc.collect()
+    gc.freeze()
+    print(f"Preloaded models and {galleries} galleries in {time.time() - start:.1f}s "
+          f"({gc.get_freeze_count()} objects frozen)")
+
+def run_preloaded_server():
+    """Run gunicorn with uvicorn workers forked from a master that preloaded everything"""
+    from gunicorn.app.base import BaseApplication
+    
+    # Loading must not start torch's thread pool in the master (forking it can hang the
+    # workers), so the master runs single-threaded and the workers get their planned threads
+    torch.set_num_threads(1)
+    
+    # Worker indices for pinning, handed out in the master: a respawned worker takes
+    # the index its predecessor gave back, so pinned workers keep distinct cores
+    free_indices = set(range(workers))
+    
+    def pre_fork(server, worker):
+        worker.index = min(free_indices) if free_indices else None
+        free_indices.discard(worker.index)
+    
+    def child_exit(server, worker):
+        if getattr(worker, "index", None) is not None:
+            free_indices.add(worker.index)
+    
+    def post_fork(server, worker):
+        apply_thread_budget(resource_plan, worker_index=worker.index)
+    
+    class PreloadedApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("pre_fork", pre_fork)
+            self.cfg.set("child_exit", child_exit)
+            self.cfg.set("post_fork", post_fork)
+        
+        def load(self):
+            preload_for_workers()
+            return app
+    
+    PreloadedApplication().run()
+
 if __name__ == "__main__":
     import uvicorn
     
-    print(f"Starting server on {host}:{port} with {workers} workers")
-    uvicorn.run("main:app", host=host, port=port, workers=workers)
\ No newline at end of file
+    inference_servers = []
+    if inference_processes > 0:
+        inference_servers = start_inference_servers(
+            DEFAULT_MODEL_PATH, DEFAULT_YOLO_PATH, inference_processes, inference_address,
+            threads=resource_plan["inference_threads"],
+            cpu_sets=resource_plan["cpu_sets"]["compute"] if resource_plan["cpu_sets"] else None
+        )
+    
+    print(f"Starting server on {host}:{port} with {workers} workers{' (preloaded)' if preload else ''}")
+    try:
+        if preload:
+            run_preloaded_server()
+        else:
+            uvicorn.run("main:app", host=host, port=port, workers=workers)
+    finally:
+        for server in inference_servers:
+            server.terminate()
\ No newline at end of file
@@ -0,0 +1,230 @@
+import os
+import math
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Descriptor of the worker slot lock this process holds (see claim_worker_index)
+_worker_slot = None
+
+def _cgroup_paths():
+    """cgroup directories of this process, v2 first, then v1 cpu controllers"""
+    paths = []
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                _, controllers, path = line.strip().split(":", 2)
+                path = path.lstrip("/")
+                if controllers == "":
+                    paths.append(("v2", os.path.join("/sys/fs/cgroup", path)))
+                    paths.append(("v2", "/sys/fs/cgroup"))
+                elif "cpu" in controllers.split(","):
+                    for mount in ("cpu", "cpu,cpuacct", "cpuacct,cpu"):
+                        paths.append(("v1", os.path.join("/sys/fs/cgroup", mount, path)))
+                        paths.append(("v1", os.path.join("/sys/fs/cgroup", mount)))
+    except OSError:
+        pass
+    return paths
+
+def cgroup_cpu_limit():
+    """
+    CPU limit of this process's cgroup in cores (quota / period), or None if unlimited
+    """
+    for version, path in _cgroup_paths():
+        try:
+            if version == "v2":
+                with open(os.path.join(path, "cpu.max")) as f:
+                    quota, period = f.read().split()[:2]
+                if quota == "max":
+                    return None
+                return int(quota) / int(period)
+            with open(os.path.join(path, "cpu.cfs_quota_us")) as f:
+                quota = int(f.read())
+            with open(os.path.join(path, "cpu.cfs_period_us")) as f:
+                period = int(f.read())
+            return None if quota <= 0 else quota / period
+        except (OSError, ValueError):
+            continue
+    return None
+
+def available_cpus():
+    """
+    Cores this process may actually use
+
+    Returns:
+        (number of cores, list of usable CPU ids, what limited the count)
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpu_ids = sorted(os.sched_getaffinity(0))
+        source = "affinity"
+    else:
+        cpu_ids = list(range(os.cpu_count() or 1))
+        source = "cpu_count"
+    cpus = len(cpu_ids)
+    limit = cgroup_cpu_limit()
+    if limit is not None and math.ceil(limit) < cpus:
+        cpus = max(1, math.ceil(limit))
+        source = "cgroup quota"
+    return cpus, cpu_ids, source
+
+def _split(cpu_ids, parts):
+    """Split CPU ids into parts contiguous, near-equal chunks"""
+    size, extra = divmod(len(cpu_ids), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(cpu_ids[start:end] or cpu_ids)
+        start = end
+    return chunks
+
+def plan_resources(workers=None, inference_processes=0, bulk_share=0.25, threads_per_worker=4, pin=False,
+                   cpus=None):
+    """
+    Share the available cores between HTTP workers, inference processes and bulk jobs
+
+    A bulk_share of the cores (at least one) is set aside for gallery builds and video
+    processing; the rest serves interactive requests. Without inference processes each
+    HTTP worker runs the models itself and gets an equal share of torch/OpenCV threads
+    (by default about threads_per_worker each, which decides the worker count). With
+    inference processes the HTTP workers only decode and encode, so they run single-
+    threaded and the interactive cores go to the inference processes.
+
+    Args:
+        workers: HTTP worker count (default: planned)
+        inference_processes: Number of dedicated inference processes (0 = none)
+        bulk_share: Share of the cores reserved for bulk jobs
+        threads_per_worker: Target torch threads per HTTP worker when planning the worker count
+        pin: Give each process its own CPU set (only where the CPU ids are known)
+        cpus: Core count to plan for (default: detected, honouring cgroup limits)
+
+    Returns:
+        Dictionary with the plan
+    """
+    detected, cpu_ids, source = available_cpus()
+    if cpus:
+        source = "configured"
+    cpus = max(1, cpus or detected)
+    # Only pin to as many CPU ids as the quota allows
+    cpu_ids = cpu_ids[:cpus]
+
+    bulk_cpus = max(1, int(cpus * bulk_share)) if cpus > 1 else 1
+    interactive_cpus = max(1, cpus - bulk_cpus) if cpus > 1 else 1
+
+    if inference_processes > 0:
+        workers = workers or max(1, min(interactive_cpus, 4))
+        torch_threads = 1
+        inference_threads = max(1, interactive_cpus // inference_processes)
+    else:
+        workers = workers or max(1, interactive_cpus // threads_per_worker)
+        torch_threads = max(1, interactive_cpus // workers)
+        inference_threads = 0
+
+    plan = {
+        "cpus": cpus,
+        "detected_cpus": detected,
+        "cgroup_cpu_limit": cgroup_cpu_limit(),
+        "source": source,
+        "interactive_cpus": interactive_cpus,
+        "bulk_cpus": bulk_cpus,
+        "http_workers": workers,
+        "torch_threads": torch_threads,
+        "opencv_threads": torch_threads,
+        "inference_processes": inference_processes,
+        "inference_threads": inference_threads,
+        "pinned": bool(pin and len(cpu_ids) > 1),
+        "cpu_sets": None
+    }
+
+    if plan["pinned"]:
+        bulk_ids = cpu_ids[len(cpu_ids) - bulk_cpus:] if len(cpu_ids) > bulk_cpus else cpu_ids
+        interactive_ids = cpu_ids[:len(cpu_ids) - bulk_cpus] or cpu_ids
+        compute_processes = inference_processes if inference_processes > 0 else workers
+        plan["cpu_sets"] = {
+            "bulk": bulk_ids,
+            "compute": _split(interactive_ids, compute_processes),
+            # With inference processes, the HTTP workers share the interactive cores
+            "http": interactive_ids if inference_processes > 0 else None
+        }
+    return plan
+
+def apply_thread_budget(plan, worker_index=None, role="http"):
+    """
+    Apply a plan's thread counts (and CPU set, if pinned) to the current process
+
+    Args:
+        plan: Result of plan_resources()
+        worker_index: Index of this process among its role, for pinning
+        role: "http" for an HTTP worker, "inference" for an inference process
+    """
+    import torch
+    import cv2
+
+    threads = plan["inference_threads"] if role == "inference" else plan["torch_threads"]
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+    cpu_sets = plan.get("cpu_sets")
+    if cpu_sets and worker_index is not None and hasattr(os, "sched_setaffinity"):
+        if role == "http" and cpu_sets["http"] is not None:
+            cpu_set = cpu_sets["http"]
+        else:
+            cpu_set = cpu_sets["compute"][worker_index % len(cpu_sets["compute"])]
+        os.sched_setaffinity(0, cpu_set)
+
+def claim_worker_index(directory, count):
+    """
+    Take the lowest free worker index of a server for this process, for pinning
+
+    Index i is held as an exclusive lock on {directory}/worker.{i}.lock for the life of
+    the process, and the kernel releases it when the process dies, so a respawned worker
+    gets the index of the one it replaces. Used by workers that are started without an
+    index (plain uvicorn --workers N, or gunicorn without preload).
+
+    Returns:
+        The worker index, or None if all count indices are taken or file locks aren't
+        available (Windows)
+    """
+    global _worker_slot
+    if fcntl is None:
+        return None
+    if _worker_slot is not None:
+        return _worker_slot[0]
+    os.makedirs(directory, exist_ok=True)
+    for index in range(count):
+        fd = os.open(os.path.join(directory, f"worker.{index}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        _worker_slot = (index, fd)
+        return index
+    return None
+
+def current_resources():
+    """Effective thread counts and CPU set of the current process"""
+    import torch
+    import cv2
+
+    return {
+        "pid": os.getpid(),
+        "torch_threads": torch.get_num_threads(),
+        "torch_interop_threads": torch.get_num_interop_threads(),
+        "opencv_threads": cv2.getNumThreads(),
+        "cpu_affinity": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    }
+
+if __name__ == "__main__":
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the CPU plan for the server")
+    parser.add_argument("--workers", type=int, help="HTTP worker count (default: planned)")
+    parser.add_argument("--inference_processes", type=int, default=0, help="Dedicated inference processes")
+    parser.add_argument("--cpus", type=int, help="Plan for this many cores instead of the detected ones")
+    parser.add_argument("--pin", action="store_true", help="Include CPU sets for pinning")
+    args = parser.parse_args()
+
+    print(json.dumps(plan_resources(args.workers, args.inference_processes, pin=args.pin, cpus=args.cpus), indent=2))
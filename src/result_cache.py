@@ -0,0 +1,124 @@
+import copy
+import asyncio
+from collections import OrderedDict
+
+def approximate_size(value):
+    """Rough size in bytes of a JSON-like result (strings and bytes dominate, e.g. base64 images)"""
+    if isinstance(value, (str, bytes)):
+        return len(value) + 50
+    if isinstance(value, dict):
+        return 64 + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(approximate_size(item) for item in value)
+    return 32
+
+class ResultCache:
+    """
+    Bounded LRU cache of request results with single-flight coalescing
+
+    The first request for a key starts the computation as its own task; identical
+    requests arriving while it runs await the same task instead of starting another
+    one. A cancelled request (e.g. a client that disconnected) doesn't cancel the
+    shared computation. Only successful results are cached, so a failed computation
+    is retried by the next request.
+
+    The cache holds at most max_entries results and at most max_bytes bytes of them
+    (as estimated by sizeof), least recently used first out; a single result larger
+    than max_bytes isn't cached. Every caller gets its own copy of a result, so one
+    request changing its response can't alter what others receive.
+
+    Meant to be used from a single event loop (one per worker process).
+    """
+
+    def __init__(self, max_entries=64, max_bytes=None, sizeof=approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._results = OrderedDict()
+        self._sizes = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Get the cached result for key, or compute it once for all concurrent callers
+
+        Args:
+            key: Hashable cache key
+            compute: Zero-argument coroutine function producing the result
+            cacheable: Optional predicate; results it rejects are shared with the
+                concurrent callers but not cached
+        """
+        if key in self._results:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(self._results[key])
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self._pending[key] = task
+            task.add_done_callback(lambda t, key=key: self._finish(key, t, cacheable))
+        else:
+            self.coalesced += 1
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def peek(self, key):
+        """The cached result for key, or None; never computes or waits"""
+        if key not in self._results:
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(self._results[key])
+
+    def put(self, key, value):
+        """Cache (a copy of) a result computed elsewhere, within the same bounds"""
+        self._store(key, copy.deepcopy(value))
+
+    def _finish(self, key, task, cacheable=None):
+        self._pending.pop(key, None)
+        # Calling exception() also marks a failure as retrieved when nobody awaited it
+        if task.cancelled() or task.exception() is not None:
+            return
+        if cacheable is not None and not cacheable(task.result()):
+            return
+        self._store(key, task.result())
+
+    def _store(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._evict(key)
+        self._results[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while len(self._results) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._evict(next(iter(self._results)))
+
+    def _evict(self, key):
+        if key in self._results:
+            del self._results[key]
+            self.bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        self._results.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._results),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "in_flight": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import time
+
+import cv2
+import websockets
+
+async def stream_video(url, source, galleries, threshold=0.45, fps=None, jpeg_quality=80, max_frames=None):
+    """
+    Stream a video file (or camera) to the /ws/recognize endpoint like a live camera
+
+    Frames are sent at the video's frame rate regardless of how fast the server answers,
+    so a slow server drops frames exactly as it would for a real camera.
+
+    Args:
+        url: WebSocket URL of the endpoint, e.g. ws://localhost:8000/ws/recognize
+        source: Video file path, or a camera index
+        galleries: Gallery names to recognize against
+        threshold: Similarity threshold
+        fps: Frames per second to send (default: the video's frame rate)
+        jpeg_quality: JPEG quality of the sent frames
+        max_frames: Stop after this many frames
+    """
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source: {source}")
+    fps = fps or capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+    stats = {"sent": 0, "results": 0, "dropped": 0, "ms": 0.0}
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({"galleries": galleries, "threshold": threshold}))
+        print(await ws.recv())
+
+        async def receive():
+            async for message in ws:
+                result = json.loads(message)
+                if "error" in result:
+                    print(f"Server error: {result['error']}")
+                    continue
+                stats["results"] += 1
+                stats["dropped"] = result["dropped"]
+                stats["ms"] += result["ms"]
+                names = ", ".join(f"#{face[0]} {face[5]} ({face[6]:.2f})" for face in result["faces"])
+                print(f"frame {result['frame']:>6}  {result['ms']:>7.1f} ms  {names}")
+
+        receiver = asyncio.create_task(receive())
+        start = time.time()
+        try:
+            while max_frames is None or stats["sent"] < max_frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if ok:
+                    await ws.send(buffer.tobytes())
+                    stats["sent"] += 1
+                # Pace the frames like a camera would
+                delay = start + stats["sent"] / fps - time.time()
+                await asyncio.sleep(max(0.0, delay))
+
+            # Give the server a moment to answer the last frame
+            await asyncio.sleep(1.0)
+        finally:
+            receiver.cancel()
+            capture.release()
+
+    elapsed = time.time() - start
+    print(f"Sent {stats['sent']} frames in {elapsed:.1f}s, {stats['results']} results, "
+          f"{stats['dropped']} dropped by the server, "
+          f"{stats['ms'] / max(1, stats['results']):.1f} ms per processed frame")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a video file to the recognition WebSocket endpoint")
+    parser.add_argument("--url", default="ws://localhost:8000/ws/recognize", help="WebSocket endpoint URL")
+    parser.add_argument("--video", required=True, help="Video file path, or camera index")
+    parser.add_argument("--galleries", nargs="+", required=True, help="Gallery names to recognize against")
+    parser.add_argument("--threshold", type=float, default=0.45, help="Similarity threshold")
+    parser.add_argument("--fps", type=float, help="Frames per second to send (default: the video's frame rate)")
+    parser.add_argument("--max_frames", type=int, help="Stop after this many frames")
+    args = parser.parse_args()
+
+    asyncio.run(stream_video(args.url, args.video, args.galleries, args.threshold, args.fps,
+                             max_frames=args.max_frames))
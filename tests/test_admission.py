@@ -0,0 +1,144 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import admission
+from admission import AdmissionController, AdmissionRejected, ProcessSlots, WorkClass
+
+def make_controller(interactive_limit=2, bulk_limit=1, total_limit=2, queue_timeout=1.0, bulk_shared=None):
+    return AdmissionController([
+        WorkClass("interactive", interactive_limit, queue_size=4, queue_timeout=queue_timeout, retry_after=1, priority=0),
+        WorkClass("bulk", bulk_limit, queue_size=1, queue_timeout=queue_timeout, retry_after=60, priority=1,
+                  shared=bulk_shared)
+    ], total_limit=total_limit)
+
+async def hold(controller, name, started, release, order=None):
+    async with controller.admit(name):
+        if order is not None:
+            order.append(name)
+        started.set()
+        await release.wait()
+
+def test_class_limit_queues_and_dispatches_in_order():
+    async def run():
+        controller = make_controller(interactive_limit=1, total_limit=None)
+        release = asyncio.Event()
+        order = []
+        first = asyncio.ensure_future(hold(controller, "interactive", asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(hold(controller, "interactive", asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        assert controller.classes["interactive"].active == 1
+        assert len(controller.classes["interactive"].waiters) == 1
+        release.set()
+        await asyncio.gather(first, second)
+        assert order == ["interactive", "interactive"]
+        assert controller.active == 0
+    asyncio.run(run())
+
+def test_full_queue_is_rejected_with_429():
+    async def run():
+        controller = make_controller(bulk_limit=1, total_limit=None)
+        release = asyncio.Event()
+        running = asyncio.ensure_future(hold(controller, "bulk", asyncio.Event(), release))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(hold(controller, "bulk", asyncio.Event(), release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.admit("bulk"):
+                pass
+        assert rejected.value.status_code == 429
+        assert rejected.value.retry_after == 60
+        release.set()
+        await asyncio.gather(running, queued)
+    asyncio.run(run())
+
+def test_wait_timeout_is_rejected_with_503():
+    async def run():
+        controller = make_controller(interactive_limit=1, total_limit=None, queue_timeout=0.05)
+        release = asyncio.Event()
+        running = asyncio.ensure_future(hold(controller, "interactive", asyncio.Event(), release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.admit("interactive"):
+                pass
+        assert rejected.value.status_code == 503
+        assert controller.classes["interactive"].timed_out == 1
+        assert not controller.classes["interactive"].waiters
+        release.set()
+        await running
+        assert controller.active == 0
+    asyncio.run(run())
+
+def test_freed_shared_slot_goes_to_higher_priority_class():
+    async def run():
+        controller = make_controller(interactive_limit=2, bulk_limit=2, total_limit=1)
+        release_first = asyncio.Event()
+        release_rest = asyncio.Event()
+        order = []
+        first = asyncio.ensure_future(hold(controller, "bulk", asyncio.Event(), release_first))
+        await asyncio.sleep(0)
+        # Queued bulk first, interactive second: interactive still gets the freed slot first
+        bulk = asyncio.ensure_future(hold(controller, "bulk", asyncio.Event(), release_rest, order))
+        await asyncio.sleep(0)
+        interactive_started = asyncio.Event()
+        interactive = asyncio.ensure_future(hold(controller, "interactive", interactive_started, release_rest, order))
+        await asyncio.sleep(0)
+        release_first.set()
+        await first
+        await asyncio.wait_for(interactive_started.wait(), 1.0)
+        assert order == ["interactive"]
+        release_rest.set()
+        await asyncio.gather(bulk, interactive)
+        assert order == ["interactive", "bulk"]
+    asyncio.run(run())
+
+def test_lower_priority_class_leaves_last_shared_slot_to_waiting_higher_priority():
+    controller = make_controller(interactive_limit=1, bulk_limit=2, total_limit=2)
+    interactive, bulk = controller.classes["interactive"], controller.classes["bulk"]
+    controller._start(interactive)
+    interactive.waiters.append(object())
+    interactive.active = 0
+    controller.active = 1
+    # One shared slot left and interactive is waiting for it
+    assert not controller._can_start(bulk)
+    interactive.waiters.clear()
+    assert controller._can_start(bulk)
+
+@pytest.mark.skipif(admission.fcntl is None, reason="needs fcntl")
+def test_process_slots_limit_across_holders(tmp_path):
+    # Two instances on the same directory stand in for two worker processes
+    first = ProcessSlots(str(tmp_path), "bulk", 1)
+    second = ProcessSlots(str(tmp_path), "bulk", 1)
+    handle = first.try_acquire()
+    assert handle is not None
+    assert second.try_acquire() is None
+    first.release(handle)
+    other = second.try_acquire()
+    assert other is not None
+    second.release(other)
+
+@pytest.mark.skipif(admission.fcntl is None, reason="needs fcntl")
+def test_bulk_waits_for_shared_slot_then_gives_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(admission, "SHARED_SLOT_POLL_INTERVAL", 0.01)
+
+    async def run():
+        other_worker = ProcessSlots(str(tmp_path), "bulk", 1)
+        handle = other_worker.try_acquire()
+        controller = make_controller(total_limit=None, queue_timeout=0.05,
+                                     bulk_shared=ProcessSlots(str(tmp_path), "bulk", 1))
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.admit("bulk"):
+                pass
+        assert rejected.value.status_code == 503
+        assert controller.classes["bulk"].active == 0
+
+        other_worker.release(handle)
+        async with controller.admit("bulk"):
+            assert other_worker.try_acquire() is None
+        assert controller.active == 0
+    asyncio.run(run())
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+gallery_manager = pytest.importorskip("gallery_manager")
+from gallery_manager import Gallery, ann_recall, load_gallery, match_embeddings, save_gallery
+
+DIM = 64
+
+def random_gallery(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return Gallery.from_dict({f"id{i:05d}": v for i, v in enumerate(rng.normal(size=(count, DIM)))})
+
+def noisy_queries(gallery, count, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=count, replace=False)
+    return gallery.matrix()[rows] + rng.normal(scale=0.5 / np.sqrt(DIM), size=(count, DIM))
+
+def best_matches(matches):
+    return [m[0][0] for m in matches]
+
+def test_ann_recall_floor():
+    # Unclustered random embeddings are the hard case for an IVF index
+    gallery = random_gallery(gallery_manager.ANN_MIN_IDENTITIES)
+    nlist = gallery.build_ann_index().nlist
+    recall = ann_recall(gallery, nprobe_values=(1, 8, nlist), queries=500)
+
+    assert recall[gallery_manager.ANN_DEFAULT_NPROBE] >= 0.95
+    assert recall[1] <= recall[8]
+    # Probing every list is an exact search
+    assert recall[nlist] == 1.0
+
+def test_galleries_switch_to_ann_search_at_the_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr(gallery_manager, "ANN_MIN_IDENTITIES", 500)
+
+    small = random_gallery(499)
+    path = str(tmp_path / "small.pth")
+    save_gallery(small, path)
+    assert load_gallery(path).ann_index is None
+
+    large = random_gallery(500)
+    path = str(tmp_path / "large.pth")
+    save_gallery(large, path)
+    assert load_gallery(path).ann_index is not None
+
+    # Below the threshold an index is ignored and matching stays exact
+    small.build_ann_index()
+    queries = noisy_queries(small, 200)
+    assert (best_matches(match_embeddings(small, queries, -1.0, top_k=1, nprobe=1)) ==
+            best_matches(match_embeddings(small, queries, -1.0, top_k=1, exact=True)))
+
+    # From the threshold on, probing a single list misses some best matches
+    large.build_ann_index()
+    queries = noisy_queries(large, 200)
+    approximate = best_matches(match_embeddings(large, queries, -1.0, top_k=1, nprobe=1))
+    exact = best_matches(match_embeddings(large, queries, -1.0, top_k=1, exact=True))
+    assert approximate != exact
+    assert sum(a == e for a, e in zip(approximate, exact)) >= len(queries) // 2
+
+def test_saves_keep_the_index_until_the_gallery_outgrows_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(gallery_manager, "ANN_MIN_IDENTITIES", 256)
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / "gallery.pth")
+    save_gallery(random_gallery(400), path)
+    gallery = load_gallery(path)
+    centroids = gallery.ann_index.centroids.copy()
+
+    # Identity changes follow the index; the next save doesn't re-cluster
+    gallery.set_identity("new", rng.normal(size=DIM))
+    gallery.remove_identity("id00000")
+    save_gallery(gallery, path)
+    saved = load_gallery(path)
+    np.testing.assert_array_equal(saved.ann_index.centroids, centroids)
+    assert len(saved.ann_index.assignments) == len(saved) == 400
+
+    # A gallery grown far past its cluster count is re-clustered
+    for i in range(1600):
+        saved.set_identity(f"grown{i:04d}", rng.normal(size=DIM))
+    save_gallery(saved, path)
+    regrown = load_gallery(path)
+    assert regrown.ann_index.nlist == round(np.sqrt(2000))
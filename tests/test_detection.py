@@ -0,0 +1,69 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+gallery_manager = pytest.importorskip("gallery_manager")
+from gallery_manager import DetectionROI, nms_boxes, tile_origins
+
+def test_tile_origins_cover_the_frame_with_overlap():
+    assert tile_origins(500, 640) == [0]
+    assert tile_origins(640, 640) == [0]
+
+    origins = tile_origins(1920, 640, overlap=0.2)
+    assert origins[0] == 0
+    # The last tile ends at the frame edge instead of running past it
+    assert origins[-1] == 1920 - 640
+    assert origins == sorted(set(origins))
+    for previous, current in zip(origins, origins[1:]):
+        assert previous + 640 - current >= 0.2 * 640
+
+def test_tile_origins_without_overlap_still_cover_the_frame():
+    origins = tile_origins(1000, 300, overlap=0.0)
+    covered = np.zeros(1000, dtype=bool)
+    for origin in origins:
+        covered[origin:origin + 300] = True
+    assert covered.all()
+    assert max(origins) + 300 == 1000
+
+def test_nms_keeps_the_best_of_overlapping_boxes():
+    boxes = [[0, 0, 100, 100],
+             [5, 5, 105, 105],      # overlaps the first one heavily
+             [200, 200, 260, 260],  # on its own
+             [0, 0, 100, 40]]       # overlaps the second one with IoU 0.31
+    scores = [0.8, 0.9, 0.5, 0.7]
+    assert nms_boxes(boxes, scores, iou_threshold=0.5) == [1, 3, 2]
+    assert nms_boxes(boxes, scores, iou_threshold=0.3) == [1, 2]
+
+def test_nms_of_no_boxes():
+    assert nms_boxes(np.zeros((0, 4)), np.zeros(0)) == []
+
+def test_roi_crops_and_masks_the_frame():
+    frame = np.full((100, 200, 3), 255, dtype=np.uint8)
+    roi = DetectionROI([[[50, 20], [149, 20], [149, 79], [50, 79]]])
+    image, offset = roi.apply(frame)
+    assert offset == (50, 20)
+    assert image.shape == (60, 100, 3)
+    assert image.all()
+
+    # A triangle blacks out the corner of its bounding box outside the polygon
+    triangle = DetectionROI([[[0, 0], [99, 0], [0, 99]]])
+    image, offset = triangle.apply(frame)
+    assert offset == (0, 0)
+    assert image.shape == (100, 100, 3)
+    assert image[5, 5].all()
+    assert not image[95, 95].any()
+
+def test_roi_outside_the_frame():
+    roi = DetectionROI([[[300, 300], [400, 300], [400, 400]]])
+    image, _ = roi.apply(np.zeros((100, 200, 3), dtype=np.uint8))
+    assert image is None
+
+def test_roi_needs_a_polygon():
+    with pytest.raises(ValueError):
+        DetectionROI([])
+    with pytest.raises(ValueError):
+        DetectionROI([[[0, 0], [10, 10]]])
@@ -0,0 +1,152 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+face_tracker = pytest.importorskip("face_tracker")
+from face_tracker import FaceTracker, Track, VideoRecognizer, box_iou
+from gallery_manager import Gallery
+
+def moved(box, dx, dy=0):
+    x1, y1, x2, y2 = box
+    return (x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+
+def test_box_iou():
+    iou = box_iou([(0, 0, 10, 10)], [(0, 0, 10, 10), (5, 0, 15, 10), (20, 20, 30, 30)])
+    np.testing.assert_allclose(iou, [[1.0, 50 / 150, 0.0]], rtol=1e-6)
+
+def test_alpha_beta_filter_follows_a_moving_face():
+    track = Track(1, (0, 0, 20, 20), frame_index=0)
+    assert track.predict() == (0, 0, 20, 20)
+
+    # The centre is pulled alpha=0.6 towards the detection and the velocity beta=0.2 of the residual
+    track.update((10, 0, 30, 20), frame_index=1)
+    np.testing.assert_allclose(track.predict(), (8, 0, 28, 20))
+    # Skipped frames extrapolate further
+    np.testing.assert_allclose(track.predict(frame_index=4), (12, 0, 32, 20))
+
+    box = (10, 0, 30, 20)
+    for frame in range(2, 30):
+        box = moved(box, 10)
+        track.update(box, frame)
+    np.testing.assert_allclose(track.predict(), moved(box, 10), atol=0.5)
+    assert track.hits == 30 and track.last_frame == 29
+
+def test_detections_are_associated_by_iou_with_the_predicted_boxes():
+    tracker = FaceTracker(iou_threshold=0.3)
+    left, right = (0, 0, 40, 40), (100, 0, 140, 40)
+    first = tracker.update([left, right], 0)
+    assert [track.track_id for track in first] == [1, 2]
+
+    # Both faces moved a bit and come back in the other order
+    second = tracker.update([moved(right, 5), moved(left, 5)], 1)
+    assert [track.track_id for track in second] == [2, 1]
+
+    # A face far from every track starts a new one
+    third = tracker.update([moved(left, 10), (300, 300, 340, 340)], 2)
+    assert [track.track_id for track in third] == [1, 3]
+
+def test_moving_face_is_found_again_after_skipped_frames():
+    tracker = FaceTracker(iou_threshold=0.3)
+    box = (0, 0, 40, 40)
+    for frame in range(20):
+        track = tracker.update([box], frame)[0]
+        box = moved(box, 10)
+    # Three frames later the face overlaps its last box by only 1/7, but matches the prediction
+    box = moved(box, 20)
+    assert box_iou([box], [track.box])[0, 0] < 0.3
+    assert tracker.update([box], 22)[0].track_id == track.track_id == 1
+
+def test_identity_is_confirmed_by_votes():
+    track = Track(1, (0, 0, 40, 40), 0, vote_window=3)
+    assert track.identity is None and track.candidates() == []
+
+    track.observe([("alice", 0.6), ("bob", 0.5)], 0)
+    track.observe([("bob", 0.7)], 1)
+    # alice 0.6 / 2 votes, bob (0.5 + 0.7) / 2 votes
+    assert track.candidates() == [("bob", pytest.approx(0.6)), ("alice", pytest.approx(0.3))]
+
+    track.observe([("alice", 0.9)], 2)
+    track.observe([("alice", 0.9)], 3)
+    # The first vote dropped out of the window of 3
+    assert track.identity == "alice"
+    assert track.candidates()[0][1] == pytest.approx(0.6)
+    summary = track.summary(fps=10)
+    assert summary["identity"] == "alice" and summary["best_similarity"] == pytest.approx(0.9)
+    assert summary["embeddings"] == 4 and summary["first_seen"] == 0.0
+
+def test_faces_are_reembedded_only_when_needed():
+    tracker = FaceTracker(reembed_every=5, reembed_iou=0.6, appearance_change=0.5)
+    box = (0, 0, 40, 40)
+    track = tracker.update([box], 0)[0]
+    assert track.needs_embedding
+    signature = np.zeros((16, 16), dtype=np.float32)
+    track.observe([("alice", 0.8)], 0, signature)
+
+    assert not tracker.update([moved(box, 2)], 1, [signature])[0].needs_embedding
+    # Changed appearance
+    assert tracker.update([moved(box, 2)], 2, [signature + 1.0])[0].needs_embedding
+    # Moved away from where it was embedded
+    assert tracker.update([moved(box, 18)], 3, [signature])[0].needs_embedding
+    assert not tracker.update([moved(box, 2)], 4, [signature])[0].needs_embedding
+    # Embedded reembed_every frames ago
+    assert tracker.update([moved(box, 2)], 5, [signature])[0].needs_embedding
+
+def test_tracks_expire_after_max_missed_frames():
+    tracker = FaceTracker(max_missed=2)
+    tracker.update([(0, 0, 40, 40), (100, 0, 140, 40)], 0)
+    for frame in range(1, 3):
+        tracker.update([(100, 0, 140, 40)], frame)
+    assert [track.track_id for track in tracker.tracks] == [1, 2]
+    assert tracker.tracks[0].missed == 2
+
+    tracker.update([(100, 0, 140, 40)], 3)
+    assert [track.track_id for track in tracker.tracks] == [2]
+    assert [track.track_id for track in tracker.finished] == [1]
+    assert [track.track_id for track in tracker.all_tracks()] == [1, 2]
+
+    # A face coming back after its track expired gets a new one
+    assert tracker.update([(0, 0, 40, 40), (100, 0, 140, 40)], 4)[0].track_id == 3
+    assert tracker.stats() == {"faces_seen": 7, "embeddings": 0, "embeddings_skipped": 7, "tracks": 3}
+
+class FakeInference:
+    """Embeds a crop as the gallery row of the person whose number fills it"""
+
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.calls = 0
+
+    def embed_face_images(self, faces):
+        self.calls += 1
+        return np.stack([np.eye(self.dim)[int(face[0, 0, 0]) % self.dim] + 0.1 for face in faces])
+
+def synthetic_detections(frames=8):
+    detections = []
+    for frame in range(frames):
+        faces = []
+        for person, x in ((1, 0), (2, 200)):
+            box = (x + 5 * frame, 0, x + 5 * frame + 40, 40)
+            crop = np.full((40, 40, 3), person, dtype=np.uint8)
+            crop[:, 20:] += 100
+            faces.append((box, crop))
+        detections.append(faces)
+    return detections
+
+def test_batched_frames_are_recognized_like_single_frames():
+    gallery = Gallery.from_dict({f"person{i}": np.eye(8)[i] for i in range(8)})
+    detections = synthetic_detections()
+    single = VideoRecognizer(None, None, None, gallery, inference=FakeInference(), reembed_every=3)
+    expected = [single.process_frame(None, frame, faces) for frame, faces in enumerate(detections)]
+
+    inference = FakeInference()
+    batched = VideoRecognizer(None, None, None, gallery, inference=inference, reembed_every=3)
+    results = batched.process_detections(list(range(len(detections))), detections)
+
+    assert results == expected
+    assert [face["identity"] for face in results[-1]] == ["person1", "person2"]
+    assert inference.calls == 1
+    assert batched.tracker.stats() == single.tracker.stats()
+    assert batched.tracker.stats()["embeddings"] == 6
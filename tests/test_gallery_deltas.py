@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+gallery_manager = pytest.importorskip("gallery_manager")
+from gallery_manager import (Gallery, GalleryCache, apply_gallery_deltas, compact_gallery, delta_log_path,
+                             load_gallery, read_gallery_deltas, save_gallery, update_gallery_identities)
+
+DIM = 16
+
+def random_embeddings(rng, count):
+    return rng.normal(size=(count, DIM))
+
+def make_gallery_file(tmp_path, identities=("a", "b", "c"), seed=0):
+    rng = np.random.default_rng(seed)
+    path = str(tmp_path / "gallery_2024_CSE.pth")
+    save_gallery({identity: rng.normal(size=DIM) for identity in identities}, path)
+    return path
+
+def add_record(rng, identity, count=2):
+    samples = random_embeddings(rng, count)
+    return {"op": "add", "identity": identity, "embedding": samples.mean(axis=0).tolist(),
+            "count": count, "sq_norm_sum": float((samples ** 2).sum())}
+
+def test_fold_in_and_out_keep_running_statistics():
+    rng = np.random.default_rng(1)
+    samples = random_embeddings(rng, 5)
+    gallery = Gallery([], np.zeros((0, 0), dtype=np.float32))
+    gallery.fold_in("a", samples[:3])
+    gallery.fold_in("a", samples[3:])
+
+    stats = gallery.identity_stats("a")
+    mean = samples.mean(axis=0)
+    assert stats["count"] == 5
+    np.testing.assert_allclose(gallery.raw_embedding("a"), mean, rtol=1e-5, atol=1e-6)
+    assert stats["spread"] == pytest.approx((samples ** 2).sum() / 5 - np.dot(mean, mean), rel=1e-4)
+
+    gallery.fold_out("a", samples[:2])
+    assert gallery.identity_stats("a")["count"] == 3
+    np.testing.assert_allclose(gallery.raw_embedding("a"), samples[2:].mean(axis=0), rtol=1e-4, atol=1e-5)
+
+    with pytest.raises(ValueError):
+        gallery.fold_out("a", random_embeddings(rng, 4))
+    gallery.fold_out("a", samples[2:])
+    assert "a" not in gallery
+
+def test_changes_are_numbered_and_replayed_from_the_log(tmp_path):
+    path = make_gallery_file(tmp_path)
+    rng = np.random.default_rng(2)
+    update_gallery_identities(path, {"op": "remove", "identity": "a"})
+    update_gallery_identities(path, {"op": "rename", "identity": "b", "new_identity": "b2"})
+    update_gallery_identities(path, add_record(rng, "d"))
+
+    records = read_gallery_deltas(path)
+    assert [r["seq"] for r in records] == [1, 2, 3]
+    assert [r["op"] for r in records] == ["remove", "rename", "add"]
+    assert [r["seq"] for r in read_gallery_deltas(path, after_seq=2)] == [3]
+
+    # A fresh process only has the files: the base file plus the replayed log
+    base = load_gallery(path, apply_deltas=False)
+    assert base.identities == ["a", "b", "c"] and base.delta_seq == 0
+    replayed = load_gallery(path)
+    assert replayed.identities == ["b2", "c", "d"]
+    assert replayed.delta_seq == 3
+    assert GalleryCache(mmap=False).get(path).identities == ["b2", "c", "d"]
+
+def test_replay_ignores_a_torn_final_record(tmp_path):
+    path = make_gallery_file(tmp_path)
+    update_gallery_identities(path, {"op": "remove", "identity": "a"})
+    # A writer crashed halfway through its record
+    with open(delta_log_path(path), "a") as f:
+        f.write('{"seq": 2, "op": "remove", "ident')
+
+    gallery = load_gallery(path)
+    assert gallery.identities == ["b", "c"]
+    assert gallery.delta_seq == 1
+
+def test_records_already_folded_into_the_file_are_skipped(tmp_path):
+    path = make_gallery_file(tmp_path)
+    rng = np.random.default_rng(3)
+    update_gallery_identities(path, {"op": "remove", "identity": "a"})
+    update_gallery_identities(path, add_record(rng, "d"))
+    with open(delta_log_path(path)) as f:
+        stale_log = f.read()
+
+    gallery, folded = compact_gallery(path)
+    assert folded == 2
+    assert gallery.delta_seq == 2
+    assert [r["op"] for r in read_gallery_deltas(path)] == ["checkpoint"]
+
+    # Crash after writing the gallery file but before the log was reset
+    with open(delta_log_path(path), "w") as f:
+        f.write(stale_log)
+    reloaded = load_gallery(path)
+    assert reloaded.identities == ["b", "c", "d"]
+    assert reloaded.identity_stats("d")["count"] == 2
+
+    # Numbering continues after the compacted records
+    update_gallery_identities(path, {"op": "remove", "identity": "b"})
+    assert read_gallery_deltas(path)[-1]["seq"] == 3
+
+def test_apply_gallery_deltas_skips_failing_records():
+    gallery = Gallery.from_dict({"a": np.ones(DIM), "b": -np.ones(DIM)})
+    records = [{"seq": 1, "op": "remove", "identity": "missing"},
+               {"seq": 2, "op": "rename", "identity": "a", "new_identity": "b"},
+               {"seq": 3, "op": "remove", "identity": "b"}]
+    updated = apply_gallery_deltas(gallery, records)
+    assert updated.identities == ["a"]
+    assert updated.delta_seq == 3
+    # The shared snapshot is left alone
+    assert gallery.identities == ["a", "b"] and gallery.delta_seq == 0
+
+def test_log_is_compacted_after_the_configured_number_of_ops(tmp_path):
+    path = make_gallery_file(tmp_path)
+    rng = np.random.default_rng(4)
+    ops = gallery_manager.GALLERY_DELTA_COMPACT_OPS
+    for i in range(ops - 1):
+        update_gallery_identities(path, add_record(rng, f"s{i:03d}"))
+    assert len(read_gallery_deltas(path)) == ops - 1
+    assert load_gallery(path, apply_deltas=False).delta_seq == 0
+
+    update_gallery_identities(path, add_record(rng, "last"))
+    with open(delta_log_path(path)) as f:
+        assert [json.loads(line) for line in f] == [{"seq": ops, "op": "checkpoint"}]
+    base = load_gallery(path, apply_deltas=False)
+    assert base.delta_seq == ops
+    assert len(base) == 3 + ops
+    assert "last" in base
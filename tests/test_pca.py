@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+gallery_manager = pytest.importorskip("gallery_manager")
+from gallery_manager import Gallery, load_gallery, match_embeddings, pca_recall, save_gallery, set_gallery_pca_dim
+
+DIM = 128
+QUERIES = 300
+CANDIDATES = 20
+
+@pytest.fixture(scope="module")
+def gallery():
+    # Real embeddings have most of their variance in a few directions
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(2000, DIM)) * 0.97 ** np.arange(DIM)
+    return Gallery.from_dict({f"id{i:04d}": v for i, v in enumerate(embeddings)})
+
+def recall_probes(gallery, seed=0, noise=0.5):
+    """The queries pca_recall() draws for the same seed"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=min(QUERIES, len(gallery)), replace=False)
+    return gallery.matrix()[rows] + rng.normal(scale=noise / np.sqrt(DIM), size=(len(rows), DIM))
+
+@pytest.mark.parametrize("dim", [8, 32])
+def test_coarse_to_fine_matching_agrees_with_pca_recall(gallery, dim):
+    recall = pca_recall(gallery, dims=(dim,), candidates=CANDIDATES, queries=QUERIES)[dim]
+
+    indexed = gallery.copy()
+    indexed.build_pca_index(dim)
+    probes = recall_probes(gallery)
+    coarse = match_embeddings(indexed, probes, -1.0, top_k=1, candidates=CANDIDATES)
+    exact = match_embeddings(gallery, probes, -1.0, top_k=1, exact=True)
+    found = sum(c[0][0] == e[0][0] for c, e in zip(coarse, exact)) / len(probes)
+    assert found == pytest.approx(recall)
+
+def test_recall_grows_with_the_dimension(gallery):
+    recall = pca_recall(gallery, dims=(4, 32), candidates=CANDIDATES, queries=QUERIES)
+    assert recall[4] < recall[32]
+    assert recall[32] >= 0.95
+
+def test_pca_dim_is_kept_in_the_gallery_file(gallery, tmp_path):
+    path = str(tmp_path / "gallery.pth")
+    save_gallery(gallery, path)
+    assert set_gallery_pca_dim(path, 32).pca_index.dim == 32
+    loaded = load_gallery(path)
+    assert loaded.pca_dim == 32 and loaded.pca_index.dim == 32
+    assert len(loaded.pca_index.reduced) == len(gallery)
+
+    with pytest.raises(ValueError):
+        set_gallery_pca_dim(path, DIM)
+    assert set_gallery_pca_dim(path, 0).pca_index is None
+    assert load_gallery(path).pca_dim is None
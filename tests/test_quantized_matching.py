@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+gallery_manager = pytest.importorskip("gallery_manager")
+from gallery_manager import Gallery, _quantized_scores, load_gallery, match_embeddings, save_gallery
+
+DIM = 128
+
+@pytest.fixture(scope="module")
+def galleries(tmp_path_factory):
+    """The same random gallery stored as float32, float16 and int8"""
+    rng = np.random.default_rng(0)
+    gallery = Gallery.from_dict({f"id{i:04d}": v for i, v in enumerate(rng.normal(size=(3000, DIM)))})
+    stored = {"float32": gallery}
+    for dtype in ("float16", "int8"):
+        path = str(tmp_path_factory.mktemp(dtype) / "gallery.pth")
+        save_gallery(gallery, path, dtype=dtype)
+        stored[dtype] = load_gallery(path)
+    return stored
+
+def noisy_queries(gallery, count=64, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=count, replace=False)
+    queries = gallery.matrix()[rows] + rng.normal(scale=0.5 / np.sqrt(DIM), size=(count, DIM))
+    # Unrelated faces as well, whose best matches are close together
+    return np.concatenate([queries, rng.normal(size=(count, DIM))])
+
+def exact_top_k(matrix, identities, query, k, threshold=-1.0):
+    query = query / np.linalg.norm(query)
+    scores = matrix @ query
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [(identities[i], float(scores[i])) for i in order if scores[i] >= threshold]
+
+@pytest.mark.parametrize("threshold", [-1.0, 0.1, 0.5])
+def test_int8_rerank_matches_exact_float32_top_k(galleries, threshold):
+    int8 = galleries["int8"]
+    # Re-ranking scores the dequantised rows with the float32 query, exactly
+    dequantised = int8.matrix()
+    queries = noisy_queries(int8)
+    for query, matches in zip(queries, match_embeddings(int8, queries, threshold, top_k=5)):
+        expected = exact_top_k(dequantised, int8.identities, query, 5, threshold)
+        assert [identity for identity, _ in matches] == [identity for identity, _ in expected]
+        np.testing.assert_allclose([s for _, s in matches], [s for _, s in expected], rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_best_match_equals_float32(galleries, dtype):
+    reference = galleries["float32"]
+    queries = noisy_queries(reference)[:64]
+    expected = match_embeddings(reference, queries, -1.0, top_k=1)
+    found = match_embeddings(galleries[dtype], queries, -1.0, top_k=1)
+    assert [m[0][0] for m in found] == [m[0][0] for m in expected]
+    np.testing.assert_allclose([m[0][1] for m in found], [m[0][1] for m in expected], atol=2e-2)
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_chunked_scores_equal_a_single_chunk(galleries, dtype, monkeypatch):
+    gallery = galleries[dtype]
+    queries = noisy_queries(gallery, count=8).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    rows = np.random.default_rng(2).choice(len(gallery), size=500, replace=False)
+
+    monkeypatch.setattr(gallery_manager, "GALLERY_MATCH_CHUNK", len(gallery))
+    whole = _quantized_scores(gallery, queries)
+    whole_rows = _quantized_scores(gallery, queries, rows)
+    whole_matches = match_embeddings(gallery, queries, 0.2, top_k=10)
+
+    # A chunk size that doesn't divide the row counts leaves a short last block
+    monkeypatch.setattr(gallery_manager, "GALLERY_MATCH_CHUNK", 7)
+    np.testing.assert_allclose(_quantized_scores(gallery, queries), whole, rtol=1e-6, atol=1e-7)
+    np.testing.assert_allclose(_quantized_scores(gallery, queries, rows), whole_rows, rtol=1e-6, atol=1e-7)
+    chunked_matches = match_embeddings(gallery, queries, 0.2, top_k=10)
+    assert [[i for i, _ in m] for m in chunked_matches] == [[i for i, _ in m] for m in whole_matches]
@@ -0,0 +1,152 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from result_cache import ResultCache, approximate_size
+
+def constant(value):
+    async def compute():
+        return value
+    return compute
+
+def test_least_recently_used_results_are_evicted_past_the_byte_bound():
+    async def run():
+        # Results of about 1 KB each, two of which fit
+        sizes = {key: approximate_size({"image": "x" * 1000, "key": key}) for key in "abc"}
+        cache = ResultCache(max_entries=10, max_bytes=sizes["a"] + sizes["b"] + 10)
+        for key in "ab":
+            await cache.get_or_compute(key, constant({"image": "x" * 1000, "key": key}))
+        assert cache.bytes == sizes["a"] + sizes["b"]
+
+        # Using "a" makes "b" the least recently used, so "c" evicts it
+        assert cache.peek("a") is not None
+        await cache.get_or_compute("c", constant({"image": "x" * 1000, "key": "c"}))
+        assert cache.peek("b") is None
+        assert cache.peek("a") is not None and cache.peek("c") is not None
+        assert cache.bytes == sizes["a"] + sizes["c"] <= cache.max_bytes
+
+        # A result larger than the whole bound isn't cached and evicts nothing
+        await cache.get_or_compute("big", constant({"image": "x" * 10000}))
+        assert cache.peek("big") is None
+        assert cache.stats()["entries"] == 2
+    asyncio.run(run())
+
+def test_entry_bound():
+    async def run():
+        cache = ResultCache(max_entries=2)
+        for key in range(3):
+            await cache.get_or_compute(key, constant({"key": key}))
+        assert cache.peek(0) is None
+        assert cache.peek(1) == {"key": 1} and cache.peek(2) == {"key": 2}
+    asyncio.run(run())
+
+def test_concurrent_requests_share_one_computation():
+    async def run():
+        cache = ResultCache()
+        calls = 0
+        release = asyncio.Event()
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"faces": [1, 2]}
+
+        waiters = [asyncio.ensure_future(cache.get_or_compute("key", compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert cache.stats()["in_flight"] == 1
+        release.set()
+        results = await asyncio.gather(*waiters)
+
+        assert calls == 1
+        assert all(result == {"faces": [1, 2]} for result in results)
+        assert cache.stats()["misses"] == 1 and cache.stats()["coalesced"] == 4
+        assert cache.stats()["in_flight"] == 0
+    asyncio.run(run())
+
+def test_cancelled_caller_does_not_cancel_the_shared_computation():
+    async def run():
+        cache = ResultCache()
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return {"ok": True}
+
+        first = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        second = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        assert await second == {"ok": True}
+        assert cache.peek("key") == {"ok": True}
+    asyncio.run(run())
+
+def test_failures_and_rejected_results_are_not_cached():
+    async def run():
+        cache = ResultCache()
+
+        async def fail():
+            raise RuntimeError("model crashed")
+
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute("key", fail)
+        assert await cache.get_or_compute("key", constant({"ok": True})) == {"ok": True}
+
+        result = await cache.get_or_compute("degraded", constant({"degradations": {"tiles": 0}}),
+                                            cacheable=lambda result: not result["degradations"])
+        assert result == {"degradations": {"tiles": 0}}
+        assert cache.peek("degraded") is None
+    asyncio.run(run())
+
+def test_callers_get_their_own_copies():
+    async def run():
+        cache = ResultCache()
+        first = await cache.get_or_compute("key", constant({"faces": [{"identity": "a"}]}))
+        first["faces"][0]["identity"] = "changed"
+        first["extra"] = True
+
+        second = await cache.get_or_compute("key", constant(None))
+        assert second == {"faces": [{"identity": "a"}]}
+        peeked = cache.peek("key")
+        peeked["faces"].clear()
+        assert cache.peek("key") == {"faces": [{"identity": "a"}]}
+    asyncio.run(run())
+
+def test_peek_never_computes():
+    async def run():
+        cache = ResultCache()
+        assert cache.peek("key") is None
+        assert cache.stats()["misses"] == 0 and cache.stats()["in_flight"] == 0
+
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return {"ok": True}
+
+        pending = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        # A computation in flight isn't a cached result yet
+        assert cache.peek("key") is None
+        release.set()
+        await pending
+        assert cache.peek("key") == {"ok": True}
+        assert cache.stats()["hits"] == 1
+    asyncio.run(run())
+
+def test_put_caches_a_copy_within_the_bounds():
+    async def run():
+        cache = ResultCache(max_entries=1)
+        value = {"faces": [1]}
+        cache.put("a", value)
+        value["faces"].append(2)
+        assert await cache.get_or_compute("a", constant(None)) == {"faces": [1]}
+
+        cache.put("b", {"faces": []})
+        assert cache.peek("a") is None and cache.peek("b") == {"faces": []}
+    asyncio.run(run())